@@ -0,0 +1,318 @@
+"""
+Load and latency benchmarks for the WebSocket and REST paths.
+
+Run from the ``teamchat`` directory:
+
+    python -m benchmarks --clients 20 --messages 20 --output bench.json
+    python -m benchmarks --baseline bench.json   # fail on regressions
+
+Simulated clients connect to ``teamchat.asgi.application`` through the real
+JWT middleware with ``WebsocketCommunicator``, on the in-memory channel
+layer and a throwaway SQLite database (see ``benchmarks.settings``).
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(latencies_ms):
+    return {
+        'samples': len(latencies_ms),
+        'p50_ms': round(percentile(latencies_ms, 50) or 0, 3),
+        'p95_ms': round(percentile(latencies_ms, 95) or 0, 3),
+        'p99_ms': round(percentile(latencies_ms, 99) or 0, 3),
+    }
+
+
+class QueryCounter:
+    """Counts queries on every connection, including database_sync_to_async threads"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        def wrap(sender, connection, **kwargs):
+            if self not in connection.execute_wrappers:
+                connection.execute_wrappers.append(self)
+
+        connection_created.connect(wrap, weak=False)
+        for connection in connections.all():
+            wrap(None, connection)
+
+    def reset(self):
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def setup_database(options):
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+
+    settings.CHAT_WRITE_BEHIND = options.write_behind
+    name = settings.DATABASES['default']['NAME']
+    if os.path.exists(name):
+        os.remove(name)
+    call_command('migrate', verbosity=0)
+    return seed(options)
+
+
+def seed(options):
+    from django.contrib.auth.hashers import make_password
+
+    from chat.models import Channel, Message, User
+
+    password = make_password('benchmark')
+    users = User.objects.bulk_create([
+        User(username=f'bench_user_{i}', password=password)
+        for i in range(options.clients)
+    ])
+    channels = []
+    for i in range(options.channels):
+        channel = Channel.objects.create(
+            name=f'bench-{i}', channel_type='public', created_by=users[0]
+        )
+        # Clients are spread round-robin over the channels
+        channel.members.add(*users[i::options.channels])
+        channels.append(channel)
+
+    words = ['deploy', 'review', 'standup', 'release', 'django', 'budget', 'incident', 'lunch']
+    for channel in channels:
+        members = users[channels.index(channel)::options.channels]
+        for start in range(0, options.history, 5000):
+            Message.objects.bulk_create([
+                Message(
+                    channel=channel,
+                    sender=members[n % len(members)],
+                    content=f'{words[n % len(words)]} {words[(n * 7) % len(words)]} message {n}'
+                )
+                for n in range(start, min(start + 5000, options.history))
+            ])
+    return users, channels
+
+
+async def run_websocket(users, channels, options, counter):
+    from channels.testing import WebsocketCommunicator
+    from rest_framework_simplejwt.tokens import RefreshToken
+
+    from teamchat.asgi import application
+
+    channel_of = {user.id: channels[i % len(channels)] for i, user in enumerate(users)}
+    members = {channel.id: [u for u in users if channel_of[u.id].id == channel.id] for channel in channels}
+
+    clients = []
+    for user in users:
+        token = str(RefreshToken.for_user(user).access_token)
+        communicator = WebsocketCommunicator(
+            application,
+            f'/ws/chat/{channel_of[user.id].id}/',
+            headers=[(b'authorization', f'Bearer {token}'.encode())],
+        )
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError(f'{user.username} could not connect')
+        clients.append((user, communicator))
+
+    sent_at = {}
+    latencies = []
+
+    async def read(user, communicator):
+        expected = len(members[channel_of[user.id].id]) * options.messages
+        seen = 0
+        while seen < expected:
+            frame = json.loads(await communicator.receive_from(timeout=options.timeout))
+            if frame.get('type') == 'chat':
+                latencies.append((time.perf_counter() - sent_at[frame['message']]) * 1000)
+                seen += 1
+
+    async def write(user, communicator):
+        for n in range(options.messages):
+            text = f'{user.id}:{n}'
+            sent_at[text] = time.perf_counter()
+            await communicator.send_to(text_data=json.dumps({'message': text}))
+            if options.interval:
+                await asyncio.sleep(options.interval)
+
+    counter.reset()
+    tracemalloc.start()
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(read(user, communicator) for user, communicator in clients),
+        *(write(user, communicator) for user, communicator in clients),
+    )
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    queries = counter.reset()
+
+    for _, communicator in clients:
+        await communicator.disconnect()
+
+    sent = len(users) * options.messages
+    return {
+        'clients': len(users),
+        'channels': len(channels),
+        'messages_sent': sent,
+        'deliveries': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(sent / elapsed, 1),
+        'deliveries_per_s': round(len(latencies) / elapsed, 1),
+        'send_to_receive': summarize(latencies),
+        'queries_per_message': round(queries / sent, 2),
+        'peak_traced_kb': round(peak / 1024, 1),
+    }
+
+
+def run_rest(users, channels, options, counter):
+    from rest_framework.test import APIClient
+
+    client = APIClient()
+    client.force_authenticate(users[0])
+    channel = channels[0]
+
+    first = client.get(f'/api/auth/channels/{channel.id}/messages/').json()
+    older = first.get('next')
+
+    endpoints = {
+        'channel_list': '/api/auth/channels/',
+        'message_list': f'/api/auth/channels/{channel.id}/messages/',
+        'message_list_older': older,
+        'message_search': f'/api/auth/channels/{channel.id}/search/?q=deploy',
+        'message_search_phrase': f'/api/auth/channels/{channel.id}/search/?q=%22release+budget%22',
+    }
+
+    results = {}
+    for name, url in endpoints.items():
+        if not url:
+            continue
+        latencies = []
+        counter.reset()
+        tracemalloc.start()
+        for _ in range(options.requests):
+            start = time.perf_counter()
+            response = client.get(url)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f'{name} returned {response.status_code}')
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {
+            **summarize(latencies),
+            'queries_per_request': round(counter.reset() / options.requests, 2),
+            'peak_traced_kb': round(peak / 1024, 1),
+        }
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Return regressions of p95 latency and queries per operation"""
+    regressions = []
+
+    def check(path, current, previous):
+        for key in ('p95_ms', 'queries_per_request', 'queries_per_message'):
+            if key in current and key in previous and previous[key]:
+                if current[key] > previous[key] * (1 + tolerance):
+                    regressions.append({
+                        'metric': f'{path}.{key}',
+                        'baseline': previous[key],
+                        'current': current[key],
+                    })
+
+    check('websocket', results['websocket']['send_to_receive'], baseline['websocket']['send_to_receive'])
+    check('websocket', results['websocket'], baseline['websocket'])
+    for name, current in results['rest'].items():
+        if name in baseline.get('rest', {}):
+            check(f'rest.{name}', current, baseline['rest'][name])
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=20, help='Simulated WebSocket clients')
+    parser.add_argument('--channels', type=int, default=2, help='Channels the clients are spread over')
+    parser.add_argument('--messages', type=int, default=20, help='Messages sent per client')
+    parser.add_argument('--interval', type=float, default=0, help='Seconds between sends per client')
+    parser.add_argument('--history', type=int, default=10000, help='Seeded messages per channel')
+    parser.add_argument('--write-behind', action='store_true', help='Persist messages through the write buffer')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per REST endpoint')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for a frame')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    parser.add_argument('--baseline', help='Compare against an earlier JSON result')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slowdown before a metric counts as a regression')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    users, channels = setup_database(options)
+
+    counter = QueryCounter()
+    counter.install()
+
+    # Keep stdout clean for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        websocket = asyncio.run(run_websocket(users, channels, options, counter))
+        rest = run_rest(users, channels, options, counter)
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'options': vars(options),
+        'websocket': websocket,
+        'rest': rest,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            results['regressions'] = compare(results, json.load(f), options.tolerance)
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+    if results.get('regressions'):
+        sys.exit(1)
@@ -0,0 +1,40 @@
+"""
+Settings for the benchmark harness: the real project settings with the
+in-memory channel layer, a throwaway SQLite database and in-process stores
+so a run needs neither Redis nor a running server.
+"""
+import os
+import tempfile
+
+os.environ.setdefault('SECRET_KEY', 'benchmark-only-secret-key')
+
+from teamchat.settings import *  # noqa: E402,F401,F403
+
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('BENCH_DB', os.path.join(tempfile.gettempdir(), 'teamchat_bench.sqlite3')),
+    }
+}
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {'capacity': 100000},
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+CHAT_RATE_LIMITER = {'BACKEND': 'chat.ratelimit.MemoryRateLimiter'}
+CHAT_RATE_LIMITS = {}
+CHAT_PRESENCE_STORE = {'BACKEND': 'chat.presence.MemoryPresenceStore'}
+CHAT_UNREAD_STORE = {'BACKEND': 'chat.unread.MemoryUnreadStore'}
+CHAT_REPLAY_BUFFER = {'BACKEND': 'chat.replay.MemoryReplayBuffer'}
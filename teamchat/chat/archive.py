@@ -0,0 +1,277 @@
+"""
+Archive tier for old messages.
+
+``archive_messages`` moves top-level messages older than
+``CHAT_ARCHIVE_AFTER_DAYS``, whose threads went quiet before that too, out
+of ``chat_message`` together with their replies. They are stored as one
+``MessageArchive`` row per channel and month holding the serialized
+messages as compressed JSON lines (zstd when ``zstandard`` is installed,
+gzip otherwise), so the hot table and its indexes only cover recent
+history.
+
+The history and search views page into the archive with the same cursors
+once a page reaches past the newest archived message of the channel, see
+``stitch_page``. Archived months are decompressed one at a time and matched
+in Python, which is slow compared to the hot tier but only paid by clients
+scrolling that far back.
+"""
+import gzip
+import json
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Message, MessageArchive, UserChannelLastSeen
+from .pagination import decode_cursor
+from .search import parse_query
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional, gzip is used instead
+    zstandard = None
+
+ARCHIVE_AFTER_DAYS = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 365)
+ARCHIVE_BATCH_SIZE = getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 1000)
+
+
+def compress(rows):
+    """Return (codec, data) for a list of serialized messages"""
+    raw = '\n'.join(json.dumps(row, separators=(',', ':')) for row in rows).encode()
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(raw)
+    return 'gzip', gzip.compress(raw)
+
+
+def decompress(codec, data):
+    data = bytes(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read zstd archives')
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raw = gzip.decompress(data)
+    return [json.loads(line) for line in raw.decode().splitlines()]
+
+
+def _sort_key(row):
+    return parse_datetime(row['timestamp']), row['id']
+
+
+def _month(timestamp):
+    return timestamp.astimezone(dt_timezone.utc).date().replace(day=1)
+
+
+def _horizon_key(channel_id):
+    return f'archive_horizon_{channel_id}'
+
+
+def get_horizon(channel_id):
+    """Timestamp of the newest archived message of a channel, or None"""
+    horizon = cache.get(_horizon_key(channel_id))
+    if horizon is None:
+        horizon = MessageArchive.objects.filter(channel_id=channel_id).aggregate(
+            last=Max('last_timestamp')
+        )['last'] or ''
+        cache.set(_horizon_key(channel_id), horizon, None)
+    return horizon or None
+
+
+def archive_messages(before=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Archive everything older than ``before``, returns the number of threads moved"""
+    if before is None:
+        before = timezone.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    total = 0
+    while True:
+        archived = _archive_batch(before, batch_size)
+        if not archived:
+            return total
+        total += archived
+
+
+def _archive_batch(before, batch_size):
+    from .serializers import MessageSerializer
+
+    with transaction.atomic():
+        parents = list(
+            Message.objects.filter(parent__isnull=True, timestamp__lt=before)
+            .filter(Q(last_reply_at__isnull=True) | Q(last_reply_at__lt=before))
+            .select_related('sender')
+            .select_for_update(of=('self',))
+            .order_by('timestamp', 'id')[:batch_size]
+        )
+        if not parents:
+            return 0
+        months = {parent.id: _month(parent.timestamp) for parent in parents}
+        replies = list(
+            Message.objects.filter(parent_id__in=months)
+            .select_related('sender')
+            .order_by('timestamp', 'id')
+        )
+
+        # Replies are archived in their parent's month
+        chunks = {}
+        messages = parents + replies
+        for message, row in zip(messages, MessageSerializer(messages, many=True).data):
+            month = months[message.parent_id or message.id]
+            chunks.setdefault((message.channel_id, month), []).append(row)
+        for (channel_id, month), rows in chunks.items():
+            _store(channel_id, month, rows)
+
+        _move_read_cursors(messages)
+        # Detach replies first so deleting them leaves the thread counters alone
+        Message.objects.filter(id__in=[reply.id for reply in replies]).update(parent=None)
+        Message.objects.filter(id__in=[message.id for message in messages]).delete()
+
+    for channel_id in {channel_id for channel_id, _ in chunks}:
+        cache.delete(_horizon_key(channel_id))
+    return len(parents)
+
+
+def _move_read_cursors(messages):
+    """
+    Move read cursors off messages about to be archived, which would null
+    them: to the newest older message of the channel that stays, so the
+    same messages count as unread. Without one the cursor is cleared and
+    ``last_seen`` set to the read message's time, which unread counting
+    falls back to.
+    """
+    archived = {message.id: message for message in messages}
+    cursors = set(
+        UserChannelLastSeen.objects.filter(last_read_message_id__in=archived)
+        .values_list('last_read_message_id', flat=True)
+    )
+    for message_id in cursors:
+        message = archived[message_id]
+        previous = (
+            Message.objects.filter(channel_id=message.channel_id, id__lt=message_id)
+            .exclude(id__in=archived)
+            .order_by('-id')
+            .values_list('id', flat=True)
+            .first()
+        )
+        visits = UserChannelLastSeen.objects.filter(last_read_message_id=message_id)
+        if previous is not None:
+            visits.update(last_read_message_id=previous)
+        else:
+            visits.update(last_read_message=None, last_seen=message.timestamp)
+
+
+def _store(channel_id, month, rows):
+    archive = MessageArchive.objects.select_for_update().filter(
+        channel_id=channel_id, month=month
+    ).first()
+    if archive is None:
+        archive = MessageArchive(channel_id=channel_id, month=month)
+    else:
+        known = {row['id'] for row in rows}
+        rows = [row for row in decompress(archive.codec, archive.data) if row['id'] not in known] + rows
+    rows.sort(key=_sort_key)
+
+    archive.codec, archive.data = compress(rows)
+    archive.message_count = len(rows)
+    archive.first_timestamp = parse_datetime(rows[0]['timestamp'])
+    archive.last_timestamp = parse_datetime(rows[-1]['timestamp'])
+    archive.save()
+
+
+def _load(archive_id):
+    codec, data = MessageArchive.objects.values_list('codec', 'data').get(id=archive_id)
+    return decompress(codec, data)
+
+
+def older_rows(channel_id, cursor, limit, match):
+    """
+    Up to ``limit`` archived rows older than ``cursor`` (None: from the
+    newest) that pass ``match``, newest first, and whether there are more.
+    """
+    archives = MessageArchive.objects.filter(channel_id=channel_id)
+    if cursor is not None:
+        archives = archives.filter(first_timestamp__lte=cursor[0])
+    found = []
+    # Months overlap, replies sit in their parent's month, so an archive is
+    # only skipped once the page is full of rows newer than all of it
+    for archive_id, last_timestamp in archives.order_by('-last_timestamp').values_list('id', 'last_timestamp'):
+        if len(found) > limit and last_timestamp < _sort_key(found[limit])[0]:
+            break
+        rows = [row for row in _load(archive_id) if match(row)]
+        if cursor is not None:
+            rows = [row for row in rows if _sort_key(row) < cursor]
+        found.extend(rows)
+        found.sort(key=_sort_key, reverse=True)
+    return found[:limit], len(found) > limit
+
+
+def newer_rows(channel_id, cursor, limit, match):
+    """Like ``older_rows`` for rows newer than ``cursor``, oldest first"""
+    archives = MessageArchive.objects.filter(channel_id=channel_id, last_timestamp__gte=cursor[0])
+    found = []
+    for archive_id, first_timestamp in archives.order_by('first_timestamp').values_list('id', 'first_timestamp'):
+        if len(found) > limit and first_timestamp > _sort_key(found[limit])[0]:
+            break
+        rows = [row for row in _load(archive_id) if match(row) and _sort_key(row) > cursor]
+        found.extend(rows)
+        found.sort(key=_sort_key)
+    return found[:limit], len(found) > limit
+
+
+def top_level(row):
+    return row['parent'] is None
+
+
+def search_matcher(query='', date_from=None, date_to=None, user_id=None):
+    """
+    A ``match`` function for archived rows mirroring the search view's
+    filters; text matches case-insensitively as substrings.
+    """
+    terms = [text.lower() for text, _ in parse_query(query)]
+
+    def match(row):
+        if user_id is not None and row['sender'] != user_id:
+            return False
+        if date_from or date_to:
+            day = parse_datetime(row['timestamp']).date()
+            if (date_from and day < date_from) or (date_to and day > date_to):
+                return False
+        content = row['content'].lower()
+        return all(term in content for term in terms)
+    return match
+
+
+def stitch_page(paginator, rows, channel_id, match=top_level):
+    """
+    Merge archived rows into a page of serialized hot rows produced by
+    ``MessageCursorPagination``, and move the paginator's cursors along.
+    """
+    horizon = get_horizon(channel_id)
+    if horizon is None:
+        return rows
+    params = paginator.request.query_params
+    size = paginator.size
+    rows = list(rows)
+
+    if params.get('after'):
+        cursor = decode_cursor(params['after'])
+        if cursor[0] > horizon:
+            return rows
+        archived, more = newer_rows(channel_id, cursor, size, match)
+        merged = sorted(rows + archived, key=_sort_key)
+        paginator.has_newer = paginator.has_newer or more or len(merged) > size
+        merged = merged[:size]
+        merged.reverse()
+    else:
+        # Hot rows newer than every archived one can't interleave with them
+        if paginator.has_older and rows and _sort_key(rows[-1])[0] > horizon:
+            return rows
+        cursor = decode_cursor(params['before']) if params.get('before') else None
+        archived, more = older_rows(channel_id, cursor, size, match)
+        merged = sorted(rows + archived, key=_sort_key, reverse=True)
+        paginator.has_older = paginator.has_older or more or len(merged) > size
+        merged = merged[:size]
+
+    paginator.page = merged
+    return merged
@@ -1,63 +1,96 @@
 import json
+import time
+from urllib.parse import parse_qs
+from channels.consumer import AsyncConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
-from .models import Channel, Message, UserChannelLastSeen
+from .models import Channel, Message
 from django.utils import timezone
 from django.core.exceptions import PermissionDenied
-from django.core.cache import cache
+from django.conf import settings
+from .persistence import get_write_buffer, new_provisional_id, write_behind_enabled
+from .membership import ensure_invalidation_listener, is_member
+from . import groups, presence, ratelimit, sync, unread
+from .replay import channel_send, missed_frames, thread_send
+from .threads import MAX_THREAD_SUBSCRIPTIONS, get_thread_parent, thread_group
+from .typing_indicators import get_typing_broadcaster
+from .encoding import encode_frame, frame_event
+from .outbound import OutboundQueue, server_transport
 User = get_user_model()
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # Frames to the client once the socket is accepted, see chat.outbound
+    outbound = None
+    # When this socket last pushed its presence connection forward
+    presence_refreshed = 0.0
+
     async def connect(self):
         self.channel_id = self.scope['url_route']['kwargs']['channel_id']
-        self.channel_group_name = f'chat_{self.channel_id}'
-        
-        # Join room group
-        await self.channel_layer.group_add(
-            self.channel_group_name,
-            self.channel_name
-        )
-        
-        # Update user presence
+        self.channel_group_name = None
+        self.joined = False
+        self.threads = {}
         user = self.scope['user']
-        if user.is_authenticated:
-            await self.update_user_presence(user, True)
-            await self.channel_layer.group_send(
-                self.channel_group_name,
-                {
-                    'type': 'user_presence',
-                    'user_id': user.id,
-                    'status': True
-                }
-            )
+
+        # Refuse the handshake unless the user belongs to the channel
+        if not user.is_authenticated or not self.channel_id.isdigit():
+            await self.close()
+            return
+        await ensure_invalidation_listener()
+        if not await is_member(self.channel_id, user.id):
+            await self.close()
+            return
+
+        # Join room group, or this socket's shard of it
+        self.channel_group_name = await groups.join(self.channel_layer, self.channel_id, self.channel_name)
+        self.joined = True
         
-        await self.accept()
+        await self.accept(self.scope.get('auth_subprotocol'))
+        self.start_outbound()
+
+        # Announced to all of the user's channels on their first connection only
+        await presence.user_connected(user.id, self.channel_name)
+        self.presence_refreshed = time.monotonic()
+
+        # Reconnecting clients pass the last seq they saw as ?since=
+        since = parse_qs(self.scope.get('query_string', b'').decode()).get('since')
+        if since and since[0].isdigit():
+            await self.replay(int(self.channel_id), int(since[0]))
 
     async def disconnect(self, close_code):
+        self.stop_outbound()
+        if not self.joined:
+            return
+
         # Leave room group
         await self.channel_layer.group_discard(
             self.channel_group_name,
             self.channel_name
         )
+        await self.leave_threads()
         
-        # Update user presence
-        user = self.scope['user']
-        if user.is_authenticated:
-            await self.update_user_presence(user, False)
-            await self.channel_layer.group_send(
-                self.channel_group_name,
-                {
-                    'type': 'user_presence',
-                    'user_id': user.id,
-                    'status': False
-                }
-            )
+        # Offline is announced after a grace period once no connection is left
+        await presence.user_disconnected(self.scope['user'].id, self.channel_name)
 
     async def receive(self, text_data):
 
         try:
             text_data_json = json.loads(text_data)
+            await self.refresh_presence(force=text_data_json.get('type') == 'heartbeat')
+            if text_data_json.get('type') == 'heartbeat':
+                return
+            if text_data_json.get('type') == 'typing':
+                self.user_typing(int(self.channel_id))
+                return
+            if text_data_json.get('type') == 'read':
+                await self.mark_read(int(self.channel_id), text_data_json.get('message_id'))
+                return
+            if text_data_json.get('type') in ('reply', 'subscribe_thread', 'unsubscribe_thread'):
+                await self.receive_thread_frame(int(self.channel_id), text_data_json)
+                return
+            if text_data_json.get('type') in ('edit', 'delete'):
+                await self.receive_change_frame(int(self.channel_id), text_data_json)
+                return
             message = text_data_json.get('message', '')[:2000]
             if not message.strip():
                 return
@@ -70,85 +103,502 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'message': 'Authentication required'
                 }))
                 return
-            if not await self.check_rate_limit(user):
-                await self.send_error('Message rate limit exceeded')
-                return
-            # Save message to database with additional checks
-            saved_message = await self.save_message(user, message)
-            print(f"Message saved with ID: {saved_message.id}")  
-            # Send message to room group
-            await self.channel_layer.group_send(
-                self.channel_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'user_id': user.id,
-                    'username': user.username,
-                    'timestamp': str(saved_message.timestamp),
-                    'message_id': saved_message.id
-                }
-            )
+            await self.post_message(self.channel_id, user, message)
 
         except Exception as e:
             await self.send(text_data=json.dumps({
                 'type': 'error',
                 'message': str(e)
             }))
-    @database_sync_to_async
-    def check_rate_limit(self, user):
-        """Allow max 20 messages per minute per user"""
-        
-        cache_key = f'msg_rate_{user.id}'
-        count = cache.get(cache_key, 0)
-        if count >= 20:
+
+    async def post_message(self, channel_id, user, message):
+        if not await self.check_rate_limit(user, channel_id):
+            await self.send_error('Message rate limit exceeded')
+            return
+        get_typing_broadcaster().message_sent(int(channel_id), user.id)
+        if write_behind_enabled():
+            await self.send_buffered_message(channel_id, user, message)
+            return
+        # Save message to database with additional checks
+        saved_message = await self.save_message(channel_id, user, message)
+        print(f"Message saved with ID: {saved_message.id}")  
+        # Send message to room group, encoded once for every member
+        await channel_send(
+            self.channel_layer,
+            int(channel_id),
+            saved_message.seq,
+            frame_event('chat_message', {
+                'type': 'chat',
+                'channel_id': int(channel_id),
+                'message': message,
+                'user_id': user.id,
+                'username': user.username,
+                'timestamp': str(saved_message.timestamp),
+                'message_id': saved_message.id,
+                'seq': saved_message.seq,
+                'provisional': False
+            })
+        )
+        await unread.message_posted(int(channel_id), user.id, saved_message.id)
+
+    async def receive_thread_frame(self, channel_id, data):
+        try:
+            parent_id = int(data.get('parent_id'))
+        except (TypeError, ValueError):
+            await self.send_error('parent_id is required', channel_id)
+            return
+
+        if data['type'] == 'subscribe_thread':
+            await self.subscribe_thread(channel_id, parent_id)
+        elif data['type'] == 'unsubscribe_thread':
+            await self.unsubscribe_thread(parent_id)
+        else:
+            message = str(data.get('message', ''))[:2000]
+            if message.strip():
+                await self.post_reply(channel_id, self.scope['user'], parent_id, message)
+
+    async def subscribe_thread(self, channel_id, parent_id):
+        """Receive the replies of a thread; False if it can't be followed"""
+        if parent_id in self.threads:
+            return True
+        if len(self.threads) >= MAX_THREAD_SUBSCRIPTIONS:
+            await self.send_error('Too many thread subscriptions', channel_id)
+            return False
+        if (not await is_member(channel_id, self.scope['user'].id)
+                or await database_sync_to_async(get_thread_parent)(channel_id, parent_id) is None):
+            await self.send_error('Thread not found', channel_id)
             return False
-        cache.set(cache_key, count+1, timeout=60)
+
+        await self.channel_layer.group_add(thread_group(parent_id), self.channel_name)
+        self.threads[parent_id] = channel_id
+        await self.send(text_data=encode_frame({
+            'type': 'thread_subscribed', 'channel_id': channel_id, 'parent_id': parent_id
+        }))
         return True
-    async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat',
-            'message': event['message'],
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'timestamp': event['timestamp'],
-            'message_id': event['message_id']
+
+    async def unsubscribe_thread(self, parent_id):
+        channel_id = self.threads.pop(parent_id, None)
+        if channel_id is None:
+            return
+        await self.channel_layer.group_discard(thread_group(parent_id), self.channel_name)
+        await self.send(text_data=encode_frame({
+            'type': 'thread_unsubscribed', 'channel_id': channel_id, 'parent_id': parent_id
         }))
 
-    async def user_presence(self, event):
-        # Send presence update to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'presence',
-            'user_id': event['user_id'],
-            'status': event['status']
+    async def leave_threads(self, channel_id=None):
+        """Drop thread groups, all of them or those of one channel"""
+        for parent_id, thread_channel_id in list(self.threads.items()):
+            if channel_id is None or thread_channel_id == channel_id:
+                await self.channel_layer.group_discard(thread_group(parent_id), self.channel_name)
+                del self.threads[parent_id]
+
+    async def post_reply(self, channel_id, user, parent_id, content):
+        if not await self.check_rate_limit(user, channel_id):
+            await self.send_error('Message rate limit exceeded', channel_id)
+            return
+        # Validates the thread, and whoever replies follows it from now on
+        if not await self.subscribe_thread(channel_id, parent_id):
+            return
+
+        group_name = thread_group(parent_id)
+        buffered = write_behind_enabled()
+        if buffered:
+            message_id, timestamp, seq = new_provisional_id(), timezone.now(), None
+        else:
+            reply = await self._create_message(channel_id, user, content, parent_id=parent_id)
+            message_id, timestamp, seq = reply.id, reply.timestamp, reply.seq
+
+        await self.channel_layer.group_send(group_name, frame_event('chat_message', {
+            'type': 'reply',
+            'channel_id': channel_id,
+            'parent_id': parent_id,
+            'message': content,
+            'user_id': user.id,
+            'username': user.username,
+            'timestamp': str(timestamp),
+            'message_id': message_id,
+            'seq': seq,
+            'provisional': buffered
         }))
+        # The channel only learns that the thread moved on
+        event = frame_event('chat_message', {
+            'type': 'thread_reply',
+            'channel_id': channel_id,
+            'parent_id': parent_id,
+            'message_id': message_id,
+            'user_id': user.id,
+            'timestamp': str(timestamp),
+            'seq': seq
+        })
+        if buffered:
+            # Recorded for replay once the write buffer has its seq
+            await groups.group_send(self.channel_layer, channel_id, event)
+        else:
+            await channel_send(self.channel_layer, channel_id, seq, event)
+        if buffered:
+            await get_write_buffer().add(
+                message_id, channel_id, group_name, user.id, content, timestamp, parent_id=parent_id
+            )
 
-    @database_sync_to_async
-    def save_message(self, user, content):
-        channel = Channel.objects.get(id=self.channel_id)
-        
-        # Verify user is a member of the channel
-        if not channel.members.filter(id=user.id).exists():
+    async def receive_change_frame(self, channel_id, data):
+        try:
+            message_id = int(data.get('message_id'))
+        except (TypeError, ValueError):
+            await self.send_error('message_id is required', channel_id)
+            return
+
+        user = self.scope['user']
+        if not await self.check_rate_limit(user, channel_id):
+            await self.send_error('Message rate limit exceeded', channel_id)
+            return
+        if not await is_member(channel_id, user.id):
             raise PermissionDenied("You are not a member of this channel")
-        
-        # Create and save the message
-        message = Message.objects.create(
-            channel=channel,
-            sender=user,
-            content=content
+
+        if data['type'] == 'edit':
+            content = str(data.get('message', ''))[:2000]
+            if content.strip():
+                await self.edit_message(channel_id, user, message_id, content)
+        else:
+            await self.delete_message(channel_id, user, message_id)
+
+    async def edit_message(self, channel_id, user, message_id, content):
+        message = await database_sync_to_async(sync.edit_message)(channel_id, message_id, user, content)
+        event = frame_event('chat_message', {
+            'type': 'message_edited',
+            'channel_id': channel_id,
+            'parent_id': message.parent_id,
+            'message_id': message.id,
+            'message': message.content,
+            'edited_at': str(message.edited_at),
+            'seq': message.seq
+        })
+        # Replies are edited in their thread, like they were posted
+        if message.parent_id:
+            await thread_send(self.channel_layer, channel_id, message.parent_id, message.seq, event)
+        else:
+            await channel_send(self.channel_layer, channel_id, message.seq, event)
+
+    async def delete_message(self, channel_id, user, message_id):
+        tombstones = await database_sync_to_async(sync.delete_message)(channel_id, message_id, user)
+        # Replies deleted along with their parent go without a frame of their own
+        deleted = tombstones[0]
+        event = frame_event('chat_message', {
+            'type': 'message_deleted',
+            'channel_id': channel_id,
+            'parent_id': deleted.parent_id,
+            'message_id': deleted.message_id,
+            'seq': deleted.seq
+        })
+        if deleted.parent_id:
+            await thread_send(self.channel_layer, channel_id, deleted.parent_id, deleted.seq, event)
+        else:
+            await channel_send(self.channel_layer, channel_id, deleted.seq, event)
+            # Followers of the thread learn it is gone
+            await self.channel_layer.group_send(thread_group(deleted.message_id), event)
+
+    def user_typing(self, channel_id):
+        # Ephemeral: throttled and batched per process, never stored and
+        # not counted by the message rate limiter
+        user = self.scope['user']
+        get_typing_broadcaster().typing(channel_id, user.id, user.username)
+
+    async def replay(self, channel_id, since):
+        """Send the channel frames missed since seq ``since``"""
+        for frame in await missed_frames(channel_id, since):
+            await self.outbound.put(frame, replayed=True)
+
+    async def refresh_presence(self, force=False):
+        """Keep the connection live; any frame counts, heartbeats always refresh"""
+        now = time.monotonic()
+        if force or now - self.presence_refreshed >= presence.REFRESH_INTERVAL:
+            self.presence_refreshed = now
+            await presence.heartbeat(self.scope['user'].id, self.channel_name)
+
+    async def check_rate_limit(self, user, channel_id):
+        """Per user, per channel and per client IP limits from CHAT_RATE_LIMITS"""
+        client = self.scope.get('client')
+        return await ratelimit.acheck([
+            ('message:user', user.id),
+            ('message:channel', channel_id),
+            ('message:ip', client[0] if client else None),
+        ])
+
+    async def mark_read(self, channel_id, message_id):
+        """Read receipt: the user has seen everything up to message_id"""
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            await self.send_error('message_id is required', channel_id)
+            return
+        if not await unread.amark_read(self.scope['user'].id, channel_id, message_id):
+            await self.send_error('Message not found in this channel', channel_id)
+
+    async def send_error(self, message, channel_id=None):
+        frame = {'type': 'error', 'message': message}
+        if channel_id is not None:
+            frame['channel_id'] = channel_id
+        await self.send(text_data=encode_frame(frame))
+
+    def start_outbound(self):
+        self.outbound = OutboundQueue(
+            self.write_frame, self.resync_frame, self.close, transport=server_transport(self.scope)
         )
-        
-        # Update last seen timestamp for the user in this channel
-        UserChannelLastSeen.objects.update_or_create(
-            user=user,
-            channel=channel,
-            defaults={'last_seen': timezone.now()}
+
+    def stop_outbound(self):
+        if self.outbound is not None:
+            self.outbound.stop()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        # Once accepted, text frames are queued so they reach the client in order
+        if self.outbound is None or text_data is None or close:
+            await super().send(text_data, bytes_data, close)
+        else:
+            await self.outbound.put(text_data)
+
+    async def write_frame(self, frame):
+        await super().send(text_data=frame)
+
+    def resync_frame(self):
+        # Frames were dropped, the client reloads with its last seq
+        return encode_frame({'type': 'resync_required', 'channel_ids': [int(self.channel_id)]})
+
+    async def send_frame(self, event):
+        # Frame was encoded once by the sender, write it straight out
+        await self.send(text_data=event['frame'])
+
+    async def user_presence(self, event):
+        # Only the latest status of a user waits for a slow client
+        user_id = event.get('user_id')
+        if self.outbound is None or user_id is None:
+            await self.send_frame(event)
+        else:
+            await self.outbound.put(event['frame'], key=('presence', user_id))
+
+    async def typing_indicator(self, event):
+        if self.outbound is None:
+            await self.send_frame(event)
+        else:
+            await self.outbound.put(event['frame'], ephemeral=True)
+
+    chat_message = send_frame
+    # Durable ids / failures for messages that were fanned out provisionally
+    message_ack = send_frame
+    message_failed = send_frame
+
+    async def send_buffered_message(self, channel_id, user, content):
+        """Fan out right away and leave the insert to the write buffer"""
+        if not await is_member(channel_id, user.id):
+            raise PermissionDenied("You are not a member of this channel")
+
+        provisional_id = new_provisional_id()
+        group_name = groups.channel_group(channel_id)
+        timestamp = timezone.now()
+        await groups.group_send(
+            self.channel_layer,
+            channel_id,
+            frame_event('chat_message', {
+                'type': 'chat',
+                'channel_id': int(channel_id),
+                'message': content,
+                'user_id': user.id,
+                'username': user.username,
+                'timestamp': str(timestamp),
+                'message_id': provisional_id,
+                'provisional': True
+            })
         )
-        
-        return message
+        await unread.message_posted(int(channel_id), user.id)
+        await get_write_buffer().add(
+            provisional_id,
+            channel_id,
+            group_name,
+            user.id,
+            content,
+            timestamp
+        )
+
+    async def group_reshard(self, event):
+        # The channel's shard count changed, move to this socket's new shard
+        group = groups.shard_group(event['channel_id'], event['shards'], self.channel_name)
+        if group != self.channel_group_name:
+            await self.channel_layer.group_add(group, self.channel_name)
+            await self.channel_layer.group_discard(self.channel_group_name, self.channel_name)
+            self.channel_group_name = group
+
+    async def members_changed(self, event):
+        if self.scope['user'].id in event['removed']:
+            await self.membership_revoked(event)
+        else:
+            await self.send_frame(event)
+
+    async def membership_revoked(self, event):
+        # The user was removed from the channel while connected
+        await self.close()
+
+    async def save_message(self, channel_id, user, content):
+        # Verify user is a member of the channel (cached, no query when warm)
+        if not await is_member(channel_id, user.id):
+            raise PermissionDenied("You are not a member of this channel")
+        return await self._create_message(channel_id, user, content)
 
     @database_sync_to_async
-    def update_user_presence(self, user, online):
-        user.online = online
-        user.last_seen = timezone.now()
-        user.save(update_fields=['online', 'last_seen'])
\ No newline at end of file
+    def _create_message(self, channel_id, user, content, parent_id=None):
+        # Create and save the message; the sender's read cursor moves
+        # through the unread store and is flushed in bulk
+        return sync.create_message(
+            channel_id=channel_id,
+            sender=user,
+            content=content,
+            parent_id=parent_id
+        )
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    One authenticated socket for any number of channels.
+
+    Clients send ``subscribe``/``unsubscribe`` frames with a ``channel_id``
+    and ``message`` frames tagged with the channel they are for; every
+    outgoing chat frame carries its ``channel_id``.
+    """
+    max_subscriptions = getattr(settings, 'CHAT_MULTIPLEX_MAX_CHANNELS', 500)
+
+    async def connect(self):
+        # channel_id -> the group (shard) this socket joined
+        self.subscriptions = {}
+        self.threads = {}
+        self.last_presence = {}
+        self.joined = False
+        user = self.scope['user']
+
+        if not user.is_authenticated:
+            await self.close()
+            return
+        await ensure_invalidation_listener()
+        self.joined = True
+        await self.accept(self.scope.get('auth_subprotocol'))
+        self.start_outbound()
+        await presence.user_connected(user.id, self.channel_name)
+        self.presence_refreshed = time.monotonic()
+
+    async def disconnect(self, close_code):
+        self.stop_outbound()
+        if not self.joined:
+            return
+        for group in self.subscriptions.values():
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.subscriptions.clear()
+        await self.leave_threads()
+        await presence.user_disconnected(self.scope['user'].id, self.channel_name)
+
+    async def receive(self, text_data):
+        channel_id = None
+        try:
+            data = json.loads(text_data)
+            frame_type = data.get('type')
+            user = self.scope['user']
+
+            await self.refresh_presence(force=frame_type == 'heartbeat')
+            if frame_type == 'heartbeat':
+                return
+
+            try:
+                channel_id = int(data.get('channel_id'))
+            except (TypeError, ValueError):
+                await self.send_error('channel_id is required')
+                return
+
+            if frame_type == 'subscribe':
+                await self.subscribe(channel_id, data.get('since'))
+            elif frame_type == 'unsubscribe':
+                await self.unsubscribe(channel_id)
+            elif frame_type == 'read':
+                if channel_id not in self.subscriptions:
+                    await self.send_error('Not subscribed to this channel', channel_id)
+                    return
+                await self.mark_read(channel_id, data.get('message_id'))
+            elif frame_type == 'typing':
+                if channel_id in self.subscriptions:
+                    self.user_typing(channel_id)
+            elif frame_type in ('subscribe_thread', 'unsubscribe_thread'):
+                await self.receive_thread_frame(channel_id, data)
+            elif frame_type in ('message', 'reply', 'edit', 'delete'):
+                if channel_id not in self.subscriptions:
+                    await self.send_error('Not subscribed to this channel', channel_id)
+                    return
+                if frame_type == 'reply':
+                    await self.receive_thread_frame(channel_id, data)
+                    return
+                if frame_type in ('edit', 'delete'):
+                    await self.receive_change_frame(channel_id, data)
+                    return
+                message = str(data.get('message', ''))[:2000]
+                if message.strip():
+                    await self.post_message(channel_id, user, message)
+            else:
+                await self.send_error('Unknown frame type', channel_id)
+
+        except Exception as e:
+            await self.send_error(str(e), channel_id)
+
+    async def subscribe(self, channel_id, since=None):
+        if channel_id in self.subscriptions:
+            return
+        if len(self.subscriptions) >= self.max_subscriptions:
+            await self.send_error('Too many subscriptions', channel_id)
+            return
+        if not await is_member(channel_id, self.scope['user'].id):
+            await self.send_error('You are not a member of this channel', channel_id)
+            return
+
+        self.subscriptions[channel_id] = await groups.join(self.channel_layer, channel_id, self.channel_name)
+        await self.send(text_data=encode_frame({'type': 'subscribed', 'channel_id': channel_id}))
+        if isinstance(since, int) and since >= 0:
+            await self.replay(channel_id, since)
+
+    async def unsubscribe(self, channel_id, reason=None):
+        group = self.subscriptions.pop(channel_id, None)
+        if group is None:
+            return
+        await self.channel_layer.group_discard(group, self.channel_name)
+        frame = {'type': 'unsubscribed', 'channel_id': channel_id}
+        if reason:
+            frame['reason'] = reason
+        await self.send(text_data=encode_frame(frame))
+
+    async def user_presence(self, event):
+        # Presence goes to every channel of the user, forward only one copy
+        user_id = event.get('user_id')
+        if user_id is not None:
+            if self.last_presence.get(user_id) == event['frame']:
+                return
+            self.last_presence[user_id] = event['frame']
+        await super().user_presence(event)
+
+    def resync_frame(self):
+        return encode_frame({'type': 'resync_required', 'channel_ids': sorted(self.subscriptions)})
+
+    async def group_reshard(self, event):
+        channel_id = event['channel_id']
+        current = self.subscriptions.get(channel_id)
+        group = groups.shard_group(channel_id, event['shards'], self.channel_name)
+        if current is not None and group != current:
+            await self.channel_layer.group_add(group, self.channel_name)
+            await self.channel_layer.group_discard(current, self.channel_name)
+            self.subscriptions[channel_id] = group
+
+    async def membership_revoked(self, event):
+        await self.leave_threads(event['channel_id'])
+        await self.unsubscribe(event['channel_id'], reason='removed')
+
+
+class GroupRelayConsumer(AsyncConsumer):
+    """
+    Worker for ``CHAT_GROUP_RELAY``: does the per-shard sends of sharded
+    channels so the sending socket only makes one call.
+    """
+
+    async def relay_send(self, message):
+        await groups.send_to_shards(
+            self.channel_layer, message['channel_id'], message['shards'], message['event']
+        )
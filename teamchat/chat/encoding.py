@@ -0,0 +1,25 @@
+"""
+Outgoing WebSocket frame encoding.
+
+Group events carry a ``frame`` that the sender encoded once, and every
+receiving consumer writes it to its socket as-is. orjson is used when it
+is installed, the stdlib encoder otherwise.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+
+def encode_frame(payload):
+    """Encode a frame dict to the text sent over the socket"""
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, separators=(',', ':'), default=str)
+
+
+def frame_event(event_type, payload, **extra):
+    """Build a channel layer event around a pre-encoded frame"""
+    return {'type': event_type, 'frame': encode_frame(payload), **extra}
@@ -0,0 +1,152 @@
+"""
+Channel-layer groups of chat channels, optionally sharded.
+
+Every socket of a channel joins the channel's group, so with channels_redis
+a ``group_send`` to a big channel is one Lua call on one Redis key that
+pushes to every member's queue while the sender waits. A channel with
+``Channel.group_shards`` above 1 spreads its sockets over that many groups
+by a hash of the socket's channel name, and a send goes to the shard groups
+concurrently: each call is smaller, and with several channels_redis hosts
+the shard groups land on different servers. With ``CHAT_GROUP_RELAY`` set
+the sender only hands the event to a relay worker, which does the sends.
+
+Shard counts are cached per process and changed with ``set_group_shards``,
+which moves connected sockets into their new shard group. Frames sent
+while sockets move can be missed; clients notice the seq gap and catch up
+like after a reconnect.
+"""
+import asyncio
+import threading
+import time
+import zlib
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .models import Channel
+
+RELAY_CHANNEL = getattr(settings, 'CHAT_GROUP_RELAY', None)
+SHARDS_CACHE_TTL = getattr(settings, 'CHAT_GROUP_SHARDS_CACHE_TTL', 300)
+MAX_GROUP_SHARDS = 256
+
+_shards = {}
+_lock = threading.Lock()
+
+
+def channel_group(channel_id):
+    """The unsharded group of a channel"""
+    return f'chat_{channel_id}'
+
+
+def shard_group(channel_id, shards, channel_name):
+    """The group a socket joins in a channel with ``shards`` groups"""
+    if shards <= 1:
+        return channel_group(channel_id)
+    return f'chat_{channel_id}_{zlib.crc32(channel_name.encode()) % shards}'
+
+
+def shard_groups(channel_id, shards):
+    if shards <= 1:
+        return [channel_group(channel_id)]
+    return [f'chat_{channel_id}_{shard}' for shard in range(shards)]
+
+
+def remember_shards(counts):
+    """Cache {channel_id: shards} read along with other channel data"""
+    expires = time.monotonic() + SHARDS_CACHE_TTL
+    with _lock:
+        for channel_id, shards in counts.items():
+            _shards[int(channel_id)] = (shards, expires)
+
+
+def forget_shards(channel_ids):
+    with _lock:
+        for channel_id in channel_ids:
+            _shards.pop(int(channel_id), None)
+
+
+def _cached_shards(channel_id):
+    with _lock:
+        entry = _shards.get(int(channel_id))
+    if entry is None or entry[1] < time.monotonic():
+        return None
+    return entry[0]
+
+
+def _query_shards(channel_id):
+    shards = Channel.objects.filter(id=channel_id).values_list('group_shards', flat=True).first()
+    shards = shards or 1
+    remember_shards({channel_id: shards})
+    return shards
+
+
+async def get_shards(channel_id):
+    shards = _cached_shards(channel_id)
+    if shards is None:
+        shards = await database_sync_to_async(_query_shards)(channel_id)
+    return shards
+
+
+async def join(channel_layer, channel_id, channel_name):
+    """Add a socket to its group of the channel and return the group's name"""
+    group = shard_group(channel_id, await get_shards(channel_id), channel_name)
+    await channel_layer.group_add(group, channel_name)
+    return group
+
+
+async def send_to_shards(channel_layer, channel_id, shards, event):
+    groups = shard_groups(channel_id, shards)
+    if len(groups) == 1:
+        await channel_layer.group_send(groups[0], event)
+        return
+    await asyncio.gather(*(channel_layer.group_send(group, event) for group in groups))
+
+
+async def group_send(channel_layer, channel_id, event, shards=None):
+    """``group_send`` to every socket of a channel, whichever shard it is in"""
+    if shards is None:
+        shards = await get_shards(channel_id)
+    if shards > 1 and RELAY_CHANNEL:
+        await channel_layer.send(RELAY_CHANNEL, {
+            'type': 'relay.send',
+            'channel_id': int(channel_id),
+            'shards': shards,
+            'event': event,
+        })
+        return
+    await send_to_shards(channel_layer, channel_id, shards, event)
+
+
+def group_send_sync(channel_layer, channel_id, event):
+    async_to_sync(group_send)(channel_layer, channel_id, event)
+
+
+def set_group_shards(channel_id, shards):
+    """
+    Change the shard count of a channel. Every worker drops its cached
+    count and connected sockets move to their shard of the new layout.
+    """
+    from .membership import INVALIDATION_GROUP
+
+    shards = max(1, min(int(shards), MAX_GROUP_SHARDS))
+    previous = _query_shards(channel_id)
+    Channel.objects.filter(id=channel_id).update(group_shards=shards)
+    remember_shards({channel_id: shards})
+    if previous == shards:
+        return shards
+
+    channel_layer = get_channel_layer()
+    if channel_layer is not None:
+        async_to_sync(channel_layer.group_send)(
+            INVALIDATION_GROUP,
+            {'type': 'membership.invalidate', 'shard_channel_ids': [int(channel_id)]}
+        )
+        # Sockets still sit in the old groups
+        async_to_sync(send_to_shards)(channel_layer, channel_id, previous, {
+            'type': 'group.reshard',
+            'channel_id': int(channel_id),
+            'shards': shards,
+        })
+    return shards
@@ -0,0 +1,95 @@
+"""
+Channel-scoped cache of the most recent serialized messages.
+
+One entry per channel, shared by every member; authorization is checked by
+the caller. Entries live under a per-channel generation number, so edits,
+deletes and lost races invalidate with a single ``incr`` instead of trying
+to patch the cached page.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.dateparse import parse_datetime
+
+# One page of history plus one row to know whether older messages exist
+HISTORY_SIZE = getattr(settings, 'CHAT_HISTORY_CACHE_SIZE', 51)
+HISTORY_TIMEOUT = getattr(settings, 'CHAT_HISTORY_CACHE_TIMEOUT', 60 * 5)
+
+
+def _generation_key(channel_id):
+    return f'history_gen_{channel_id}'
+
+
+def _page_key(channel_id, generation):
+    return f'history_{channel_id}_{generation}'
+
+
+def get_generation(channel_id):
+    key = _generation_key(channel_id)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, 1, timeout=None)
+        generation = cache.get(key, 1)
+    return generation
+
+
+def invalidate(channel_id):
+    """Drop the cached page for a channel"""
+    key = _generation_key(channel_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 2, timeout=None)
+
+
+def get_recent(channel_id):
+    """Return (rows, generation); rows is None on a miss"""
+    generation = get_generation(channel_id)
+    return cache.get(_page_key(channel_id, generation)), generation
+
+
+def set_recent(channel_id, generation, rows):
+    # Written under the generation read before the DB query, so a page read
+    # before a concurrent append/invalidate lands on a dead key
+    cache.set(_page_key(channel_id, generation), list(rows[:HISTORY_SIZE]), HISTORY_TIMEOUT)
+
+
+def _sort_key(row):
+    return parse_datetime(row['timestamp']), row['id']
+
+
+def _modify(channel_id, change):
+    """Apply change(rows) to the cached page, or invalidate if that isn't safe"""
+    lock_key = f'history_lock_{channel_id}'
+    if not cache.add(lock_key, 1, timeout=5):
+        # Someone else is modifying the page, invalidating is always safe
+        invalidate(channel_id)
+        return
+
+    try:
+        generation = get_generation(channel_id)
+        key = _page_key(channel_id, generation)
+        cached = cache.get(key)
+        if cached is None:
+            # A reader may be filling this generation from a DB read that
+            # predates this change
+            invalidate(channel_id)
+            return
+        cache.set(key, change(cached)[:HISTORY_SIZE], HISTORY_TIMEOUT)
+    finally:
+        cache.delete(lock_key)
+
+
+def append(channel_id, rows):
+    """Write-through new serialized messages into the cached page"""
+    def merge(cached):
+        known = {row['id'] for row in cached}
+        merged = cached + [row for row in rows if row['id'] not in known]
+        merged.sort(key=_sort_key, reverse=True)
+        return merged
+    _modify(channel_id, merge)
+
+
+def update(channel_id, rows):
+    """Write-through changed serialized messages, e.g. new reply counts"""
+    changed = {row['id']: row for row in rows}
+    _modify(channel_id, lambda cached: [changed.get(row['id'], row) for row in cached])
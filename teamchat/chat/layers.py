@@ -0,0 +1,219 @@
+"""
+Channel layer with in-process fan-out for sockets on the same node.
+
+``RedisChannelLayer`` keeps group members in Redis and pushes a copy of
+every group message into the queue of each member, so a send to a channel
+costs Redis work per connected socket even when they all live in the
+sending process. ``HybridChannelLayer`` keeps the members of each group in
+the process that owns them, delivers to local members in memory and
+publishes the message once on the group's Redis pub/sub channel, which
+Redis hands to every other node with members in the group. Redis work per
+group message is O(nodes) instead of O(members).
+"""
+import asyncio
+import logging
+import time
+import uuid
+import weakref
+from copy import deepcopy
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+logger = logging.getLogger(__name__)
+
+
+class HybridChannelLayer(InMemoryChannelLayer):
+    """
+    Each process is a node whose random id is part of the names of its
+    channels. Sends to a channel of another node are published on that
+    node's pub/sub channel; channels without a node, like ``runworker``
+    channels, are Redis lists shared by every process.
+
+    Group membership lives with the node that owns the channel, so
+    ``group_add``/``group_discard`` only take channels of this node, and a
+    group message is delivered to local members as one shared copy that
+    consumers must not modify. Pub/sub delivery is at most once: a node
+    that is reconnecting to Redis misses what is published meanwhile.
+    """
+
+    def __init__(self, hosts=None, prefix='chat', expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, **kwargs):
+        super().__init__(
+            expiry=expiry, group_expiry=group_expiry, capacity=capacity, **kwargs
+        )
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.url = self._url((hosts or ['redis://127.0.0.1:6379/0'])[0])
+        self.prefix = prefix
+        self.node = uuid.uuid4().hex[:12]
+        self._clients = weakref.WeakKeyDictionary()
+        self._pubsub = None
+        self._reader = None
+        self._cleaned = 0
+        # Messages dropped for full channels, reported with chat.outbound.stats
+        self.dropped = 0
+
+    @staticmethod
+    def _url(host):
+        if isinstance(host, str):
+            return host
+        if isinstance(host, dict):
+            return host['address']
+        return f'redis://{host[0]}:{host[1]}/0'
+
+    def _client(self):
+        # Sync code reaches the layer through async_to_sync on throwaway
+        # event loops, and redis connections belong to the loop they were
+        # opened on
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            import redis.asyncio
+            client = self._clients[loop] = redis.asyncio.Redis.from_url(self.url)
+        return client
+
+    def _node_key(self, node):
+        return f'{self.prefix}:node:{node}'
+
+    def _group_key(self, group):
+        return f'{self.prefix}:group:{group}'
+
+    def _queue_key(self, channel):
+        return f'{self.prefix}:queue:{channel}'
+
+    @staticmethod
+    def _node_of(channel):
+        head, bang, _ = channel.partition('!')
+        return head.rsplit('.', 1)[-1] if bang else None
+
+    def _pack(self, message, group=None, channel=None):
+        return msgpack.packb(
+            {'node': self.node, 'group': group, 'channel': channel, 'message': message},
+            use_bin_type=True,
+        )
+
+    # Local delivery
+
+    def _put(self, channel, message):
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait((time.time() + self.expiry, message))
+
+    def _deliver(self, group, message):
+        for channel in list(self.groups.get(group, ())):
+            try:
+                self._put(channel, message)
+            except ChannelFull:
+                self.dropped += 1
+
+    def _clean_expired(self):
+        # Walks every queue and group; once a second is plenty
+        now = time.monotonic()
+        if now - self._cleaned >= 1:
+            self._cleaned = now
+            super()._clean_expired()
+
+    # Pub/sub
+
+    async def _ensure_subscriber(self):
+        if self._pubsub is None:
+            self._pubsub = self._client().pubsub(ignore_subscribe_messages=True)
+            await self._pubsub.subscribe(self._node_key(self.node))
+            self._reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        while True:
+            try:
+                received = await self._pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # redis-py reconnects and resubscribes on the next read
+                logger.warning('Channel layer lost its pub/sub connection', exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            if received is not None:
+                self._dispatch(received['data'])
+
+    def _dispatch(self, data):
+        payload = msgpack.unpackb(data, raw=False)
+        if payload['node'] == self.node:
+            return
+        if payload['group'] is not None:
+            self._deliver(payload['group'], payload['message'])
+        else:
+            try:
+                self._put(payload['channel'], payload['message'])
+            except ChannelFull:
+                self.dropped += 1
+                logger.warning('Dropped a message for full channel %s', payload['channel'])
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        node = self._node_of(channel)
+        if node == self.node:
+            self._put(channel, deepcopy(message))
+        elif node is not None:
+            await self._client().publish(self._node_key(node), self._pack(message, channel=channel))
+        else:
+            client = self._client()
+            key = self._queue_key(channel)
+            if await client.llen(key) >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            async with client.pipeline(transaction=True) as pipe:
+                pipe.rpush(key, self._pack(message, channel=channel))
+                pipe.expire(key, self.expiry)
+                await pipe.execute()
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        if self._node_of(channel) is not None:
+            await self._ensure_subscriber()
+            return await super().receive(channel)
+        while True:
+            item = await self._client().blpop([self._queue_key(channel)], timeout=5)
+            if item is not None:
+                return msgpack.unpackb(item[1], raw=False)['message']
+
+    async def new_channel(self, prefix='specific.'):
+        await self._ensure_subscriber()
+        return f'{prefix}{self.node}!{uuid.uuid4().hex}'
+
+    async def group_add(self, group, channel):
+        if self._node_of(channel) != self.node:
+            raise ValueError(f'{channel} does not belong to this process')
+        first = not self.groups.get(group)
+        await super().group_add(group, channel)
+        if first:
+            await self._ensure_subscriber()
+            await self._pubsub.subscribe(self._group_key(group))
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        if group not in self.groups and self._pubsub is not None:
+            await self._pubsub.unsubscribe(self._group_key(group))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        self._clean_expired()
+        self._deliver(group, deepcopy(message))
+        await self._client().publish(self._group_key(group), self._pack(message, group=group))
+
+    async def flush(self):
+        await super().flush()
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe()
+            await self._pubsub.subscribe(self._node_key(self.node))
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        self._pubsub = self._reader = None
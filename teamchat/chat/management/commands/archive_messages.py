@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, archive_messages
+
+
+class Command(BaseCommand):
+    help = 'Move old messages into compressed monthly archives'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                            help='Archive threads quiet for longer than this')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                            help='Threads moved per transaction')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        archived = archive_messages(before, options['batch_size'])
+        self.stdout.write(f'Archived {archived} threads older than {before:%Y-%m-%d}')
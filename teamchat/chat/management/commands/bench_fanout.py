@@ -0,0 +1,80 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.consumers import ChatConsumer
+from chat.encoding import frame_event, orjson
+
+
+def legacy_chat_message(event):
+    # What ChatConsumer.chat_message did per member before frames were pre-encoded
+    return json.dumps({
+        'type': 'chat',
+        'message': event['message'],
+        'user_id': event['user_id'],
+        'username': event['username'],
+        'timestamp': event['timestamp'],
+        'message_id': event['message_id'],
+        'provisional': event.get('provisional', False)
+    })
+
+
+class Command(BaseCommand):
+    help = 'Measure fan-out CPU per message against group size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,100,1000,10000')
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--length', type=int, default=200,
+                            help='Characters per message body')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        results = [
+            asyncio.run(self.measure(size, options['messages'], options['length']))
+            for size in sizes
+        ]
+        self.stdout.write(json.dumps({
+            'encoder': 'orjson' if orjson else 'json',
+            'results': results,
+        }, indent=2))
+
+    async def measure(self, group_size, messages, length):
+        sent = []
+        consumer = ChatConsumer()
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            sent.append(text_data)
+        consumer.send = send
+
+        payload = {
+            'type': 'chat',
+            'message': 'x' * length,
+            'user_id': 1,
+            'username': 'bench',
+            'timestamp': '2025-06-06 20:35:25.527454+00:00',
+            'message_id': 1,
+            'provisional': False
+        }
+
+        start = time.process_time()
+        for _ in range(messages):
+            for _ in range(group_size):
+                sent.append(legacy_chat_message(payload))
+        legacy = time.process_time() - start
+        sent.clear()
+
+        start = time.process_time()
+        for _ in range(messages):
+            event = frame_event('chat_message', payload)
+            for _ in range(group_size):
+                await consumer.chat_message(event)
+        encoded = time.process_time() - start
+
+        return {
+            'group_size': group_size,
+            'legacy_us_per_message': round(legacy / messages * 1e6, 2),
+            'pre_encoded_us_per_message': round(encoded / messages * 1e6, 2),
+        }
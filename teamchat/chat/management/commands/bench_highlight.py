@@ -0,0 +1,135 @@
+import json
+import random
+import re
+import statistics
+import string
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.highlight import Highlighter
+
+COMMON_WORDS = ['deploy', 'django', 'meeting', 'release', 'review', 'standup', 'budget', 'incident']
+
+
+def per_term_highlight(content, query):
+    """The previous highlighter: one lowercase scan of the content per term and match"""
+    highlighted = []
+    for term in query.lower().split():
+        start = 0
+        while True:
+            idx = content.lower().find(term, start)
+            if idx == -1:
+                break
+            end = idx + len(term)
+            highlighted.append((idx, end))
+            start = end
+
+    highlighted.sort()
+    merged = []
+    for start, end in highlighted:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    result = []
+    last_pos = 0
+    for start, end in merged:
+        if last_pos < start:
+            result.append(content[last_pos:start])
+        result.append(f'<mark>{content[start:end]}</mark>')
+        last_pos = end
+    if last_pos < len(content):
+        result.append(content[last_pos:])
+    return [''.join(result)]
+
+
+class AlternationHighlighter(Highlighter):
+    """Highlighter matching all terms in one pass of a compiled alternation"""
+
+    def __init__(self, query, **kwargs):
+        super().__init__(query, **kwargs)
+        self.lowered_pattern = re.compile(
+            '|'.join(re.escape(term) for term in sorted(self.terms, key=len, reverse=True))
+        )
+
+    def _find(self, content):
+        lowered = content.lower()
+        if len(lowered) != len(content):
+            return super()._find(content)
+        return [match.span() for match in self.lowered_pattern.finditer(lowered)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the previous per-term highlighter, Highlighter and a single-pass '
+        'alternation on long messages'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--length', type=int, default=2000,
+                            help='Characters per message')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--query', action='append', dest='queries',
+                            help='Query to time, may be given more than once')
+
+    def handle(self, *args, **options):
+        messages = self.generate(options['messages'], options['length'])
+        queries = options['queries'] or [
+            'deploy',
+            'deploy review budget',
+            ' '.join(COMMON_WORDS),
+        ]
+        engines = {
+            'per_term': lambda query: [per_term_highlight(content, query) for content in messages],
+            'highlighter': lambda query: [
+                highlighter.highlight(content)
+                for highlighter in [Highlighter(query)] for content in messages
+            ],
+            'alternation': lambda query: [
+                highlighter.highlight(content)
+                for highlighter in [AlternationHighlighter(query)] for content in messages
+            ],
+        }
+
+        results = []
+        for query in queries:
+            for name, highlight in engines.items():
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    highlight(query)
+                    timings.append(time.perf_counter() - start)
+                median = statistics.median(timings)
+                results.append({
+                    'engine': name,
+                    'query': query,
+                    'terms': len(query.split()),
+                    'median_ms': round(median * 1000, 3),
+                    'us_per_message': round(median * 1_000_000 / len(messages), 2),
+                })
+
+        self.stdout.write(json.dumps({
+            'messages': len(messages),
+            'length': options['length'],
+            'results': results,
+        }, indent=2))
+
+    def generate(self, total, length):
+        rng = random.Random(42)
+        vocabulary = [
+            ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+            for _ in range(2000)
+        ]
+        messages = []
+        for _ in range(total):
+            words = []
+            size = 0
+            while size < length:
+                word = rng.choice(COMMON_WORDS).capitalize() if rng.random() < 0.05 else rng.choice(vocabulary)
+                words.append(word)
+                size += len(word) + 1
+            messages.append(' '.join(words)[:length])
+        return messages
@@ -0,0 +1,96 @@
+import json
+import random
+import statistics
+import string
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.management.databases import throwaway_database
+from chat.models import Channel, Message, User
+from chat.search import ContainsSearchBackend, get_search_backend
+
+BENCH_CHANNEL = '__bench_search__'
+COMMON_WORDS = ['deploy', 'django', 'meeting', 'release', 'review', 'standup', 'budget', 'incident']
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare icontains search with the full-text search backend on a channel '
+        'seeded in a throwaway test database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--chunk-size', type=int, default=10_000)
+        parser.add_argument('--query', action='append', dest='queries',
+                            help='Query to time, may be given more than once')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the test database and its seeded channel for later runs')
+
+    def handle(self, *args, **options):
+        # Dropping the whole database is cheaper than deleting a million
+        # rows through the per-row post_delete receivers
+        with throwaway_database(keep=options['keep'], verbosity=options['verbosity'] - 1):
+            self.run(options)
+
+    def run(self, options):
+        channel = self.seed(options['messages'], options['chunk_size'])
+        queries = options['queries'] or ['django', 'deploy review', '"release budget"', 'zzzz']
+        queryset = Message.objects.filter(channel=channel)
+        engines = {
+            'icontains': ContainsSearchBackend(),
+            type(get_search_backend()).__name__: get_search_backend(),
+        }
+
+        results = []
+        for query in queries:
+            for name, backend in engines.items():
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    page = list(backend.search(queryset, query).order_by('-timestamp', '-id')[:20])
+                    timings.append((time.perf_counter() - start) * 1000)
+                results.append({
+                    'engine': name,
+                    'query': query,
+                    'hits': len(page),
+                    'median_ms': round(statistics.median(timings), 3),
+                    'max_ms': round(max(timings), 3),
+                })
+
+        self.stdout.write(json.dumps({
+            'messages': queryset.count(),
+            'results': results,
+        }, indent=2))
+
+    def seed(self, total, chunk_size):
+        user, _ = User.objects.get_or_create(username='__bench__')
+        channel, _ = Channel.objects.get_or_create(
+            name=BENCH_CHANNEL, team=None,
+            defaults={'channel_type': 'public', 'created_by': user}
+        )
+        existing = Message.objects.filter(channel=channel).count()
+
+        rng = random.Random(42)
+        vocabulary = COMMON_WORDS + [
+            ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+            for _ in range(5000)
+        ]
+        # Rough Zipf distribution so common words have realistic hit rates
+        weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+
+        created = existing
+        while created < total:
+            size = min(chunk_size, total - created)
+            Message.objects.bulk_create([
+                Message(
+                    channel=channel,
+                    sender=user,
+                    content=' '.join(rng.choices(vocabulary, weights, k=rng.randint(4, 30)))
+                )
+                for _ in range(size)
+            ])
+            created += size
+        return channel
@@ -0,0 +1,88 @@
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.management.databases import throwaway_database
+from chat.models import Channel, Message, User
+from chat.serializers import FastMessageSerializer, MessageSerializer
+
+BENCH_CHANNEL = '__bench_serializer__'
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare MessageSerializer with FastMessageSerializer on pages of a channel '
+        'seeded in a throwaway test database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10_000)
+        parser.add_argument('--page-size', type=int, action='append', dest='page_sizes',
+                            help='Page size to time, may be given more than once')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the test database and its seeded channel for later runs')
+
+    def handle(self, *args, **options):
+        with throwaway_database(keep=options['keep'], verbosity=options['verbosity'] - 1):
+            self.run(options)
+
+    def run(self, options):
+        channel = self.seed(options['messages'])
+        queryset = Message.objects.filter(channel=channel).order_by('-timestamp', '-id')
+        serializers = {
+            'MessageSerializer': lambda page: MessageSerializer(
+                queryset.select_related('sender')[:page], many=True
+            ).data,
+            'FastMessageSerializer': lambda page: FastMessageSerializer(
+                FastMessageSerializer.values(queryset)[:page]
+            ).data,
+        }
+
+        results = []
+        for page in options['page_sizes'] or [50, 500, options['messages']]:
+            outputs = {}
+            for name, serialize in serializers.items():
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    outputs[name] = serialize(page)
+                    timings.append(time.perf_counter() - start)
+                median = statistics.median(timings)
+                results.append({
+                    'serializer': name,
+                    'page_size': len(outputs[name]),
+                    'median_ms': round(median * 1000, 3),
+                    'us_per_message': round(median * 1_000_000 / max(len(outputs[name]), 1), 2),
+                })
+            if json.dumps(outputs['MessageSerializer']) != json.dumps(outputs['FastMessageSerializer']):
+                self.stderr.write(f'Outputs differ for page size {page}')
+
+        self.stdout.write(json.dumps({
+            'messages': queryset.count(),
+            'results': results,
+        }, indent=2))
+
+    def seed(self, total):
+        users = [
+            User.objects.get_or_create(username=f'__bench_{index}__')[0] for index in range(10)
+        ]
+        channel, _ = Channel.objects.get_or_create(
+            name=BENCH_CHANNEL, team=None,
+            defaults={'channel_type': 'public', 'created_by': users[0]}
+        )
+        existing = Message.objects.filter(channel=channel).count()
+
+        rng = random.Random(42)
+        Message.objects.bulk_create([
+            Message(
+                channel=channel,
+                sender=rng.choice(users),
+                content=f'Benchmark message {index} ' + 'lorem ipsum ' * rng.randint(1, 20),
+            )
+            for index in range(existing, total)
+        ], batch_size=1000)
+        return channel
@@ -0,0 +1,33 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import Channel
+from chat.transfer import EXPORT_CHUNK_SIZE, TransferStats, export_chunks
+
+
+class Command(BaseCommand):
+    help = "Write a channel's history as NDJSON, oldest message first"
+
+    def add_arguments(self, parser):
+        parser.add_argument('channel_id', type=int)
+        parser.add_argument('--output', help='File to write, stdout by default')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if not Channel.objects.filter(id=options['channel_id']).exists():
+            raise CommandError(f"Channel {options['channel_id']} does not exist")
+
+        stats = TransferStats()
+        chunks = export_chunks(options['channel_id'], options['chunk_size'], stats)
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+        # Stats go to stderr so stdout stays pure NDJSON
+        self.stderr.write(json.dumps(stats.as_dict()))
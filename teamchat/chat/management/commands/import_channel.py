@@ -0,0 +1,40 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import Channel
+from chat.transfer import IMPORT_CHUNK_SIZE, SenderMap, TransferStats, import_lines
+
+
+class Command(BaseCommand):
+    help = 'Load NDJSON history, e.g. from export_channel or another chat system, into a channel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('channel_id', type=int)
+        parser.add_argument('input', help="NDJSON file, '-' for stdin")
+        parser.add_argument('--sender-map',
+                            help='JSON file mapping sender ids of the file to local user ids')
+        parser.add_argument('--match-usernames', action='store_true',
+                            help='Map unmapped senders to the local user with the same username')
+        parser.add_argument('--default-sender', type=int,
+                            help='Local user id for senders that stay unmapped, skipped otherwise')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        if not Channel.objects.filter(id=options['channel_id']).exists():
+            raise CommandError(f"Channel {options['channel_id']} does not exist")
+
+        mapping = None
+        if options['sender_map']:
+            with open(options['sender_map']) as sender_map:
+                mapping = json.load(sender_map)
+        senders = SenderMap(mapping, options['match_usernames'], options['default_sender'])
+
+        stats = TransferStats()
+        if options['input'] == '-':
+            import_lines(options['channel_id'], sys.stdin, senders, options['chunk_size'], stats)
+        else:
+            with open(options['input'], encoding='utf-8') as lines:
+                import_lines(options['channel_id'], lines, senders, options['chunk_size'], stats)
+        self.stdout.write(json.dumps(stats.as_dict()))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.groups import MAX_GROUP_SHARDS, set_group_shards
+from chat.models import Channel
+
+
+class Command(BaseCommand):
+    help = "Spread a channel's sockets over several channel-layer groups"
+
+    def add_arguments(self, parser):
+        parser.add_argument('channel_id', type=int)
+        parser.add_argument('shards', type=int,
+                            help=f'Number of groups, 1 to {MAX_GROUP_SHARDS}; 1 turns sharding off')
+
+    def handle(self, *args, **options):
+        if not Channel.objects.filter(id=options['channel_id']).exists():
+            raise CommandError(f"Channel {options['channel_id']} does not exist")
+        if not 1 <= options['shards'] <= MAX_GROUP_SHARDS:
+            raise CommandError(f'shards must be between 1 and {MAX_GROUP_SHARDS}')
+        shards = set_group_shards(options['channel_id'], options['shards'])
+        self.stdout.write(f"Channel {options['channel_id']} now fans out over {shards} groups")
@@ -0,0 +1,23 @@
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+@contextmanager
+def throwaway_database(keep=False, verbosity=0):
+    """
+    Run the block against a fresh test database of the configured engine,
+    created and migrated the way the test runner does it, so benchmarks
+    never seed the real one. With ``keep`` the database and its rows are
+    reused by the next run (on SQLite that needs a file, see
+    ``DATABASES['default']['TEST']['NAME']``).
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(
+        verbosity=verbosity, autoclobber=True, serialize=False, keepdb=keep
+    )
+    try:
+        yield connection.settings_dict['NAME']
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity, keepdb=keep)
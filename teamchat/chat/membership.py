@@ -0,0 +1,357 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from . import groups
+from .encoding import frame_event
+from .middleware import user_cache
+from .models import Channel, Team, User
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_GROUP = 'chat_membership_invalidation'
+BULK_CHUNK_SIZE = getattr(settings, 'CHAT_MEMBERSHIP_BULK_CHUNK_SIZE', 1000)
+
+
+class MembershipCache:
+    """
+    Bounded TTL/LRU cache of (channel_id, user_id) -> is_member.
+
+    Both positive and negative answers are cached, along with full member
+    lists of channels that messages were recently sent to. Entries are
+    dropped through ``invalidate`` whenever ``Channel.members`` changes, the
+    TTL only bounds how long a missed invalidation can linger.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._members = OrderedDict()
+        # Signal handlers run in worker threads, lookups on the event loop
+        self._lock = threading.Lock()
+
+    def get(self, channel_id, user_id):
+        key = (int(channel_id), int(user_id))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, channel_id, user_id, value):
+        key = (int(channel_id), int(user_id))
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_members(self, channel_id):
+        channel_id = int(channel_id)
+        with self._lock:
+            entry = self._members.get(channel_id)
+            if entry is None:
+                return None
+            members, expires = entry
+            if expires < time.monotonic():
+                del self._members[channel_id]
+                return None
+            self._members.move_to_end(channel_id)
+            return members
+
+    def set_members(self, channel_id, members):
+        channel_id = int(channel_id)
+        with self._lock:
+            self._members[channel_id] = (frozenset(members), time.monotonic() + self.ttl)
+            self._members.move_to_end(channel_id)
+            # Member lists are far bigger than single answers, keep fewer
+            while len(self._members) > max(1, self.maxsize // 100):
+                self._members.popitem(last=False)
+
+    def invalidate(self, pairs=(), channel_ids=(), user_ids=()):
+        channel_ids = {int(c) for c in channel_ids}
+        user_ids = {int(u) for u in user_ids}
+        with self._lock:
+            for channel_id, user_id in pairs:
+                self._entries.pop((int(channel_id), int(user_id)), None)
+                self._members.pop(int(channel_id), None)
+            for channel_id in channel_ids:
+                self._members.pop(channel_id, None)
+            if user_ids:
+                self._members.clear()
+            if channel_ids or user_ids:
+                stale = [
+                    key for key in self._entries
+                    if key[0] in channel_ids or key[1] in user_ids
+                ]
+                for key in stale:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._members.clear()
+
+
+membership_cache = MembershipCache(
+    maxsize=getattr(settings, 'CHAT_MEMBERSHIP_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CHAT_MEMBERSHIP_CACHE_TTL', 300),
+)
+
+
+def _query_membership(channel_id, user_id):
+    return Channel.members.through.objects.filter(
+        channel_id=channel_id,
+        user_id=user_id
+    ).exists()
+
+
+async def is_member(channel_id, user_id):
+    """Check channel membership, hitting the database only on a cache miss"""
+    cached = membership_cache.get(channel_id, user_id)
+    if cached is not None:
+        return cached
+    result = await database_sync_to_async(_query_membership)(channel_id, user_id)
+    membership_cache.set(channel_id, user_id, result)
+    return result
+
+
+def is_member_sync(channel_id, user_id):
+    """
+    Check channel membership for views and other sync code.
+
+    Always asks the database: only processes serving sockets run the
+    invalidation listener, so the cache of an HTTP-only worker would keep
+    removed members in (and new members out) until the TTL.
+    """
+    return _query_membership(channel_id, user_id)
+
+
+def _query_member_ids(channel_id):
+    return list(
+        Channel.members.through.objects.filter(channel_id=channel_id).values_list('user_id', flat=True)
+    )
+
+
+async def channel_member_ids(channel_id):
+    """Return the ids of every member of a channel, cached like ``is_member``"""
+    cached = membership_cache.get_members(channel_id)
+    if cached is not None:
+        return cached
+    members = frozenset(await database_sync_to_async(_query_member_ids)(channel_id))
+    membership_cache.set_members(channel_id, members)
+    return members
+
+
+_listeners = weakref.WeakKeyDictionary()
+
+
+async def ensure_invalidation_listener():
+    """
+    Subscribe this process to membership invalidations from other workers.
+
+    One listener runs per event loop, no matter how many sockets are open.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    loop = asyncio.get_running_loop()
+    if loop in _listeners:
+        return
+    # Claimed up front so concurrent connects don't start a second listener
+    _listeners[loop] = None
+    try:
+        name = await channel_layer.new_channel()
+        await channel_layer.group_add(INVALIDATION_GROUP, name)
+    except BaseException:
+        # Let the next connect try again instead of serving stale answers
+        del _listeners[loop]
+        raise
+    _listeners[loop] = asyncio.ensure_future(_listen(channel_layer, name))
+
+
+async def _listen(channel_layer, name):
+    # Without the listener this process would serve stale membership until
+    # the cache TTL, so it outlives any error
+    while True:
+        try:
+            await _receive_invalidations(channel_layer, name)
+        except Exception:
+            logger.exception('Membership invalidation listener failed, restarting')
+            await asyncio.sleep(1)
+            # Invalidations may have been missed meanwhile
+            membership_cache.clear()
+            try:
+                await channel_layer.group_add(INVALIDATION_GROUP, name)
+            except Exception:
+                logger.warning('Could not rejoin %s', INVALIDATION_GROUP, exc_info=True)
+
+
+async def _receive_invalidations(channel_layer, name):
+    # Re-join well within channels_redis' default group expiry
+    refresh = getattr(channel_layer, 'group_expiry', 86400) / 2
+    while True:
+        try:
+            message = await asyncio.wait_for(channel_layer.receive(name), refresh)
+        except asyncio.TimeoutError:
+            await channel_layer.group_add(INVALIDATION_GROUP, name)
+            continue
+        membership_cache.invalidate(
+            pairs=message.get('pairs', ()),
+            channel_ids=message.get('channel_ids', ()),
+            user_ids=message.get('user_ids', ()),
+        )
+        if message.get('auth_user_ids'):
+            user_cache.invalidate(message['auth_user_ids'])
+        if message.get('shard_channel_ids'):
+            groups.forget_shards(message['shard_channel_ids'])
+
+
+def _chunks(ids, size=None):
+    ids = list(ids)
+    size = size or BULK_CHUNK_SIZE
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _bulk_add(through, owner_field, owner_id, user_ids):
+    """Insert missing (owner, user) rows in chunks and return the added user ids"""
+    added = []
+    for chunk in _chunks({int(user_id) for user_id in user_ids}):
+        existing = set(
+            through.objects.filter(**{owner_field: owner_id, 'user_id__in': chunk})
+            .values_list('user_id', flat=True)
+        )
+        new = set(User.objects.filter(id__in=chunk).values_list('id', flat=True)) - existing
+        through.objects.bulk_create(
+            [through(**{owner_field: owner_id, 'user_id': user_id}) for user_id in new],
+            ignore_conflicts=True,
+        )
+        added.extend(new)
+    return added
+
+
+def _bulk_remove(through, owner_field, owner_id, user_ids):
+    removed = []
+    for chunk in _chunks({int(user_id) for user_id in user_ids}):
+        rows = through.objects.filter(**{owner_field: owner_id, 'user_id__in': chunk})
+        gone = list(rows.values_list('user_id', flat=True))
+        if gone:
+            rows.delete()
+            removed.extend(gone)
+    return removed
+
+
+def _current_member_ids(through, owner_field, owner_id):
+    return set(through.objects.filter(**{owner_field: owner_id}).values_list('user_id', flat=True))
+
+
+def publish_membership_change(channel_id, added=(), removed=()):
+    """
+    Invalidate cached membership of a channel here and on every worker, and
+    tell its sockets who joined and left in one ``members_changed`` event.
+
+    Sent once the surrounding transaction commits.
+    """
+    channel_id = int(channel_id)
+    added, removed = sorted(added), sorted(removed)
+    membership_cache.invalidate(channel_ids=[channel_id])
+
+    def publish():
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        async_to_sync(channel_layer.group_send)(
+            INVALIDATION_GROUP,
+            {'type': 'membership.invalidate', 'channel_ids': [channel_id]}
+        )
+        if added or removed:
+            groups.group_send_sync(channel_layer, channel_id, frame_event('members_changed', {
+                'type': 'members_changed',
+                'channel_id': channel_id,
+                'added': added,
+                'removed': removed,
+            }, channel_id=channel_id, removed=removed))
+
+    transaction.on_commit(publish)
+
+
+def add_channel_members(channel_id, user_ids):
+    """Add users by id without loading them; returns the ids actually added"""
+    with transaction.atomic():
+        added = _bulk_add(Channel.members.through, 'channel_id', channel_id, user_ids)
+        if added:
+            publish_membership_change(channel_id, added=added)
+    return added
+
+
+def remove_channel_members(channel_id, user_ids):
+    with transaction.atomic():
+        removed = _bulk_remove(Channel.members.through, 'channel_id', channel_id, user_ids)
+        if removed:
+            publish_membership_change(channel_id, removed=removed)
+    return removed
+
+
+def sync_channel_members(channel_id, user_ids):
+    """Make the member list exactly ``user_ids``; returns (added, removed)"""
+    through = Channel.members.through
+    wanted = {int(user_id) for user_id in user_ids}
+    with transaction.atomic():
+        current = _current_member_ids(through, 'channel_id', channel_id)
+        added = _bulk_add(through, 'channel_id', channel_id, wanted - current)
+        removed = _bulk_remove(through, 'channel_id', channel_id, current - wanted)
+        if added or removed:
+            publish_membership_change(channel_id, added=added, removed=removed)
+    return added, removed
+
+
+def _propagate_to_channels(team_id, added):
+    if not added:
+        return
+    from .tasks import propagate_team_members
+    transaction.on_commit(lambda: propagate_team_members.delay(team_id, added))
+
+
+def add_team_members(team_id, user_ids, propagate=True):
+    """
+    Add users to a team by id. New members are added to the team's public
+    channels by the ``propagate_team_members`` task.
+    """
+    with transaction.atomic():
+        added = _bulk_add(Team.members.through, 'team_id', team_id, user_ids)
+        if propagate:
+            _propagate_to_channels(team_id, added)
+    return added
+
+
+def remove_team_members(team_id, user_ids):
+    with transaction.atomic():
+        return _bulk_remove(Team.members.through, 'team_id', team_id, user_ids)
+
+
+def sync_team_members(team_id, user_ids, propagate=True):
+    through = Team.members.through
+    wanted = {int(user_id) for user_id in user_ids}
+    with transaction.atomic():
+        current = _current_member_ids(through, 'team_id', team_id)
+        added = _bulk_add(through, 'team_id', team_id, wanted - current)
+        removed = _bulk_remove(through, 'team_id', team_id, current - wanted)
+        if propagate:
+            _propagate_to_channels(team_id, added)
+    return added, removed
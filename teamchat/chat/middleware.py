@@ -1,27 +1,177 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
 from channels.db import database_sync_to_async
 
+logger = logging.getLogger(__name__)
+
+# Browsers can't set headers on a WebSocket, so they send
+# ``new WebSocket(url, ['bearer', token])`` and the server picks 'bearer'
+TOKEN_SUBPROTOCOL = 'bearer'
+USER_CACHE_TIMEOUT = getattr(settings, 'CHAT_AUTH_USER_CACHE_TIMEOUT', 300)
+# All sockets need of a user; the password hash never goes into a cache
+USER_CACHE_FIELDS = ('id', 'username', 'is_active', 'avatar')
+
+
+class UserCache:
+    """
+    In-process TTL/LRU cache of users resolved from tokens, in front of the
+    shared Django cache. Entries are dropped by ``invalidate`` when a user
+    is saved or deleted; the short TTL bounds how long another worker can
+    keep a stale copy.
+    """
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return user
+
+    def set(self, user_id, user):
+        with self._lock:
+            self._entries[user_id] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache(
+    maxsize=getattr(settings, 'CHAT_AUTH_USER_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CHAT_AUTH_USER_CACHE_TTL', 30),
+)
+
+
+def _shared_key(user_id):
+    return f'auth_user_fields_{user_id}'
+
+
+def invalidate_user(user_id):
+    """Forget a cached user here and in the shared cache"""
+    user_cache.invalidate([user_id])
+    cache.delete(_shared_key(user_id))
+
+
+def _load_user(user_id):
+    """An unsaved user holding only ``USER_CACHE_FIELDS``, or None"""
+    User = get_user_model()
+    fields = cache.get(_shared_key(user_id))
+    if fields is None:
+        fields = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).values(*USER_CACHE_FIELDS).first()
+        if fields is None:
+            return None
+        cache.set(_shared_key(user_id), fields, USER_CACHE_TIMEOUT)
+    return User(**fields)
+
+
+def _load_password(user_id):
+    User = get_user_model()
+    return User.objects.filter(pk=user_id).values_list('password', flat=True).first()
+
+
+def get_token(scope):
+    """Return (token, subprotocol) from the header, subprotocol or query string"""
+    headers = dict(scope['headers'])
+    auth_header = headers.get(b'authorization', b'').decode()
+    if auth_header.startswith('Bearer '):
+        return auth_header.split()[1], None
+
+    subprotocols = scope.get('subprotocols') or []
+    if TOKEN_SUBPROTOCOL in subprotocols:
+        index = subprotocols.index(TOKEN_SUBPROTOCOL)
+        if index + 1 < len(subprotocols):
+            return subprotocols[index + 1], TOKEN_SUBPROTOCOL
+
+    tokens = parse_qs(scope.get('query_string', b'').decode()).get('token')
+    if tokens:
+        return tokens[0], None
+    return None, None
+
+
 class JWTAuthMiddleware:
+    """
+    Authenticates WebSocket handshakes with a simplejwt access token.
+
+    Signatures are verified on the event loop (no database involved) and
+    users come from ``user_cache`` or the shared cache, so a warm handshake
+    runs no queries.
+    """
+
     def __init__(self, app):
         self.app = app
+        self.jwt_auth = JWTAuthentication()
+        # The blacklist app checks tokens against the database
+        self.validate_in_thread = 'rest_framework_simplejwt.token_blacklist' in settings.INSTALLED_APPS
 
     async def __call__(self, scope, receive, send):
-        headers = dict(scope['headers'])
-        auth_header = headers.get(b'authorization', b'').decode()
-        
-        if auth_header.startswith('Bearer '):
-            token = auth_header.split()[1]
-            jwt_auth = JWTAuthentication()
-            
+        token, subprotocol = get_token(scope)
+        scope['user'] = AnonymousUser()
+
+        if token:
             try:
-                validated_token = await database_sync_to_async(jwt_auth.get_validated_token)(token)
-                user = await database_sync_to_async(jwt_auth.get_user)(validated_token)
-                scope['user'] = user
+                scope['user'] = await self.authenticate(token)
+                if subprotocol:
+                    scope['auth_subprotocol'] = subprotocol
             except Exception as e:
-                scope['user'] = AnonymousUser()
-                print(f"JWT validation failed: {e}")
+                logger.debug('JWT validation failed: %s', e)
+
+        return await self.app(scope, receive, send)
+
+    async def authenticate(self, token):
+        if self.validate_in_thread:
+            validated_token = await database_sync_to_async(self.jwt_auth.get_validated_token)(token)
         else:
-            scope['user'] = AnonymousUser()
+            validated_token = self.jwt_auth.get_validated_token(token)
+
+        user_id = str(validated_token[api_settings.USER_ID_CLAIM])
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await database_sync_to_async(_load_user)(user_id)
+            if user is None:
+                raise ValueError('User not found')
+            user_cache.set(user_id, user)
+        password = None
+        if getattr(api_settings, 'CHECK_REVOKE_TOKEN', False):
+            # Cached users carry no password hash, revocation asks the database
+            password = await database_sync_to_async(_load_password)(user.pk)
+        self.check_user(user, validated_token, password)
+        return user
 
-        return await self.app(scope, receive, send)
\ No newline at end of file
+    @staticmethod
+    def check_user(user, validated_token, password=None):
+        """The same checks as ``JWTAuthentication.get_user``"""
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise ValueError('User is inactive')
+        if getattr(api_settings, 'CHECK_REVOKE_TOKEN', False):
+            from rest_framework_simplejwt.utils import get_md5_hash_password
+            if password is None or validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(password):
+                raise ValueError("The user's password has been changed")
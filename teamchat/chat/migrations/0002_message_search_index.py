@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from chat.search import install_search_index
+    install_search_index(schema_editor.connection.alias)
+
+
+def uninstall(apps, schema_editor):
+    from chat.search import uninstall_search_index
+    uninstall_search_index(schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
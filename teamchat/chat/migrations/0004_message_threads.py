@@ -0,0 +1,41 @@
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def count_existing_replies(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    threads = (
+        Message.objects.filter(parent__isnull=False)
+        .order_by()
+        .values('parent_id')
+        .annotate(replies=Count('id'), last=Max('timestamp'))
+    )
+    for thread in threads.iterator():
+        Message.objects.filter(id=thread['parent_id']).update(
+            reply_count=thread['replies'], last_reply_at=thread['last']
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_userchannellastseen_last_read_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='last_reply_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['parent', 'timestamp'], name='message_thread_idx'),
+        ),
+        migrations.RunPython(count_existing_replies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def number_existing_messages(apps, schema_editor):
+    Channel = apps.get_model('chat', 'Channel')
+    Message = apps.get_model('chat', 'Message')
+    for channel_id in Channel.objects.values_list('id', flat=True).iterator():
+        messages = []
+        for seq, message_id in enumerate(
+            Message.objects.filter(channel_id=channel_id)
+            .order_by('timestamp', 'id')
+            .values_list('id', flat=True)
+            .iterator(),
+            start=1,
+        ):
+            messages.append(Message(id=message_id, seq=seq))
+        Message.objects.bulk_update(messages, ['seq'], batch_size=1000)
+        Channel.objects.filter(id=channel_id).update(last_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('channel', 'seq'), name='message_channel_seq_uniq'),
+        ),
+        migrations.CreateModel(
+            name='MessageTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.BigIntegerField()),
+                ('parent_id', models.BigIntegerField(blank=True, null=True)),
+                ('seq', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tombstones', to='chat.channel')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='messagetombstone',
+            constraint=models.UniqueConstraint(fields=('channel', 'seq'), name='tombstone_channel_seq_uniq'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_alter_message_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='group_shards',
+            field=models.PositiveSmallIntegerField(default=1, editable=False),
+        ),
+    ]
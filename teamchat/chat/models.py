@@ -61,6 +61,11 @@ class Channel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     members = models.ManyToManyField(User, related_name='channels')
     is_active = models.BooleanField(default=True)
+    # Last change sequence number handed out, see chat.sync
+    last_seq = models.BigIntegerField(default=0)
+    # Channel-layer groups the channel's sockets are spread over, changed
+    # with chat.groups.set_group_shards
+    group_shards = models.PositiveSmallIntegerField(default=1, editable=False)
 
     class Meta:
         indexes = [
@@ -78,16 +83,26 @@ class Message(models.Model):
     channel = models.ForeignKey(Channel, on_delete=models.CASCADE,related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE,related_name='messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so imports can bulk_create historic timestamps
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
     parent = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True,related_name='replies')
+    # Denormalized thread summary, maintained by chat.threads
+    reply_count = models.PositiveIntegerField(default=0)
+    last_reply_at = models.DateTimeField(null=True, blank=True)
+    # Channel change sequence number of the last create or edit
+    seq = models.BigIntegerField(null=True, blank=True)
     
     class Meta:
         
+        constraints = [
+            models.UniqueConstraint(fields=['channel', 'seq'], name='message_channel_seq_uniq'),
+        ]
         indexes = [
             models.Index(fields=['channel', '-timestamp']),
             models.Index(fields=['sender', '-timestamp']),
+            models.Index(fields=['parent', 'timestamp'], name='message_thread_idx'),
             models.Index(fields=['content'], name='content_idx', opclasses=['text_pattern_ops']),
         ]
         ordering = ['-timestamp']
@@ -98,11 +113,54 @@ class Message(models.Model):
 
 
 
+class MessageTombstone(models.Model):
+    """A deleted message, kept so clients syncing by seq learn about the delete"""
+
+    channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='tombstones')
+    message_id = models.BigIntegerField()
+    parent_id = models.BigIntegerField(null=True, blank=True)
+    seq = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['channel', 'seq'], name='tombstone_channel_seq_uniq'),
+        ]
+
+    def __str__(self):
+        return f"Message {self.message_id} deleted at seq {self.seq}"
+
+
+class MessageArchive(models.Model):
+    """One channel's archived messages of one month, see chat.archive"""
+
+    channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='archives')
+    month = models.DateField()
+    codec = models.CharField(max_length=10)
+    # Compressed JSON lines of serialized messages, replies included
+    data = models.BinaryField()
+    message_count = models.PositiveIntegerField(default=0)
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('channel', 'month')
+        ordering = ['-month']
+
+    def __str__(self):
+        return f"{self.channel_id} {self.month:%Y-%m} ({self.message_count} messages)"
+
+
 class UserChannelLastSeen(models.Model):
    
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='channel_visits')
     channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='user_visits')
     last_seen = models.DateTimeField(auto_now=True)
+    # Read cursor, written in bulk by chat.unread.flush_read_cursors
+    last_read_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
     
     class Meta:
         unique_together = ('user', 'channel')
@@ -0,0 +1,257 @@
+"""
+Bounded outbound queues for WebSocket connections.
+
+Consumers queue frames here instead of awaiting each ``send``, and one
+writer task per connection sends them. The consumer keeps draining its
+channel layer queue, so a slow client can't fill it until the layer drops
+messages for it, and what waits in the queue is bounded by
+``CHAT_OUTBOUND_HIGH_WATER`` frames and ``CHAT_OUTBOUND_HIGH_WATER_BYTES``:
+
+- presence frames replace a queued frame for the same user, and they and
+  other ephemeral frames (typing) are dropped while the queue is over the
+  mark;
+- any other frame over the mark triggers ``CHAT_OUTBOUND_OVERFLOW``:
+  ``resync`` drops the queue for a single ``resync_required`` frame (the
+  client catches up through the changes endpoint with its last seq),
+  ``disconnect`` closes the socket.
+
+Frames replayed to a reconnecting socket don't count towards the marks, so
+a full replay doesn't push a healthy client into a resync.
+
+The writer has to stop while the client isn't reading for frames to back
+up here. Under uvicorn or hypercorn ``websocket.send`` itself waits for the
+client. Daphne hands every frame to Twisted's transport buffer and returns
+at once, so under Daphne the queue registers itself as the streaming
+producer of the connection's Twisted transport (see
+``ServerSendMiddleware``): Twisted pauses it once the transport holds more
+than its ``bufferSize`` (64 KiB) of bytes the kernel didn't take, and
+resumes it when that buffer has drained; the writer waits in between.
+
+Counters for the process are kept in ``stats``.
+"""
+import asyncio
+import logging
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+HIGH_WATER = getattr(settings, 'CHAT_OUTBOUND_HIGH_WATER', 500)
+HIGH_WATER_BYTES = getattr(settings, 'CHAT_OUTBOUND_HIGH_WATER_BYTES', 1024 * 1024)
+OVERFLOW = getattr(settings, 'CHAT_OUTBOUND_OVERFLOW', 'resync')
+
+# Close code for sockets dropped by the ``disconnect`` policy
+SLOW_CONSUMER_CLOSE_CODE = 4008
+RESYNC = 'resync'
+
+
+class OutboundStats:
+    """Outbound queue counters of this process"""
+
+    def __init__(self):
+        self.connections = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.disconnects = 0
+        # Times a transport buffer filled up and held the writer back
+        self.paused = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+stats = OutboundStats()
+
+
+class ServerSendMiddleware:
+    """
+    Outermost WebSocket middleware: keeps the server's own ``send`` in the
+    scope as ``server_send`` before other middleware wraps it, so
+    ``server_transport`` can find the connection behind it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        return await self.app(dict(scope, server_send=send), receive, send)
+
+
+def server_transport(scope):
+    """
+    The Twisted transport of a Daphne connection, or None under servers
+    whose sends wait for the client anyway.
+    """
+    send = scope.get('server_send')
+    # Daphne passes each connection partial(server.handle_reply, protocol)
+    if isinstance(send, partial) and send.args:
+        transport = getattr(send.args[0], 'transport', None)
+        if hasattr(transport, 'registerProducer'):
+            return transport
+    return None
+
+
+class OutboundQueue:
+    """
+    Frames waiting for one connection. ``write`` sends a frame, ``resync_frame``
+    builds the frame that replaces the queue on overflow and ``close`` drops
+    the connection. With a ``transport`` (see ``server_transport``) the queue
+    is its streaming producer and only writes while Twisted's buffer has room.
+    """
+
+    def __init__(self, write, resync_frame, close, high_water=HIGH_WATER,
+                 high_water_bytes=HIGH_WATER_BYTES, overflow=OVERFLOW, transport=None):
+        self.write = write
+        self.resync_frame = resync_frame
+        self.close = close
+        self.high_water = high_water
+        self.high_water_bytes = high_water_bytes
+        self.overflow = overflow
+        # [key, frame, replayed] entries; keyed ones can be replaced while queued
+        self._entries = deque()
+        self._keyed = {}
+        self._bytes = 0
+        # Replayed frames in the queue, left out of the marks
+        self._replayed = 0
+        self._replayed_bytes = 0
+        self._ready = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._closed = False
+        self._transport = transport
+        if transport is not None:
+            # Daphne leaves the HTTP channel that upgraded the connection
+            # registered, with nothing left to produce
+            transport.unregisterProducer()
+            transport.registerProducer(self, True)
+        self._task = asyncio.ensure_future(self._run())
+        stats.connections += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def full(self):
+        return (
+            len(self._entries) - self._replayed >= self.high_water
+            or self._bytes - self._replayed_bytes >= self.high_water_bytes
+        )
+
+    async def put(self, frame, key=None, ephemeral=False, replayed=False):
+        """
+        Queue a frame. A newer frame with the same ``key`` replaces a queued
+        one; keyed and ``ephemeral`` frames are dropped when the queue is full.
+        ``replayed`` frames are always queued and don't count towards the
+        marks.
+        """
+        if self._closed:
+            return
+        if replayed:
+            self._append([None, frame, True])
+            self._replayed += 1
+            self._replayed_bytes += len(frame)
+            return
+        if key is not None:
+            entry = self._keyed.get(key)
+            if entry is not None:
+                self._bytes += len(frame) - len(entry[1])
+                entry[1] = frame
+                stats.coalesced += 1
+                return
+        if self.full:
+            if key is not None or ephemeral:
+                stats.dropped += 1
+                return
+            await self._overflow()
+            if self._closed:
+                return
+
+        entry = [key, frame, False]
+        self._append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+
+    def _append(self, entry):
+        self._entries.append(entry)
+        self._bytes += len(entry[1])
+        stats.depth += 1
+        stats.max_depth = max(stats.max_depth, len(self._entries))
+        self._ready.set()
+
+    async def _overflow(self):
+        # A resync frame the client hasn't got yet already covers the drop
+        pending = RESYNC in self._keyed
+        dropped = len(self._entries) - pending
+        self._clear()
+        stats.dropped += dropped
+        if self.overflow == 'disconnect':
+            stats.disconnects += 1
+            logger.info('Closing a slow socket with %d frames queued', dropped)
+            self.stop()
+            await self.close(SLOW_CONSUMER_CLOSE_CODE)
+            return
+        if not pending:
+            stats.resyncs += 1
+        await self.put(self.resync_frame(), key=RESYNC)
+
+    def _clear(self):
+        stats.depth -= len(self._entries)
+        self._entries.clear()
+        self._keyed.clear()
+        self._bytes = 0
+        self._replayed = 0
+        self._replayed_bytes = 0
+
+    # IPushProducer, called by Twisted on the event loop thread
+
+    def pauseProducing(self):
+        self._writable.clear()
+        stats.paused += 1
+
+    def resumeProducing(self):
+        self._writable.set()
+
+    def stopProducing(self):
+        # The connection is lost, let the writer fail and stop
+        self._writable.set()
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._entries:
+                # Frames back up here while the client isn't reading
+                await self._writable.wait()
+                key, frame, replayed = self._entries.popleft()
+                if key is not None:
+                    del self._keyed[key]
+                if replayed:
+                    self._replayed -= 1
+                    self._replayed_bytes -= len(frame)
+                self._bytes -= len(frame)
+                stats.depth -= 1
+                try:
+                    await self.write(frame)
+                except Exception:
+                    # The connection is gone
+                    logger.debug('Outbound write failed', exc_info=True)
+                    self.stop()
+                    return
+                stats.sent += 1
+            self._ready.clear()
+
+    def stop(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._clear()
+        self._task.cancel()
+        if self._transport is not None:
+            self._transport.unregisterProducer()
+            self._transport = None
+        stats.connections -= 1
@@ -0,0 +1,132 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_cursor(timestamp, pk):
+    raw = f'{timestamp.isoformat()}|{pk}'.encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, pk = raw.rsplit('|', 1)
+        timestamp = parse_datetime(timestamp)
+        if timestamp is None:
+            raise ValueError(cursor)
+        return timestamp, int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise NotFound('Invalid cursor')
+
+
+def older_than(timestamp, pk):
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+
+
+def newer_than(timestamp, pk):
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination over (timestamp, id), newest first.
+
+    ``?before=<cursor>`` loads older history and ``?after=<cursor>`` loads
+    newer messages. Each page is a range scan on the ``channel, -timestamp``
+    index, so scrolling back costs the same at any depth. ``?count=1`` adds
+    a total, counted up to ``count_cap`` rows.
+    """
+    page_size = 50
+    max_page_size = 100
+    page_size_query_param = 'limit'
+    count_cap = 1000
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.size = self.get_page_size(request)
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+
+        self.count = None
+        if request.query_params.get('count') in ('1', 'true'):
+            self.count = queryset.order_by()[:self.count_cap].count()
+
+        if after:
+            rows = list(
+                queryset.filter(newer_than(*decode_cursor(after)))
+                .order_by('timestamp', 'id')[:self.size + 1]
+            )
+            self.has_newer = len(rows) > self.size
+            self.has_older = True
+            rows = rows[:self.size]
+            rows.reverse()
+        else:
+            if before:
+                queryset = queryset.filter(older_than(*decode_cursor(before)))
+            rows = list(queryset.order_by('-timestamp', '-id')[:self.size + 1])
+            self.has_older = len(rows) > self.size
+            self.has_newer = bool(before)
+            rows = rows[:self.size]
+
+        self.page = rows
+        return rows
+
+    def paginate_serialized(self, rows, request):
+        """First page from already serialized rows, newest first"""
+        self.request = request
+        self.size = self.get_page_size(request)
+        self.count = None
+        self.has_older = len(rows) > self.size
+        self.has_newer = False
+        self.page = rows[:self.size]
+        return self.page
+
+    def _cursor_link(self, param, row):
+        if isinstance(row, dict):
+            # Serialized rows carry strings, .values() rows datetimes
+            timestamp, pk = row['timestamp'], row['id']
+            if isinstance(timestamp, str):
+                timestamp = parse_datetime(timestamp)
+        else:
+            timestamp, pk = row.timestamp, row.id
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, 'before')
+        url = remove_query_param(url, 'after')
+        return replace_query_param(url, param, encode_cursor(timestamp, pk))
+
+    def get_next_link(self):
+        # "next" walks back in time, i.e. loads older history
+        if not self.page or not self.has_older:
+            return None
+        return self._cursor_link('before', self.page[-1])
+
+    def get_previous_link(self):
+        if not self.page or not self.has_newer:
+            return None
+        return self._cursor_link('after', self.page[0])
+
+    def get_paginated_response(self, data):
+        body = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('page_size', self.size),
+            ('results', data),
+        ])
+        if self.count is not None:
+            body['count'] = self.count
+            body['count_is_exact'] = self.count < self.count_cap
+        return Response(body)
@@ -0,0 +1,276 @@
+import asyncio
+import atexit
+import logging
+import uuid
+import weakref
+from dataclasses import dataclass
+from datetime import datetime
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from . import groups, history_cache, sync, threads, unread
+from .encoding import encode_frame, frame_event
+from .replay import get_replay_buffer
+from .models import Message, User
+from .serializers import MessageSerializer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingMessage:
+    provisional_id: str
+    channel_id: int
+    group_name: str
+    sender_id: int
+    content: str
+    # When the message was accepted and fanned out, not when it is written
+    timestamp: datetime
+    parent_id: int = None
+
+
+class MessageWriteBuffer:
+    """
+    Per-process write-behind buffer for chat messages.
+
+    Messages are fanned out with a provisional id and queued here. The queue
+    is written with a single ``bulk_create`` once ``batch_size`` messages are
+    pending or ``flush_interval`` seconds have passed, and a ``message_ack``
+    event carrying the durable ids is sent to each affected group. What is
+    still queued when the process exits is written by ``close``.
+    """
+
+    def __init__(self, batch_size=50, flush_interval=0.1):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        # Serializes flushes so acks go out in commit order
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def add(self, provisional_id, channel_id, group_name, sender_id, content, timestamp,
+                  parent_id=None):
+        """Queue a message that has already been fanned out with ``timestamp``"""
+        pending = PendingMessage(
+            provisional_id=provisional_id,
+            channel_id=int(channel_id),
+            group_name=group_name,
+            sender_id=sender_id,
+            content=content,
+            timestamp=timestamp,
+            parent_id=parent_id,
+        )
+        self._pending.append(pending)
+
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        # Keep a reference so the task isn't garbage collected mid-flush
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Persist everything queued so far and acknowledge it"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return []
+
+        async with self._lock:
+            try:
+                saved = await database_sync_to_async(self._write)(batch)
+            except Exception as e:
+                await self._send_failures(batch, str(e))
+                return []
+            await self._send_acks(batch, saved)
+            await self._mark_read(saved)
+        return saved
+
+    def close(self):
+        """Write and acknowledge what is still queued, outside the event loop"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            saved = self._write(batch)
+        except Exception:
+            logger.exception('Lost %d buffered messages on shutdown', len(batch))
+            return
+        try:
+            async_to_sync(self._send_acks)(batch, saved)
+            async_to_sync(self._mark_read)(saved)
+        except Exception:
+            logger.warning('Could not acknowledge %d messages on shutdown', len(batch), exc_info=True)
+
+    @staticmethod
+    def _write(batch):
+        messages = [
+            Message(
+                channel_id=item.channel_id,
+                sender_id=item.sender_id,
+                content=item.content,
+                timestamp=item.timestamp,
+                parent_id=item.parent_id,
+            )
+            for item in batch
+        ]
+        with transaction.atomic():
+            # bulk_create skips pre_save, so take the channel seqs here
+            sync.number_messages(messages)
+            messages = Message.objects.bulk_create(messages)
+
+            # bulk_create skips post_save, so count replies on their threads here
+            threads.record_replies(messages)
+
+        # ...and write top-level messages through to the history cache
+        senders = User.objects.in_bulk({item.sender_id for item in batch})
+        rows = {}
+        for message in messages:
+            if message.parent_id:
+                continue
+            message.sender = senders[message.sender_id]
+            rows.setdefault(message.channel_id, []).append(MessageSerializer(message).data)
+        for channel_id, channel_rows in rows.items():
+            history_cache.append(channel_id, channel_rows)
+        return messages
+
+    @staticmethod
+    async def _mark_read(messages):
+        # Senders have read up to their own latest message, one cursor
+        # update per (user, channel) no matter how many messages
+        latest = {}
+        for message in messages:
+            latest[(message.sender_id, message.channel_id)] = message.id
+        store = unread.get_unread_store()
+        for (user_id, channel_id), message_id in latest.items():
+            await store.amark_read(user_id, channel_id, message_id)
+
+    @staticmethod
+    def _group(batch, rows):
+        grouped = {}
+        for item, row in zip(batch, rows):
+            grouped.setdefault(item.group_name, []).append((item, row))
+        return grouped
+
+    @staticmethod
+    async def _group_send(channel_layer, group_name, channel_id, event):
+        # Channel groups may be sharded, thread groups never are
+        if group_name == groups.channel_group(channel_id):
+            await groups.group_send(channel_layer, channel_id, event)
+        else:
+            await channel_layer.group_send(group_name, event)
+
+    @staticmethod
+    def _ack_event(channel_id, items):
+        return frame_event('message_ack', {
+            'type': 'ack',
+            'channel_id': channel_id,
+            'acks': [
+                {
+                    'provisional_id': item.provisional_id,
+                    'message_id': message.id,
+                    'seq': message.seq,
+                    'timestamp': str(message.timestamp),
+                    **({'parent_id': message.parent_id} if message.parent_id else {}),
+                }
+                for item, message in items
+            ],
+        })
+
+    async def _send_acks(self, batch, messages):
+        channel_layer = get_channel_layer()
+        replies = {}
+        for group_name, items in self._group(batch, messages).items():
+            channel_id = items[0][0].channel_id
+            await self._group_send(channel_layer, group_name, channel_id, self._ack_event(channel_id, items))
+            if group_name != groups.channel_group(channel_id):
+                replies.setdefault(channel_id, []).extend(items)
+
+        # The channel saw thread replies as provisional thread_reply frames
+        for channel_id, items in replies.items():
+            await groups.group_send(channel_layer, channel_id, self._ack_event(channel_id, items))
+
+        # Reconnecting clients never saw the provisional frame, they get
+        # the message as if it had been saved right away
+        replay = get_replay_buffer()
+        for item, message in zip(batch, messages):
+            if message.parent_id is None:
+                await replay.record(message.channel_id, message.seq, encode_frame({
+                    'type': 'chat',
+                    'channel_id': message.channel_id,
+                    'message': message.content,
+                    'user_id': message.sender_id,
+                    'username': message.sender.username,
+                    'timestamp': str(message.timestamp),
+                    'message_id': message.id,
+                    'seq': message.seq,
+                    'provisional': False
+                }))
+            else:
+                # Replies take channel seqs too, the channel saw them as thread_reply
+                await replay.record(message.channel_id, message.seq, encode_frame({
+                    'type': 'thread_reply',
+                    'channel_id': message.channel_id,
+                    'parent_id': message.parent_id,
+                    'message_id': message.id,
+                    'user_id': message.sender_id,
+                    'timestamp': str(message.timestamp),
+                    'seq': message.seq
+                }))
+
+    async def _send_failures(self, batch, error):
+        channel_layer = get_channel_layer()
+        for group_name, items in self._group(batch, batch).items():
+            channel_id = items[0][0].channel_id
+            await self._group_send(channel_layer, group_name, channel_id, frame_event('message_failed', {
+                'type': 'message_failed',
+                'channel_id': channel_id,
+                'provisional_ids': [item.provisional_id for item, _ in items],
+                'error': error,
+            }))
+
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_write_buffer():
+    """Return the write buffer for the running event loop"""
+    loop = asyncio.get_running_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        buffer = MessageWriteBuffer(
+            batch_size=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 50),
+            flush_interval=getattr(settings, 'CHAT_WRITE_BEHIND_FLUSH_MS', 100) / 1000,
+        )
+        _buffers[loop] = buffer
+        # Deploys stop the server with messages still queued
+        atexit.register(buffer.close)
+    return buffer
+
+
+def new_provisional_id():
+    return f'tmp-{uuid.uuid4().hex}'
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
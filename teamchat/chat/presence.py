@@ -0,0 +1,326 @@
+"""
+Presence tracking outside the User table.
+
+Every open socket is a connection with an expiry that heartbeats push
+forward, so a user is online while at least one of their connections is
+live and crashed nodes age out on their own. Heartbeat frames and, at most
+every ``REFRESH_INTERVAL``, any other inbound frame keep a connection live. Online/offline transitions
+are debounced: going online is announced once, going offline only after
+``CHAT_PRESENCE_OFFLINE_GRACE`` seconds without any connection, so a user
+reloading one of ten tabs never flaps. ``last_seen`` is buffered in the
+store and written to ``User`` in bulk by the ``flush_presence`` task.
+"""
+import asyncio
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import groups
+from .encoding import frame_event
+from .models import Channel
+
+PRESENCE_TTL = getattr(settings, 'CHAT_PRESENCE_TTL', 90)
+# Sockets refresh their connection on inbound frames at most this often
+REFRESH_INTERVAL = PRESENCE_TTL / 3
+OFFLINE_GRACE = getattr(settings, 'CHAT_PRESENCE_OFFLINE_GRACE', 10)
+
+
+class PresenceStore:
+    """
+    Base class for presence backends.
+
+    ``add_connection`` and ``heartbeat`` return True when the user should
+    be announced online, ``settle_offline`` returns True when they should
+    be announced offline. ``drain_last_seen`` and ``sweep`` are used by the periodic
+    flush task.
+    """
+
+    async def add_connection(self, user_id, connection_id):
+        raise NotImplementedError
+
+    async def remove_connection(self, user_id, connection_id):
+        """Drop a connection and return how many are still live"""
+        raise NotImplementedError
+
+    async def heartbeat(self, user_id, connection_id):
+        raise NotImplementedError
+
+    async def settle_offline(self, user_id):
+        raise NotImplementedError
+
+    def sweep(self):
+        """Settle every announced user whose connections all expired"""
+        raise NotImplementedError
+
+    def drain_last_seen(self):
+        """Return and forget {user_id: (last_seen, online)} since the last drain"""
+        raise NotImplementedError
+
+
+class MemoryPresenceStore(PresenceStore):
+    """Single-process store for tests and development"""
+
+    def __init__(self, **options):
+        self._connections = {}
+        self._announced = set()
+        self._last_seen = {}
+        self._lock = threading.Lock()
+
+    def _live(self, user_id, now):
+        connections = self._connections.get(user_id, {})
+        for connection_id, expires in list(connections.items()):
+            if expires <= now:
+                del connections[connection_id]
+        return len(connections)
+
+    async def add_connection(self, user_id, connection_id):
+        now = time.time()
+        with self._lock:
+            self._connections.setdefault(user_id, {})[connection_id] = now + PRESENCE_TTL
+            self._last_seen[user_id] = now
+            if user_id in self._announced:
+                return False
+            self._announced.add(user_id)
+            return True
+
+    async def remove_connection(self, user_id, connection_id):
+        now = time.time()
+        with self._lock:
+            self._connections.get(user_id, {}).pop(connection_id, None)
+            self._last_seen[user_id] = now
+            return self._live(user_id, now)
+
+    async def heartbeat(self, user_id, connection_id):
+        # A heartbeat after the user was settled offline brings them back
+        return await self.add_connection(user_id, connection_id)
+
+    def _settle(self, user_id):
+        with self._lock:
+            if self._live(user_id, time.time()) or user_id not in self._announced:
+                return False
+            self._announced.discard(user_id)
+            return True
+
+    async def settle_offline(self, user_id):
+        return self._settle(user_id)
+
+    def sweep(self):
+        return [user_id for user_id in list(self._announced) if self._settle(user_id)]
+
+    def drain_last_seen(self):
+        with self._lock:
+            drained, self._last_seen = self._last_seen, {}
+            return {
+                user_id: (seen, user_id in self._announced)
+                for user_id, seen in drained.items()
+            }
+
+
+SETTLE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) > 0 then
+    return 0
+end
+return redis.call('SREM', KEYS[2], ARGV[2])
+"""
+
+# SETTLE_SCRIPT for many users at once: KEYS[1] is the announced set,
+# KEYS[i] the connections of the user ARGV[i]; returns the settled users
+SWEEP_SCRIPT = """
+local settled = {}
+for i = 2, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', ARGV[1])
+    if redis.call('ZCARD', KEYS[i]) == 0 and redis.call('SREM', KEYS[1], ARGV[i]) == 1 then
+        settled[#settled + 1] = ARGV[i]
+    end
+end
+return settled
+"""
+
+
+class RedisPresenceStore(PresenceStore):
+    """
+    Presence shared by every worker.
+
+    Connections are a sorted set per user scored by expiry, the announced
+    users a set, and buffered last-seen times a hash that the flush task
+    reads and clears in one transaction. ``sweep`` settles up to
+    ``sweep_batch_size`` announced users per script call.
+    """
+
+    def __init__(self, url='redis://127.0.0.1:6379/0', prefix='presence', sweep_batch_size=1000):
+        self.url = url
+        self.prefix = prefix
+        self.sweep_batch_size = sweep_batch_size
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+            self._sweep_script = self._client.register_script(SWEEP_SCRIPT)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import redis.asyncio
+            self._async_client = redis.asyncio.Redis.from_url(self.url)
+            self._async_settle_script = self._async_client.register_script(SETTLE_SCRIPT)
+        return self._async_client
+
+    def _connections_key(self, user_id):
+        return f'{self.prefix}:connections:{user_id}'
+
+    @property
+    def _announced_key(self):
+        return f'{self.prefix}:announced'
+
+    @property
+    def _last_seen_key(self):
+        return f'{self.prefix}:last_seen'
+
+    async def add_connection(self, user_id, connection_id):
+        now = time.time()
+        key = self._connections_key(user_id)
+        pipe = self.async_client.pipeline(transaction=True)
+        pipe.zadd(key, {connection_id: now + PRESENCE_TTL})
+        pipe.expire(key, PRESENCE_TTL * 2)
+        pipe.hset(self._last_seen_key, user_id, now)
+        pipe.sadd(self._announced_key, user_id)
+        *_, added = await pipe.execute()
+        return bool(added)
+
+    async def remove_connection(self, user_id, connection_id):
+        now = time.time()
+        key = self._connections_key(user_id)
+        pipe = self.async_client.pipeline(transaction=True)
+        pipe.zrem(key, connection_id)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.hset(self._last_seen_key, user_id, now)
+        pipe.zcard(key)
+        *_, live = await pipe.execute()
+        return live
+
+    async def heartbeat(self, user_id, connection_id):
+        now = time.time()
+        key = self._connections_key(user_id)
+        pipe = self.async_client.pipeline(transaction=False)
+        pipe.zadd(key, {connection_id: now + PRESENCE_TTL})
+        pipe.expire(key, PRESENCE_TTL * 2)
+        pipe.hset(self._last_seen_key, user_id, now)
+        # A heartbeat after the user was settled offline brings them back
+        pipe.sadd(self._announced_key, user_id)
+        *_, added = await pipe.execute()
+        return bool(added)
+
+    async def settle_offline(self, user_id):
+        client = self.async_client
+        settled = await self._async_settle_script(
+            keys=[self._connections_key(user_id), self._announced_key],
+            args=[time.time(), user_id],
+            client=client,
+        )
+        return bool(settled)
+
+    def sweep(self):
+        went_offline = []
+        now = time.time()
+        user_ids = [int(member) for member in self.client.smembers(self._announced_key)]
+        for start in range(0, len(user_ids), self.sweep_batch_size):
+            batch = user_ids[start:start + self.sweep_batch_size]
+            settled = self._sweep_script(
+                keys=[self._announced_key] + [self._connections_key(user_id) for user_id in batch],
+                args=[now] + batch,
+            )
+            went_offline.extend(int(user_id) for user_id in settled)
+        return went_offline
+
+    def drain_last_seen(self):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hgetall(self._last_seen_key)
+        pipe.delete(self._last_seen_key)
+        pipe.smembers(self._announced_key)
+        last_seen, _, announced = pipe.execute()
+        announced = {int(member) for member in announced}
+        return {
+            int(user_id): (float(seen), int(user_id) in announced)
+            for user_id, seen in last_seen.items()
+        }
+
+
+_store = None
+
+
+def get_presence_store():
+    """Return the store configured by ``CHAT_PRESENCE_STORE``"""
+    global _store
+    if _store is None:
+        config = getattr(settings, 'CHAT_PRESENCE_STORE', {})
+        backend = import_string(config.get('BACKEND', 'chat.presence.MemoryPresenceStore'))
+        _store = backend(**config.get('OPTIONS', {}))
+    return _store
+
+
+def _user_channel_shards(user_id):
+    # Shard counts come along in the same query, one lookup for every channel
+    shards = dict(
+        Channel.members.through.objects.filter(user_id=user_id)
+        .values_list('channel_id', 'channel__group_shards')
+    )
+    groups.remember_shards(shards)
+    return shards
+
+
+async def broadcast(user_id, status):
+    """Push a presence diff to every channel the user belongs to"""
+    channel_layer = get_channel_layer()
+    channel_shards = await database_sync_to_async(_user_channel_shards)(user_id)
+    event = frame_event('user_presence', {
+        'type': 'presence',
+        'user_id': user_id,
+        'status': status
+    }, user_id=user_id)
+    for channel_id, shards in channel_shards.items():
+        await groups.group_send(channel_layer, channel_id, event, shards=shards)
+
+
+def broadcast_sync(user_id, status):
+    async_to_sync(broadcast)(user_id, status)
+
+
+async def user_connected(user_id, connection_id):
+    if await get_presence_store().add_connection(user_id, connection_id):
+        await broadcast(user_id, True)
+
+
+_pending_offline = {}
+
+
+async def user_disconnected(user_id, connection_id):
+    if await get_presence_store().remove_connection(user_id, connection_id):
+        return
+    # Last connection gone; wait out the grace period before announcing
+    if user_id not in _pending_offline:
+        _pending_offline[user_id] = asyncio.ensure_future(_announce_offline_later(user_id))
+
+
+async def _announce_offline_later(user_id):
+    try:
+        await asyncio.sleep(OFFLINE_GRACE)
+        if await get_presence_store().settle_offline(user_id):
+            await broadcast(user_id, False)
+    finally:
+        _pending_offline.pop(user_id, None)
+
+
+async def heartbeat(user_id, connection_id):
+    if await get_presence_store().heartbeat(user_id, connection_id):
+        await broadcast(user_id, True)
@@ -0,0 +1,255 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+SLIDING_WINDOW = 'sliding_window'
+TOKEN_BUCKET = 'token_bucket'
+
+
+@dataclass(frozen=True)
+class Rate:
+    limit: int
+    window: float  # seconds
+    algorithm: str = SLIDING_WINDOW
+
+
+class RateLimiter:
+    """
+    Base class for rate limiter backends.
+
+    ``hit`` and ``ahit`` take a list of ``(key, Rate)`` pairs and return
+    False if any of them is over its limit; otherwise they consume one unit
+    from each and return True.
+    """
+
+    def hit(self, checks):
+        raise NotImplementedError
+
+    async def ahit(self, checks):
+        raise NotImplementedError
+
+    def reset(self):
+        """Forget all counters (used by tests and benchmarks)"""
+        raise NotImplementedError
+
+
+class MemoryRateLimiter(RateLimiter):
+    """In-process limiter, exact within a single process"""
+
+    def __init__(self, **options):
+        self._logs = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def hit(self, checks):
+        now = time.monotonic()
+        with self._lock:
+            # A denied call consumes nothing, so one spamming scope can't
+            # drain a bucket shared with other users
+            for key, rate in checks:
+                if rate.algorithm == TOKEN_BUCKET:
+                    allowed = self._refill(key, rate, now) >= 1
+                else:
+                    allowed = len(self._prune(key, rate, now)) < rate.limit
+                if not allowed:
+                    return False
+            for key, rate in checks:
+                if rate.algorithm == TOKEN_BUCKET:
+                    tokens, updated = self._buckets[key]
+                    self._buckets[key] = (tokens - 1, updated)
+                else:
+                    self._logs[key].append(now)
+        return True
+
+    async def ahit(self, checks):
+        # Nothing to wait on, so no thread hop either
+        return self.hit(checks)
+
+    def reset(self):
+        with self._lock:
+            self._logs.clear()
+            self._buckets.clear()
+
+    def _prune(self, key, rate, now):
+        log = self._logs.setdefault(key, deque())
+        while log and log[0] <= now - rate.window:
+            log.popleft()
+        return log
+
+    def _refill(self, key, rate, now):
+        tokens, updated = self._buckets.get(key, (rate.limit, now))
+        tokens = min(rate.limit, tokens + (now - updated) * rate.limit / rate.window)
+        self._buckets[key] = (tokens, now)
+        return tokens
+
+
+# Checks every key first and only consumes when all of them allow, reading
+# the clock on the Redis server so every worker agrees. ARGV holds
+# (algorithm, limit, window ms, sliding window member) per key.
+HIT_SCRIPT = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local tokens = {}
+for i = 1, #KEYS do
+    local base = (i - 1) * 4
+    local limit = tonumber(ARGV[base + 2])
+    local window = tonumber(ARGV[base + 3])
+    if ARGV[base + 1] == 'token_bucket' then
+        local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+        local available = tonumber(state[1]) or limit
+        local updated = tonumber(state[2]) or now
+        available = math.min(limit, available + (now - updated) * limit / window)
+        if available < 1 then
+            return 0
+        end
+        tokens[i] = available
+    else
+        redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, now - window)
+        if redis.call('ZCARD', KEYS[i]) >= limit then
+            return 0
+        end
+    end
+end
+for i = 1, #KEYS do
+    local base = (i - 1) * 4
+    local window = tonumber(ARGV[base + 3])
+    if tokens[i] then
+        redis.call('HSET', KEYS[i], 'tokens', tostring(tokens[i] - 1), 'ts', now)
+    else
+        redis.call('ZADD', KEYS[i], now, ARGV[base + 4])
+    end
+    redis.call('PEXPIRE', KEYS[i], window)
+end
+return 1
+"""
+HIT_SCRIPT_SHA = hashlib.sha1(HIT_SCRIPT.encode()).hexdigest()
+
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Atomic limiter shared by every worker.
+
+    All checks of one call run in a single Lua script over their keys, sent
+    as one ``EVALSHA`` (``EVAL`` once after a NOSCRIPT), so a message costs
+    one round trip no matter how many scopes it is limited on. ``ahit``
+    uses ``redis.asyncio`` directly.
+    """
+
+    def __init__(self, url='redis://127.0.0.1:6379/0', prefix='ratelimit'):
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import redis.asyncio
+            self._async_client = redis.asyncio.Redis.from_url(self.url)
+        return self._async_client
+
+    def _command(self, checks):
+        keys, args = [], []
+        for key, rate in checks:
+            keys.append(f'{self.prefix}:{rate.algorithm}:{key}')
+            # Unique member so simultaneous hits aren't collapsed
+            args += [rate.algorithm, rate.limit, int(rate.window * 1000), uuid.uuid4().hex]
+        return [len(keys), *keys, *args]
+
+    def hit(self, checks):
+        from redis.exceptions import NoScriptError
+
+        command = self._command(checks)
+        try:
+            return bool(self.client.evalsha(HIT_SCRIPT_SHA, *command))
+        except NoScriptError:
+            return bool(self.client.eval(HIT_SCRIPT, *command))
+
+    async def ahit(self, checks):
+        from redis.exceptions import NoScriptError
+
+        command = self._command(checks)
+        try:
+            return bool(await self.async_client.evalsha(HIT_SCRIPT_SHA, *command))
+        except NoScriptError:
+            return bool(await self.async_client.eval(HIT_SCRIPT, *command))
+
+    def reset(self):
+        for key in self.client.scan_iter(f'{self.prefix}:*'):
+            self.client.delete(key)
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    """Return the limiter configured by ``CHAT_RATE_LIMITER``"""
+    global _limiter
+    if _limiter is None:
+        config = getattr(settings, 'CHAT_RATE_LIMITER', {})
+        backend = import_string(config.get('BACKEND', 'chat.ratelimit.MemoryRateLimiter'))
+        _limiter = backend(**config.get('OPTIONS', {}))
+    return _limiter
+
+
+def get_rate(scope):
+    config = getattr(settings, 'CHAT_RATE_LIMITS', {}).get(scope)
+    if not config:
+        return None
+    return Rate(
+        limit=config['limit'],
+        window=config['window'],
+        algorithm=config.get('algorithm', SLIDING_WINDOW),
+    )
+
+
+def _resolve(checks):
+    """Turn (scope, identifier) pairs into (key, Rate), skipping unset scopes"""
+    resolved = []
+    for scope, identifier in checks:
+        rate = get_rate(scope)
+        if rate is not None and identifier is not None:
+            resolved.append((f'{scope}:{identifier}', rate))
+    return resolved
+
+
+def check(checks):
+    """Consume one unit from each (scope, identifier) pair if none is over its limit"""
+    resolved = _resolve(checks)
+    return not resolved or get_rate_limiter().hit(resolved)
+
+
+async def acheck(checks):
+    resolved = _resolve(checks)
+    return not resolved or await get_rate_limiter().ahit(resolved)
+
+
+class ChatRateThrottle(BaseThrottle):
+    """DRF throttle backed by the chat rate limiter"""
+    user_scope = None
+    ip_scope = None
+
+    def allow_request(self, request, view):
+        checks = [(self.ip_scope, self.get_ident(request))]
+        if request.user and request.user.is_authenticated:
+            checks.append((self.user_scope, request.user.id))
+        return check([(scope, ident) for scope, ident in checks if scope])
+
+
+class SearchRateThrottle(ChatRateThrottle):
+    user_scope = 'search:user'
+    ip_scope = 'search:ip'
@@ -0,0 +1,147 @@
+"""
+Replay of missed channel frames after a reconnect.
+
+Every channel frame that carries a change ``seq`` (new messages, edits,
+deletes) is recorded in a bounded per-channel buffer as it is fanned out.
+Replies take seqs of their channel too, so their frames are recorded in the
+channel's buffer (``thread_reply`` for new replies, the thread frame for
+edits and deletes) and a reply leaves no gap that sends a reconnect to the
+database.
+A client reconnecting with the last seq it saw gets the frames it missed
+from the buffer; when the gap reaches past the oldest buffered frame, the
+changes are read from the database instead (see ``chat.sync``).
+
+The group is joined before replaying, so a frame sent in between may be
+delivered twice; clients drop frames whose seq they already have.
+"""
+import threading
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .encoding import encode_frame
+from .groups import group_send
+from .sync import serialize_changes
+from .threads import thread_group
+
+
+class ReplayBuffer:
+    """Base class for replay buffer backends"""
+
+    async def record(self, channel_id, seq, frame):
+        raise NotImplementedError
+
+    async def frames_since(self, channel_id, seq):
+        """
+        Buffered frames after ``seq`` in seq order, or None if frames after
+        it may already have been dropped.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _after(entries, seq):
+        # Entries are (seq, frame); the buffer covers the gap only if it
+        # reaches back to the frame right after ``seq``
+        if not entries or min(entry_seq for entry_seq, _ in entries) > seq + 1:
+            return None
+        return [frame for entry_seq, frame in sorted(entries) if entry_seq > seq]
+
+
+class MemoryReplayBuffer(ReplayBuffer):
+    """Single-process buffer for tests and development"""
+
+    def __init__(self, size=500, **options):
+        self.size = size
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    async def record(self, channel_id, seq, frame):
+        with self._lock:
+            entries = self._channels.get(int(channel_id))
+            if entries is None:
+                entries = self._channels[int(channel_id)] = deque(maxlen=self.size)
+            entries.append((seq, frame))
+
+    async def frames_since(self, channel_id, seq):
+        with self._lock:
+            entries = list(self._channels.get(int(channel_id), ()))
+        return self._after(entries, seq)
+
+
+class RedisReplayBuffer(ReplayBuffer):
+    """
+    One capped Redis stream per channel, shared by every worker.
+
+    Streams are trimmed to roughly ``size`` entries on every add and
+    expire ``timeout`` seconds after the channel's last frame.
+    """
+
+    def __init__(self, url='redis://127.0.0.1:6379/0', prefix='replay', size=500, timeout=60 * 60 * 24):
+        self.url = url
+        self.prefix = prefix
+        self.size = size
+        self.timeout = timeout
+        self._async_client = None
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import redis.asyncio
+            self._async_client = redis.asyncio.Redis.from_url(self.url)
+        return self._async_client
+
+    def _key(self, channel_id):
+        return f'{self.prefix}:{channel_id}'
+
+    async def record(self, channel_id, seq, frame):
+        key = self._key(channel_id)
+        pipe = self.async_client.pipeline(transaction=False)
+        pipe.xadd(key, {'seq': seq, 'frame': frame}, maxlen=self.size, approximate=True)
+        pipe.expire(key, self.timeout)
+        await pipe.execute()
+
+    async def frames_since(self, channel_id, seq):
+        entries = await self.async_client.xrange(self._key(channel_id))
+        return self._after(
+            [(int(fields[b'seq']), fields[b'frame'].decode()) for _, fields in entries], seq
+        )
+
+
+_buffer = None
+
+
+def get_replay_buffer():
+    """Return the buffer configured by ``CHAT_REPLAY_BUFFER``"""
+    global _buffer
+    if _buffer is None:
+        config = getattr(settings, 'CHAT_REPLAY_BUFFER', {})
+        backend = import_string(config.get('BACKEND', 'chat.replay.MemoryReplayBuffer'))
+        _buffer = backend(**config.get('OPTIONS', {}))
+    return _buffer
+
+
+async def channel_send(channel_layer, channel_id, seq, event):
+    """``group_send`` a channel frame and keep it for replay"""
+    await get_replay_buffer().record(channel_id, seq, event['frame'])
+    await group_send(channel_layer, channel_id, event)
+
+
+async def thread_send(channel_layer, channel_id, parent_id, seq, event):
+    """``group_send`` a thread frame and keep it for replay in its channel"""
+    await get_replay_buffer().record(channel_id, seq, event['frame'])
+    await channel_layer.group_send(thread_group(parent_id), event)
+
+
+async def missed_frames(channel_id, seq):
+    """
+    Encoded frames to send a client that last saw ``seq``: the buffered
+    frames, or a single ``changes`` frame read from the database.
+    """
+    frames = await get_replay_buffer().frames_since(channel_id, seq)
+    if frames is not None:
+        return frames
+
+    changes = await database_sync_to_async(serialize_changes)(channel_id, seq)
+    return [encode_frame({'type': 'changes', **changes})]
@@ -1,6 +1,13 @@
 from django.urls import re_path
 from . import consumers
+from .groups import RELAY_CHANNEL
 
 websocket_urlpatterns = [
+    re_path(r'ws/chat/$', consumers.MultiplexChatConsumer.as_asgi()),
     re_path(r'ws/chat/(?P<channel_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
-]
\ No newline at end of file
+]
+
+# Background workers, run with ``manage.py runworker <channel>``
+channel_routes = {}
+if RELAY_CHANNEL:
+    channel_routes[RELAY_CHANNEL] = consumers.GroupRelayConsumer.as_asgi()
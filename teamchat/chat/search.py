@@ -0,0 +1,206 @@
+import re
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Message
+
+TOKEN_RE = re.compile(r'"([^"]+)"|(\S+)')
+
+
+def parse_query(query):
+    """Split a query into (text, is_phrase) pairs; "quoted text" is a phrase"""
+    terms = []
+    for phrase, word in TOKEN_RE.findall(query):
+        if phrase.strip():
+            terms.append((phrase.strip(), True))
+        elif word:
+            terms.append((word, False))
+    return terms
+
+
+class SearchBackend:
+    """
+    Base class for message search engines.
+
+    ``search`` narrows a Message queryset to matches; with ``rank=True`` it
+    also annotates a ``search_rank`` (higher is better). ``install`` creates
+    whatever index the engine needs and is safe to run repeatedly.
+    """
+    vendor = None
+
+    def search(self, queryset, query, rank=False):
+        raise NotImplementedError
+
+    def install(self, connection):
+        pass
+
+    def uninstall(self, connection):
+        pass
+
+
+class ContainsSearchBackend(SearchBackend):
+    """Case-insensitive substring match, a sequential scan on large channels"""
+
+    def search(self, queryset, query, rank=False):
+        condition = Q()
+        for text, _ in parse_query(query):
+            condition &= Q(content__icontains=text)
+        queryset = queryset.filter(condition)
+        if rank:
+            queryset = queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
+        return queryset
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    tsvector search backed by a GIN expression index.
+
+    The index is on ``to_tsvector(config, content)`` so Postgres keeps it in
+    sync on every insert and edit, and queries use ``websearch_to_tsquery``
+    which understands "quoted phrases", ``or`` and ``-exclusions``.
+    """
+    vendor = 'postgresql'
+    index_name = 'chat_message_fts_idx'
+
+    def __init__(self, config='english'):
+        self.config = config
+
+    def _vector(self):
+        table = connection.ops.quote_name(Message._meta.db_table)
+        return f"to_tsvector('{self.config}', {table}.\"content\")"
+
+    def search(self, queryset, query, rank=False):
+        tsquery = f"websearch_to_tsquery('{self.config}', %s)"
+        queryset = queryset.filter(
+            RawSQL(f'{self._vector()} @@ {tsquery}', [query], output_field=BooleanField())
+        )
+        if rank:
+            queryset = queryset.annotate(
+                search_rank=RawSQL(f'ts_rank({self._vector()}, {tsquery})', [query], output_field=FloatField())
+            )
+        return queryset
+
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.index_name} ON {Message._meta.db_table} '
+                f"USING gin (to_tsvector('{self.config}', content))"
+            )
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP INDEX IF EXISTS {self.index_name}')
+
+
+class SqliteSearchBackend(SearchBackend):
+    """
+    FTS5 search for the default SQLite database.
+
+    ``chat_message_fts`` is an external-content FTS5 table over
+    ``chat_message``, kept in sync by insert/update/delete triggers. Bare
+    words match as prefixes and "quoted text" as a phrase; results are
+    ranked with bm25.
+    """
+    vendor = 'sqlite'
+    table = 'chat_message_fts'
+
+    def match_expression(self, query):
+        parts = []
+        for text, is_phrase in parse_query(query):
+            quoted = '"' + text.replace('"', '""') + '"'
+            parts.append(quoted if is_phrase else quoted + '*')
+        return ' '.join(parts)
+
+    def search(self, queryset, query, rank=False):
+        expression = self.match_expression(query)
+        if not expression:
+            return queryset.none()
+        queryset = queryset.filter(
+            id__in=RawSQL(f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s', [expression])
+        )
+        if rank:
+            source = connection.ops.quote_name(Message._meta.db_table)
+            queryset = queryset.annotate(
+                # FTS5 rank is bm25, where lower means more relevant
+                search_rank=RawSQL(
+                    f'SELECT -rank FROM {self.table} '
+                    f'WHERE {self.table} MATCH %s AND rowid = {source}."id"',
+                    [expression],
+                    output_field=FloatField(),
+                )
+            )
+        return queryset
+
+    def install(self, connection):
+        source = Message._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [self.table]
+            )
+            created = cursor.fetchone() is None
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5('
+                f"content, content='{source}', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2')"
+            )
+            # Triggers are dropped whenever a migration rebuilds chat_message,
+            # so they are (re)created on every install
+            cursor.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {self.table}_ai AFTER INSERT ON {source} BEGIN '
+                f'INSERT INTO {self.table}(rowid, content) VALUES (new.id, new.content); END'
+            )
+            cursor.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {self.table}_ad AFTER DELETE ON {source} BEGIN '
+                f"INSERT INTO {self.table}({self.table}, rowid, content) VALUES ('delete', old.id, old.content); END"
+            )
+            cursor.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {self.table}_au AFTER UPDATE OF content ON {source} BEGIN '
+                f"INSERT INTO {self.table}({self.table}, rowid, content) VALUES ('delete', old.id, old.content); "
+                f'INSERT INTO {self.table}(rowid, content) VALUES (new.id, new.content); END'
+            )
+            if created:
+                cursor.execute(f"INSERT INTO {self.table}({self.table}) VALUES ('rebuild')")
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            for suffix in ('ai', 'ad', 'au'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {self.table}_{suffix}')
+            cursor.execute(f'DROP TABLE IF EXISTS {self.table}')
+
+
+BACKENDS = {
+    'postgresql': PostgresSearchBackend,
+    'sqlite': SqliteSearchBackend,
+}
+
+_backend = None
+
+
+def get_search_backend():
+    """Return ``CHAT_SEARCH_BACKEND`` or the engine for the default database"""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+        if path:
+            _backend = import_string(path)()
+        else:
+            _backend = BACKENDS.get(connection.vendor, ContainsSearchBackend)()
+    return _backend
+
+
+def install_search_index(using='default'):
+    conn = connections[using]
+    backend = BACKENDS.get(conn.vendor)
+    if backend is not None:
+        backend().install(conn)
+
+
+def uninstall_search_index(using='default'):
+    conn = connections[using]
+    backend = BACKENDS.get(conn.vendor)
+    if backend is not None:
+        backend().uninstall(conn)
@@ -1,10 +1,14 @@
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth import authenticate
 from .models import User, Channel, Message, Team
+from .membership import add_channel_members, add_team_members
+from django.utils.functional import cached_property
 from django.utils.html import escape
+from .highlight import Highlighter
 User = get_user_model()
 
 class CustomSignupSerializer(serializers.ModelSerializer):
@@ -50,17 +54,59 @@ class CustomLoginSerializer(serializers.Serializer):
         }
     
     
+class BulkManyRelatedField(serializers.ManyRelatedField):
+    """Looks up every submitted pk in one query instead of one per pk"""
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        pks = []
+        for pk in data:
+            try:
+                pks.append(int(pk))
+            except (TypeError, ValueError):
+                self.child_relation.fail('incorrect_type', data_type=type(pk).__name__)
+        pks = list(dict.fromkeys(pks))
+        found = self.child_relation.get_queryset().in_bulk(pks)
+        for pk in pks:
+            if pk not in found:
+                self.child_relation.fail('does_not_exist', pk_value=pk)
+        return [found[pk] for pk in pks]
+
+
+class MemberIdsField(serializers.PrimaryKeyRelatedField):
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return BulkManyRelatedField(**list_kwargs)
+
+
+class MemberSerializer(serializers.ModelSerializer):
+    """Compact user row for the paginated member lists"""
+
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'avatar', 'online']
+
+
 class TeamSerializer(serializers.ModelSerializer):
-    members = serializers.PrimaryKeyRelatedField(
+    members = MemberIdsField(
         queryset=User.objects.all(),
         many=True,
         required=False,
         allow_empty=True
     )
 
+    member_count = serializers.SerializerMethodField()
+
     class Meta:
         model = Team
-        fields = ['id', 'name', 'description', 'created_by', 'created_at', 'members']
+        fields = ['id', 'name', 'description', 'created_by', 'created_at', 'members', 'member_count']
         read_only_fields = ['created_by', 'created_at']
         extra_kwargs = {
             'name': {'required': True},
@@ -68,6 +114,11 @@ class TeamSerializer(serializers.ModelSerializer):
         }
     # Validate that the creator is not in the members list
 
+    def get_member_count(self, obj):
+        # Annotated by TeamListView, counted here for freshly created teams
+        count = getattr(obj, 'member_count', None)
+        return obj.members.count() if count is None else count
+
     def validate_members(self, value):
         """Ensure creator isn't in members list"""
         user = self.context['request'].user
@@ -88,8 +139,9 @@ class TeamSerializer(serializers.ModelSerializer):
             **validated_data
         )
         
-        # Add creator as member and any additional members
-        team.members.add(user, *members)
+        # Add creator as member and any additional members; a new team has
+        # no channels to propagate to yet
+        add_team_members(team.id, [user.id, *(member.id for member in members)], propagate=False)
         
         return team
 
@@ -99,8 +151,18 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'email', 'online', 'last_seen', 'avatar']
 
 
+class TeamSummarySerializer(serializers.ModelSerializer):
+    """Team list entry without member ids, see TeamMemberListView"""
+    member_count = serializers.IntegerField(read_only=True)
+    channel_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Team
+        fields = ['id', 'name', 'description', 'created_by', 'created_at', 'member_count', 'channel_count']
+
+
 class ChannelSerializer(serializers.ModelSerializer):
-    members = serializers.PrimaryKeyRelatedField(
+    members = MemberIdsField(
         queryset=User.objects.all(),
         many=True,
         required=False  # Make members optional
@@ -135,20 +197,50 @@ class ChannelSerializer(serializers.ModelSerializer):
             **validated_data
         )
         
-        # Add creator first
-        channel.members.add(user)
-        
-        # For team channels, add all team members
+        # Creator, all team members for team channels and any explicitly
+        # specified members, inserted by id in bulk
+        member_ids = [user.id, *(member.id for member in members)]
         if team and channel.channel_type != 'direct':
-            team_members = team.members.all()
-            channel.members.add(*team_members)
-        
-        # Add any explicitly specified members
-        if members:
-            channel.members.add(*members)
+            member_ids.extend(
+                Team.members.through.objects.filter(team=team).values_list('user_id', flat=True)
+            )
+        add_channel_members(channel.id, member_ids)
         
         return channel
     
+class ChannelSummarySerializer(serializers.ModelSerializer):
+    """
+    Channel list entry without member ids, see ChannelMemberListView.
+
+    ``last_message`` and ``unread_count`` come from the view context so a
+    whole page costs a fixed number of queries.
+    """
+    member_count = serializers.IntegerField(read_only=True)
+    last_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
+
+    preview_length = 100
+
+    class Meta:
+        model = Channel
+        fields = ['id', 'name', 'team', 'channel_type', 'member_count', 'last_message', 'unread_count']
+
+    def get_last_message(self, obj):
+        message = self.context.get('last_messages', {}).get(obj.last_message_id)
+        if message is None:
+            return None
+        return {
+            'id': message.id,
+            'sender': message.sender_id,
+            'username': message.sender.username,
+            'preview': message.content[:self.preview_length],
+            'timestamp': serializers.DateTimeField().to_representation(message.timestamp),
+        }
+
+    def get_unread_count(self, obj):
+        return self.context.get('unread_counts', {}).get(obj.id, 0)
+
+    
 class MessageSerializer(serializers.ModelSerializer):
     username = serializers.CharField(source='sender.username', read_only=True)
     user_avatar = serializers.CharField(source='sender.avatar', read_only=True)
@@ -156,7 +248,9 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ['id', 'channel', 'sender', 'username', 'user_avatar', 
-                 'content', 'timestamp', 'edited', 'edited_at', 'parent']
+                 'content', 'timestamp', 'edited', 'edited_at', 'parent',
+                 'reply_count', 'last_reply_at', 'seq']
+        read_only_fields = ['reply_count', 'last_reply_at', 'seq']
     def validate_content(self, value):
         # Basic XSS protection
         cleaned_value = escape(value)
@@ -164,57 +258,61 @@ class MessageSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Message too long")
         return cleaned_value
     
+class FastMessageSerializer:
+    """
+    Read-only ``MessageSerializer`` for lists.
+
+    ``values(queryset)`` selects the message and sender columns in one
+    joined query, and ``data`` turns those rows into the same dicts
+    ``MessageSerializer`` produces without instantiating models or walking
+    DRF fields per row.
+    """
+    lookups = (
+        'id', 'channel_id', 'sender_id', 'sender__username', 'sender__avatar', 'content',
+        'timestamp', 'edited', 'edited_at', 'parent_id', 'reply_count', 'last_reply_at', 'seq',
+    )
+    datetime_field = serializers.DateTimeField()
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @classmethod
+    def values(cls, queryset):
+        return queryset.values(*cls.lookups)
+
+    @property
+    def data(self):
+        datetime = self.datetime_field.to_representation
+        return [
+            {
+                'id': row['id'],
+                'channel': row['channel_id'],
+                'sender': row['sender_id'],
+                'username': row['sender__username'],
+                'user_avatar': row['sender__avatar'],
+                'content': row['content'],
+                'timestamp': datetime(row['timestamp']),
+                'edited': row['edited'],
+                'edited_at': datetime(row['edited_at']),
+                'parent': row['parent_id'],
+                'reply_count': row['reply_count'],
+                'last_reply_at': datetime(row['last_reply_at']),
+                'seq': row['seq'],
+            }
+            for row in self.rows
+        ]
+
+
 class MessageSearchSerializer(MessageSerializer):
-    highlights = serializers.SerializerMethodField()
+    """``MessageSerializer`` plus ``highlights`` and ``matches`` for the request's ``q``"""
 
-    class Meta(MessageSerializer.Meta):
-        fields = MessageSerializer.Meta.fields + ['highlights']
-    
-    def get_highlights(self, obj):
+    @cached_property
+    def highlighter(self):
+        # One per serializer, and ``many=True`` reuses a single child
         request = self.context.get('request')
-        search_term = request.GET.get('q', '') if request else ''
-        
-        if not search_term:
-            return []
-        
-        content = obj.content
-        # Simple highlighting - for more advanced, consider Whoosh or Elasticsearch
-        highlighted = []
-        terms = search_term.lower().split()
-        
-        for term in terms:
-            start = 0
-            while True:
-                idx = content.lower().find(term, start)
-                if idx == -1:
-                    break
-                end = idx + len(term)
-                highlighted.append((idx, end))
-                start = end
-        
-        # Sort by position and merge overlapping ranges
-        highlighted.sort()
-        merged = []
-        for start, end in highlighted:
-            if not merged:
-                merged.append([start, end])
-            else:
-                last_start, last_end = merged[-1]
-                if start <= last_end:
-                    merged[-1][1] = max(last_end, end)
-                else:
-                    merged.append([start, end])
-        
-        # Apply highlights
-        result = []
-        last_pos = 0
-        for start, end in merged:
-            if last_pos < start:
-                result.append(content[last_pos:start])
-            result.append(f'<mark>{content[start:end]}</mark>')
-            last_pos = end
-        
-        if last_pos < len(content):
-            result.append(content[last_pos:])
-        
-        return [''.join(result)]
\ No newline at end of file
+        return Highlighter(request.GET.get('q', '') if request else '')
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['highlights'], data['matches'] = self.highlighter.highlight(data['content'])
+        return data
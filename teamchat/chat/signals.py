@@ -0,0 +1,104 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save, pre_save
+from django.dispatch import receiver
+
+from . import history_cache, sync, threads
+from .membership import INVALIDATION_GROUP, membership_cache, publish_membership_change
+from .middleware import invalidate_user
+from .models import Channel, Message, User
+from .search import install_search_index
+from .serializers import MessageSerializer
+
+
+@receiver(m2m_changed, sender=Channel.members.through)
+def channel_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop cached membership answers here and on every other worker"""
+    if action == 'pre_clear':
+        # pk_set is not available for clear, remember who is about to go
+        if reverse:
+            instance._cleared_memberships = {
+                channel_id: [instance.pk]
+                for channel_id in sender.objects.filter(user_id=instance.pk).values_list('channel_id', flat=True)
+            }
+        else:
+            instance._cleared_memberships = {
+                instance.pk: list(sender.objects.filter(channel_id=instance.pk).values_list('user_id', flat=True))
+            }
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        if reverse:
+            event = {'user_ids': [instance.pk]}
+        else:
+            event = {'channel_ids': [instance.pk]}
+        membership_cache.invalidate(**event)
+        transaction.on_commit(lambda: _broadcast(event))
+        changed = instance.__dict__.pop('_cleared_memberships', {})
+    elif reverse:
+        changed = {channel_id: [instance.pk] for channel_id in pk_set}
+    else:
+        changed = {instance.pk: list(pk_set)}
+    for channel_id, user_ids in changed.items():
+        if action == 'post_add':
+            publish_membership_change(channel_id, added=user_ids)
+        elif user_ids:
+            # Sockets of removed users are closed by the members_changed event
+            publish_membership_change(channel_id, removed=user_ids)
+
+
+def _broadcast(event):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(
+        INVALIDATION_GROUP,
+        {'type': 'membership.invalidate', **event}
+    )
+
+
+@receiver(post_migrate)
+def ensure_search_index(sender, using, **kwargs):
+    # SQLite drops the FTS triggers whenever a migration rebuilds chat_message
+    if sender.name == 'chat':
+        install_search_index(using)
+
+
+@receiver(pre_save, sender=Message)
+def number_message(sender, instance, **kwargs):
+    # bulk_create skips this, see MessageWriteBuffer._write
+    if instance._state.adding and instance.seq is None:
+        sync.number_messages([instance])
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    if created and instance.parent_id:
+        # Replies live in their thread, only the parent's counters change
+        threads.record_replies([instance])
+    elif created:
+        row = MessageSerializer(instance).data
+        transaction.on_commit(lambda: history_cache.append(instance.channel_id, [row]))
+    elif instance.parent_id is None:
+        row = MessageSerializer(instance).data
+        transaction.on_commit(lambda: history_cache.update(instance.channel_id, [row]))
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    if instance.parent_id:
+        threads.forget_reply(instance)
+    transaction.on_commit(lambda: history_cache.invalidate(instance.channel_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # Sockets authenticate from cached users, drop them here and on every worker
+    def invalidate():
+        invalidate_user(instance.pk)
+        _broadcast({'auth_user_ids': [instance.pk]})
+    transaction.on_commit(invalidate)
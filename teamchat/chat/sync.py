@@ -0,0 +1,159 @@
+"""
+Per-channel change sequence numbers, message edits and deletes.
+
+Every create, edit and delete in a channel takes the next number from
+``Channel.last_seq``; messages keep the number of their latest change in
+``seq`` and deletes leave a ``MessageTombstone`` behind. A client that
+remembers the highest seq it has seen catches up with ``changes_since``
+instead of reloading the history.
+
+Numbers are taken with ``UPDATE ... SET last_seq = last_seq + n`` inside
+the caller's transaction, which locks the channel row until commit, so
+changes of a channel commit in seq order and a reader never sees seq N+1
+before N.
+"""
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Channel, Message, MessageTombstone
+
+SYNC_PAGE_SIZE = getattr(settings, 'CHAT_SYNC_PAGE_SIZE', 500)
+
+
+def allocate_seqs(channel_id, count=1):
+    """Reserve ``count`` consecutive seqs; call inside ``transaction.atomic``"""
+    Channel.objects.filter(id=channel_id).update(last_seq=F('last_seq') + count)
+    last = Channel.objects.values_list('last_seq', flat=True).get(id=channel_id)
+    return range(last - count + 1, last + 1)
+
+
+def number_messages(messages):
+    """Give messages their next seqs, one UPDATE per channel"""
+    by_channel = {}
+    for message in messages:
+        by_channel.setdefault(message.channel_id, []).append(message)
+    # A fixed lock order keeps concurrent batches from deadlocking
+    for channel_id in sorted(by_channel):
+        channel_messages = by_channel[channel_id]
+        for message, seq in zip(channel_messages, allocate_seqs(channel_id, len(channel_messages))):
+            message.seq = seq
+
+
+def create_message(**fields):
+    # Numbered by the pre_save signal, in the same transaction as the insert
+    with transaction.atomic():
+        return Message.objects.create(**fields)
+
+
+def edit_message(channel_id, message_id, user, content):
+    """Replace the content of the user's own message and return it"""
+    with transaction.atomic():
+        message = Message.objects.select_related('sender').filter(
+            id=message_id, channel_id=channel_id
+        ).first()
+        if message is None:
+            raise ObjectDoesNotExist('Message not found')
+        if message.sender_id != user.id:
+            raise PermissionDenied('You can only edit your own messages')
+
+        message.content = content
+        message.edited = True
+        message.edited_at = timezone.now()
+        number_messages([message])
+        message.save(update_fields=['content', 'edited', 'edited_at', 'seq'])
+    return message
+
+
+def delete_message(channel_id, message_id, user):
+    """
+    Delete a message, and the replies of a thread parent with it. Senders
+    delete their own messages, channel creators any. Returns the tombstones.
+    """
+    with transaction.atomic():
+        message = Message.objects.select_related('channel').filter(
+            id=message_id, channel_id=channel_id
+        ).first()
+        if message is None:
+            raise ObjectDoesNotExist('Message not found')
+        if user.id not in (message.sender_id, message.channel.created_by_id):
+            raise PermissionDenied('You can only delete your own messages')
+
+        doomed = [(message.id, message.parent_id)]
+        if message.parent_id is None and message.reply_count:
+            doomed.extend(
+                Message.objects.filter(parent_id=message.id)
+                .order_by('timestamp', 'id')
+                .values_list('id', 'parent_id')
+            )
+        tombstones = MessageTombstone.objects.bulk_create([
+            MessageTombstone(channel_id=channel_id, message_id=id, parent_id=parent_id, seq=seq)
+            for (id, parent_id), seq in zip(doomed, allocate_seqs(channel_id, len(doomed)))
+        ])
+        Message.objects.filter(id__in=[id for id, _ in doomed]).delete()
+    return tombstones
+
+
+def changes_since(channel_id, since, limit=SYNC_PAGE_SIZE):
+    """
+    Changes with a seq above ``since`` in seq order, at most ``limit``.
+
+    Returns (messages, tombstones, seq, has_more): messages hold creates and
+    edits, seq is where the next call should continue from.
+    """
+    # Read first: everything up to it has committed, later changes wait
+    # for the next call
+    latest = Channel.objects.values_list('last_seq', flat=True).get(id=channel_id)
+    messages = list(
+        Message.objects.filter(channel_id=channel_id, seq__gt=since, seq__lte=latest)
+        .select_related('sender')
+        .order_by('seq')[:limit]
+    )
+    tombstones = list(
+        MessageTombstone.objects.filter(channel_id=channel_id, seq__gt=since, seq__lte=latest)
+        .order_by('seq')[:limit]
+    )
+    changes = sorted(messages + tombstones, key=lambda change: change.seq)
+    if len(changes) <= limit:
+        return messages, tombstones, latest, False
+
+    changes = changes[:limit]
+    messages = [change for change in changes if isinstance(change, Message)]
+    tombstones = [change for change in changes if isinstance(change, MessageTombstone)]
+    return messages, tombstones, changes[-1].seq, True
+
+
+def serialize_changes(channel_id, since, limit=SYNC_PAGE_SIZE):
+    """``changes_since`` as the payload of the changes endpoint and frame"""
+    from .serializers import MessageSerializer
+
+    messages, tombstones, seq, has_more = changes_since(channel_id, since, limit)
+    changes = [
+        {
+            'op': 'edit' if message.edited else 'create',
+            'seq': message.seq,
+            'message': row,
+        }
+        for message, row in zip(messages, MessageSerializer(messages, many=True).data)
+    ]
+    changes.extend(
+        {
+            'op': 'delete',
+            'seq': tombstone.seq,
+            'message_id': tombstone.message_id,
+            'parent_id': tombstone.parent_id,
+        }
+        for tombstone in tombstones
+    )
+    changes.sort(key=lambda change: change['seq'])
+    return {
+        'channel_id': channel_id,
+        'since': since,
+        'seq': seq,
+        'has_more': has_more,
+        # The client is ahead of the server, e.g. a restored database
+        'reset': seq < since,
+        'changes': changes,
+    }
@@ -1,13 +1,50 @@
+from datetime import datetime, timezone as dt_timezone
+
 from celery import shared_task
-from django.utils import timezone
-from .models import User
+from .models import Channel, User
+from .membership import add_channel_members
+from .presence import broadcast_sync, get_presence_store
+from . import archive, unread
+
+@shared_task
+def flush_presence():
+    """Announce users whose connections expired and bulk write last_seen"""
+    store = get_presence_store()
+    went_offline = store.sweep()
+    for user_id in went_offline:
+        broadcast_sync(user_id, False)
+
+    seen = store.drain_last_seen()
+    if seen:
+        User.objects.bulk_update(
+            [
+                User(id=user_id, last_seen=datetime.fromtimestamp(ts, tz=dt_timezone.utc), online=online)
+                for user_id, (ts, online) in seen.items()
+            ],
+            ['last_seen', 'online'],
+            batch_size=500
+        )
+    if went_offline:
+        User.objects.filter(id__in=went_offline).update(online=False)
+
 
 @shared_task
-def cleanup_presence():
-    """Mark users as offline if they haven't been seen in 5 minutes"""
-    threshold = timezone.now() - timezone.timedelta(minutes=5)
-    User.objects.filter(
-        online=True,
-        last_seen__lt=threshold
-    ).update(online=False)
+def flush_read_cursors():
+    """Bulk write read cursors buffered in the unread store"""
+    return unread.flush_read_cursors()
 
+
+@shared_task
+def propagate_team_members(team_id, user_ids):
+    """Add new team members to every public channel of the team"""
+    channel_ids = Channel.objects.filter(
+        team_id=team_id, channel_type='public', is_active=True
+    ).values_list('id', flat=True)
+    for channel_id in channel_ids:
+        add_channel_members(channel_id, user_ids)
+
+
+@shared_task
+def archive_messages():
+    """Move messages older than CHAT_ARCHIVE_AFTER_DAYS to the archive tier"""
+    return archive.archive_messages()
@@ -0,0 +1,320 @@
+"""
+Run with the in-process stores of the benchmark settings, so neither Redis
+nor a running server is needed:
+
+    python manage.py test chat --settings=benchmarks.settings
+"""
+import asyncio
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import archive, membership, middleware
+from .highlight import Highlighter
+from .membership import MembershipCache
+from .outbound import OutboundQueue
+from .models import Channel, Message, Team, User, UserChannelLastSeen
+from .transfer import SenderMap, import_lines
+from .unread import MemoryUnreadStore, mark_read, unread_counts
+
+
+class HighlightTests(TestCase):
+    def test_snippets_are_escaped(self):
+        snippets, matches = Highlighter('deploy', context=None).highlight(
+            '<script>alert(1)</script> deploy <b>now</b>'
+        )
+        self.assertEqual(matches, [[26, 32]])
+        self.assertEqual(snippets, [
+            '&lt;script&gt;alert(1)&lt;/script&gt; <mark>deploy</mark> &lt;b&gt;now&lt;/b&gt;'
+        ])
+
+    def test_marked_text_is_escaped(self):
+        snippets, _ = Highlighter('a<b', context=None).highlight('x a<b y')
+        self.assertEqual(snippets, ['x <mark>a&lt;b</mark> y'])
+
+    def test_search_view_escapes_highlights(self):
+        user = User.objects.create_user('sadaf', password='x')
+        channel = Channel.objects.create(name='general', channel_type='public', created_by=user)
+        channel.members.add(user)
+        # Stored unescaped, like messages from the socket and import paths
+        Message.objects.create(
+            channel=channel, sender=user, content='<script>alert(1)</script> deploy'
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.get(reverse('message-search', args=[channel.id]), {'q': 'deploy'})
+
+        self.assertEqual(response.status_code, 200)
+        highlights = response.json()['results'][0]['highlights']
+        self.assertEqual(highlights, ['&lt;script&gt;alert(1)&lt;/script&gt; <mark>deploy</mark>'])
+
+
+class ListQueryCountTests(TestCase):
+    """Team and channel lists cost the same number of queries for any size"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('sadaf', password='x')
+        self.others = [User.objects.create_user(f'member{i}', password='x') for i in range(5)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # Unread counters are seeded from the database once per user
+        unread_counts(self.user.id)
+
+    def add_channels(self, count):
+        for _ in range(count):
+            team = Team.objects.create(name=f'team{Team.objects.count()}', created_by=self.user)
+            team.members.add(self.user, *self.others)
+            channel = Channel.objects.create(
+                name=f'channel{Channel.objects.count()}', team=team,
+                channel_type='public', created_by=self.user,
+            )
+            channel.members.add(self.user, *self.others)
+            Message.objects.create(channel=channel, sender=self.others[0], content='hello')
+
+    def assertQueriesPerPage(self, url, params, queries):
+        for count, total in ((1, 1), (9, 10)):
+            self.add_channels(count)
+            with self.assertNumQueries(queries):
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['count'], total)
+
+    def test_channel_list(self):
+        self.assertQueriesPerPage(reverse('channel-list'), {}, 3)
+
+    def test_channel_summary(self):
+        self.assertQueriesPerPage(reverse('channel-list'), {'view': 'summary'}, 3)
+
+    def test_team_list(self):
+        self.assertQueriesPerPage(reverse('team-list'), {}, 3)
+
+    def test_team_summary(self):
+        self.assertQueriesPerPage(reverse('team-list'), {'view': 'summary'}, 2)
+
+
+class UnreadSeedTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('sadaf', password='x')
+        self.sender = User.objects.create_user('neha', password='x')
+        self.channel = Channel.objects.create(name='general', channel_type='public', created_by=self.sender)
+        self.channel.members.add(self.user, self.sender)
+        self.messages = [
+            Message.objects.create(channel=self.channel, sender=self.sender, content=f'message {i}')
+            for i in range(5)
+        ]
+        self.store = MemoryUnreadStore()
+        patcher = mock.patch('chat.unread._store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_channel_without_cursor_counts_every_message(self):
+        self.assertEqual(unread_counts(self.user.id), {self.channel.id: 5})
+
+    def test_database_cursor(self):
+        UserChannelLastSeen.objects.create(
+            user=self.user, channel=self.channel, last_read_message=self.messages[1]
+        )
+        self.assertEqual(unread_counts(self.user.id), {self.channel.id: 3})
+
+    def test_read_receipt_leaves_later_messages_unread(self):
+        unread_counts(self.user.id)
+        self.assertTrue(mark_read(self.user.id, self.channel.id, self.messages[2].id))
+        self.assertEqual(unread_counts(self.user.id), {self.channel.id: 2})
+
+    def test_late_read_receipt_keeps_unread_count(self):
+        unread_counts(self.user.id)
+        mark_read(self.user.id, self.channel.id, self.messages[3].id)
+        self.store.increment(self.channel.id, [self.user.id])
+
+        mark_read(self.user.id, self.channel.id, self.messages[1].id)
+        mark_read(self.user.id, self.channel.id, self.messages[3].id)
+
+        self.assertEqual(unread_counts(self.user.id), {self.channel.id: 2})
+        self.assertEqual(self.store.get_cursor(self.user.id, self.channel.id), self.messages[3].id)
+
+    def test_read_receipt_for_another_channel_is_refused(self):
+        other = Channel.objects.create(name='random', channel_type='public', created_by=self.sender)
+        message = Message.objects.create(channel=other, sender=self.sender, content='elsewhere')
+        unread_counts(self.user.id)
+
+        self.assertFalse(mark_read(self.user.id, self.channel.id, message.id))
+        self.assertIsNone(self.store.get_cursor(self.user.id, self.channel.id))
+        self.assertEqual(unread_counts(self.user.id), {self.channel.id: 5})
+
+    def test_store_cursor_wins_over_unflushed_database_cursor(self):
+        UserChannelLastSeen.objects.create(
+            user=self.user, channel=self.channel, last_read_message=self.messages[1]
+        )
+        self.store.mark_read(self.user.id, self.channel.id, self.messages[3].id)
+        self.assertEqual(unread_counts(self.user.id), {self.channel.id: 1})
+
+
+class MembershipAuthorizationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('sadaf', password='x')
+        self.channel = Channel.objects.create(name='general', channel_type='public', created_by=self.user)
+        self.channel.members.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_view_denies_member_removed_by_another_worker(self):
+        # The cache of this process still says member, as it would when the
+        # removal happened on a worker whose invalidation never arrived
+        stale = MembershipCache()
+        stale.set(self.channel.id, self.user.id, True)
+        Channel.members.through.objects.filter(channel=self.channel, user=self.user).delete()
+
+        with mock.patch('chat.membership.membership_cache', stale):
+            response = self.client.get(reverse('message-list', args=[self.channel.id]))
+
+        self.assertEqual(response.status_code, 403)
+
+
+class AuthUserCacheTests(TestCase):
+    def test_shared_cache_holds_no_password_hash(self):
+        user = User.objects.create_user('sadaf', password='x', avatar='https://example.com/a.png')
+        key = middleware._shared_key(str(user.id))
+        self.addCleanup(cache.delete, key)
+
+        middleware._load_user(str(user.id))
+        with self.assertNumQueries(0):
+            cached = middleware._load_user(str(user.id))
+
+        self.assertEqual(cache.get(key), {
+            'id': user.id, 'username': 'sadaf', 'is_active': True, 'avatar': 'https://example.com/a.png',
+        })
+        self.assertEqual((cached.pk, cached.username), (user.pk, 'sadaf'))
+        self.assertEqual(cached.password, '')
+
+
+class ImportTests(TestCase):
+    def test_malformed_lines_are_skipped_and_reported(self):
+        user = User.objects.create_user('sadaf', password='x')
+        channel = Channel.objects.create(name='general', channel_type='public', created_by=user)
+        lines = [
+            '{"id": 1, "sender": 7, "content": "first", "timestamp": "2024-01-01T10:00:00+00:00"}\n',
+            '{"id": 2, "sender": 7, "content": "no timestamp"}\n',
+            '{"id": 3, "sender": 7, "content": "cut off", "timest\n',
+            '\n',
+            '{"id": 4, "sender": 7, "content": "last", "timestamp": "2024-01-01T10:01:00+00:00"}\n',
+        ]
+
+        stats = import_lines(channel.id, lines, SenderMap(default=user.id))
+
+        self.assertEqual(
+            list(Message.objects.filter(channel=channel).order_by('timestamp').values_list('content', flat=True)),
+            ['first', 'last'],
+        )
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.invalid, 2)
+        self.assertEqual([error['line'] for error in stats.errors], [2, 3])
+
+
+class InvalidationListenerTests(SimpleTestCase):
+    async def test_failed_start_is_retried(self):
+        layer = mock.Mock()
+        layer.new_channel = mock.AsyncMock(side_effect=[ConnectionError('redis down'), 'listener'])
+        layer.group_add = mock.AsyncMock()
+        layer.receive = mock.AsyncMock(side_effect=asyncio.CancelledError)
+
+        with mock.patch('chat.membership.get_channel_layer', return_value=layer):
+            with self.assertRaises(ConnectionError):
+                await membership.ensure_invalidation_listener()
+            await membership.ensure_invalidation_listener()
+
+        layer.group_add.assert_awaited_once_with(membership.INVALIDATION_GROUP, 'listener')
+        listener = membership._listeners.pop(asyncio.get_running_loop())
+        listener.cancel()
+
+
+class FakeTransport:
+    """Stands in for the Twisted transport of a Daphne connection"""
+
+    def __init__(self):
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class OutboundQueueTests(SimpleTestCase):
+    async def test_full_transport_buffer_backs_frames_up_into_a_resync(self):
+        written = []
+
+        async def write(frame):
+            written.append(frame)
+
+        async def close(code):
+            pass
+
+        transport = FakeTransport()
+        queue = OutboundQueue(write, lambda: 'resync', close, high_water=3, transport=transport)
+        self.assertIs(transport.producer, queue)
+
+        await queue.put('a')
+        await asyncio.sleep(0)
+        transport.producer.pauseProducing()
+        for frame in 'bcde':
+            await queue.put(frame)
+            await asyncio.sleep(0)
+        self.assertEqual(written, ['a'])
+
+        transport.producer.resumeProducing()
+        await asyncio.sleep(0)
+        self.assertEqual(written, ['a', 'resync', 'e'])
+
+        queue.stop()
+        self.assertIsNone(transport.producer)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('sadaf', password='x')
+        self.sender = User.objects.create_user('neha', password='x')
+        self.channel = Channel.objects.create(name='general', channel_type='public', created_by=self.sender)
+        self.channel.members.add(self.user, self.sender)
+
+    def row(self, message_id, day, parent=None):
+        return {
+            'id': message_id, 'parent': parent, 'sender': self.sender.id, 'content': f'message {message_id}',
+            'timestamp': datetime(2023, 3, day, tzinfo=dt_timezone.utc).isoformat(),
+        }
+
+    def test_older_rows_reads_months_that_overlap(self):
+        # The January thread got its reply in March, after the March messages
+        january = self.row(1, 5)
+        january['timestamp'] = datetime(2023, 1, 5, tzinfo=dt_timezone.utc).isoformat()
+        archive._store(self.channel.id, date(2023, 1, 1), [january, self.row(2, 20, parent=1)])
+        archive._store(self.channel.id, date(2023, 3, 1), [self.row(3, 1), self.row(4, 2), self.row(5, 10)])
+
+        rows, more = archive.older_rows(self.channel.id, None, 2, lambda row: True)
+
+        self.assertEqual([row['id'] for row in rows], [2, 5])
+        self.assertTrue(more)
+
+    def test_archiving_keeps_unread_counts(self):
+        old = timezone.now() - timedelta(days=400)
+        read = [
+            Message.objects.create(channel=self.channel, sender=self.sender, content='old', timestamp=old)
+            for _ in range(2)
+        ]
+        Message.objects.create(channel=self.channel, sender=self.sender, content='new')
+        UserChannelLastSeen.objects.create(user=self.user, channel=self.channel, last_read_message=read[1])
+        store = MemoryUnreadStore()
+        with mock.patch('chat.unread._store', store):
+            self.assertEqual(unread_counts(self.user.id), {self.channel.id: 1})
+
+        archive.archive_messages(before=timezone.now() - timedelta(days=365))
+
+        self.assertEqual(Message.objects.filter(channel=self.channel).count(), 1)
+        with mock.patch('chat.unread._store', MemoryUnreadStore()):
+            self.assertEqual(unread_counts(self.user.id), {self.channel.id: 1})
@@ -0,0 +1,71 @@
+"""
+Thread replies.
+
+A reply is a Message with ``parent`` set to a top-level message of the same
+channel. Replies are fanned out to the ``thread_<parent_id>`` group only,
+so just the sockets that opened the thread receive them; the channel gets
+a small ``thread_reply`` frame to bump its counters. ``reply_count`` and
+``last_reply_at`` on the parent are kept up to date here with single
+``UPDATE ... SET reply_count = reply_count + n`` statements.
+"""
+from django.conf import settings
+from django.db.models import DateTimeField, F, Max, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from . import history_cache
+from .models import Message
+
+MAX_THREAD_SUBSCRIPTIONS = getattr(settings, 'CHAT_MAX_THREAD_SUBSCRIPTIONS', 100)
+
+
+def thread_group(parent_id):
+    return f'thread_{parent_id}'
+
+
+def get_thread_parent(channel_id, parent_id):
+    """The top-level message of ``channel_id`` a reply may attach to, or None"""
+    return Message.objects.filter(
+        id=parent_id, channel_id=channel_id, parent__isnull=True
+    ).only('id', 'channel_id').first()
+
+
+def _refresh_cached_parents(parent_ids):
+    from .serializers import MessageSerializer
+
+    parents = Message.objects.filter(id__in=parent_ids).select_related('sender')
+    rows = {}
+    for parent in parents:
+        rows.setdefault(parent.channel_id, []).append(MessageSerializer(parent).data)
+    for channel_id, channel_rows in rows.items():
+        history_cache.update(channel_id, channel_rows)
+
+
+def record_replies(replies):
+    """Count new replies on their parents, one UPDATE per thread"""
+    threads = {}
+    for reply in replies:
+        if reply.parent_id is None:
+            continue
+        count, last = threads.get(reply.parent_id, (0, reply.timestamp))
+        threads[reply.parent_id] = (count + 1, max(last, reply.timestamp))
+    if not threads:
+        return
+
+    for parent_id, (count, last) in threads.items():
+        last = Value(last, output_field=DateTimeField())
+        Message.objects.filter(id=parent_id).update(
+            reply_count=F('reply_count') + count,
+            # Greatest is NULL on SQLite if either side is
+            last_reply_at=Greatest(Coalesce('last_reply_at', last), last),
+        )
+    _refresh_cached_parents(threads)
+
+
+def forget_reply(reply):
+    """Undo ``record_replies`` for a deleted reply"""
+    last = Message.objects.filter(parent_id=reply.parent_id).aggregate(last=Max('timestamp'))['last']
+    Message.objects.filter(id=reply.parent_id, reply_count__gt=0).update(
+        reply_count=F('reply_count') - 1,
+        last_reply_at=last,
+    )
+    _refresh_cached_parents([reply.parent_id])
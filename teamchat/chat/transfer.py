@@ -0,0 +1,264 @@
+"""
+Streaming NDJSON export and import of channel history.
+
+One message per line, oldest first:
+
+    {"id": 1, "parent": null, "sender": 3, "username": "sadaf",
+     "content": "...", "timestamp": "...", "edited": false,
+     "edited_at": null, "reply_count": 2}
+
+The exporter reads archived months first and then the hot table through
+``.iterator(chunk_size=...)``, encoding a chunk of rows at a time, so memory
+stays flat however long the channel is. The importer inserts chunks with
+``bulk_create``, maps foreign sender ids to local users and only remembers
+the ids of messages that have replies, so files from other chat systems of
+any size can be loaded as long as parents come before their replies.
+"""
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from . import history_cache, sync, threads
+from .archive import decompress
+from .encoding import encode_frame
+from .models import Message, MessageArchive
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 2000)
+IMPORT_CHUNK_SIZE = getattr(settings, 'CHAT_IMPORT_CHUNK_SIZE', 1000)
+# Malformed lines reported with their line number, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+EXPORT_FIELDS = (
+    'id', 'parent', 'sender', 'username', 'content', 'timestamp', 'edited', 'edited_at', 'reply_count'
+)
+
+
+class TransferStats:
+    """Rows moved and throughput, for reports"""
+
+    def __init__(self):
+        self.count = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    def reject(self, line_number, error):
+        """Count a malformed line, keeping the first few reasons"""
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line_number, 'error': str(error)})
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        seconds = self.seconds
+        report = {
+            'messages': self.count,
+            'skipped': self.skipped,
+            'seconds': round(seconds, 3),
+            'messages_per_s': round(self.count / seconds, 1) if seconds else None,
+        }
+        if self.invalid:
+            report['invalid'] = self.invalid
+            report['errors'] = self.errors
+        return report
+
+
+def _encode(rows):
+    return ''.join(encode_frame(row) + '\n' for row in rows).encode()
+
+
+def export_chunks(channel_id, chunk_size=EXPORT_CHUNK_SIZE, stats=None):
+    """Yield the channel's history as NDJSON, one bytes chunk per ``chunk_size`` rows"""
+    stats = stats or TransferStats()
+
+    # Archived months are older than the hot tier, one month in memory at a time
+    archives = MessageArchive.objects.filter(channel_id=channel_id).order_by('month')
+    for archive_id in archives.values_list('id', flat=True):
+        codec, data = MessageArchive.objects.values_list('codec', 'data').get(id=archive_id)
+        rows = [{field: row.get(field) for field in EXPORT_FIELDS} for row in decompress(codec, data)]
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            stats.count += len(chunk)
+            yield _encode(chunk)
+
+    hot = (
+        Message.objects.filter(channel_id=channel_id)
+        .order_by('timestamp', 'id')
+        .values_list(
+            'id', 'parent_id', 'sender_id', 'sender__username', 'content',
+            'timestamp', 'edited', 'edited_at', 'reply_count',
+        )
+        .iterator(chunk_size=chunk_size)
+    )
+    chunk = []
+    for values in hot:
+        row = dict(zip(EXPORT_FIELDS, values))
+        row['timestamp'] = row['timestamp'].isoformat()
+        if row['edited_at'] is not None:
+            row['edited_at'] = row['edited_at'].isoformat()
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            stats.count += len(chunk)
+            yield _encode(chunk)
+            chunk = []
+    if chunk:
+        stats.count += len(chunk)
+        yield _encode(chunk)
+
+
+async def aexport_chunks(channel_id, chunk_size=EXPORT_CHUNK_SIZE, stats=None):
+    """
+    ``export_chunks`` for ASGI responses: each chunk is read in the
+    database thread, so the export streams instead of being collected into
+    a list by Django's sync iterator fallback.
+    """
+    chunks = export_chunks(channel_id, chunk_size, stats)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    while True:
+        chunk = await next_chunk(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+class SenderMap:
+    """
+    Maps sender ids of an imported file to local user ids: explicitly
+    through ``mapping``, by matching usernames, or to ``default``.
+    """
+
+    def __init__(self, mapping=None, match_usernames=False, default=None):
+        self.mapping = {str(source): target for source, target in (mapping or {}).items()}
+        self.match_usernames = match_usernames
+        self.default = default
+        self._usernames = {}
+
+    def resolve(self, rows):
+        """Local user id per row, None for rows that can't be mapped"""
+        if self.match_usernames:
+            wanted = {
+                row.get('username') for row in rows
+                if str(row.get('sender')) not in self.mapping and row.get('username') not in self._usernames
+            }
+            wanted.discard(None)
+            if wanted:
+                found = dict(
+                    get_user_model().objects.filter(username__in=wanted).values_list('username', 'id')
+                )
+                self._usernames.update({username: found.get(username) for username in wanted})
+
+        resolved = []
+        for row in rows:
+            user_id = self.mapping.get(str(row.get('sender')))
+            if user_id is None and self.match_usernames:
+                user_id = self._usernames.get(row.get('username'))
+            resolved.append(user_id if user_id is not None else self.default)
+        return resolved
+
+
+def _parse_datetime(value, field):
+    if not isinstance(value, str):
+        raise ValueError(f'{field} must be an ISO 8601 string')
+    # None for strings in another format, ValueError for impossible dates
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'{field} must be an ISO 8601 string')
+    return parsed
+
+
+def parse_row(line):
+    """
+    Decode one NDJSON line into a row ready for ``_import_chunk``, with
+    timestamps parsed. Raises ValueError for anything that can't be imported.
+    """
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError('not a JSON object')
+    if not isinstance(row.get('content'), str):
+        raise ValueError('content must be a string')
+    for field in ('id', 'parent'):
+        if row.get(field) is not None and (
+            isinstance(row[field], bool) or not isinstance(row[field], (int, str))
+        ):
+            raise ValueError(f'{field} must be an integer or a string')
+    if not isinstance(row.get('edited', False), bool):
+        raise ValueError('edited must be true or false')
+    row['timestamp'] = _parse_datetime(row.get('timestamp'), 'timestamp')
+    if row.get('edited_at') is not None:
+        row['edited_at'] = _parse_datetime(row['edited_at'], 'edited_at')
+    return row
+
+
+def import_lines(channel_id, lines, senders, chunk_size=IMPORT_CHUNK_SIZE, stats=None):
+    """
+    Insert NDJSON ``lines`` into a channel in chunks of ``chunk_size``.
+    Rows without a local sender, or replies whose parent was not imported,
+    are skipped and counted. Malformed lines are skipped too and reported
+    with their line number in ``stats.errors``.
+    """
+    stats = stats or TransferStats()
+    # Source id -> local id, only for messages that have replies
+    parents = {}
+    chunk = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            chunk.append(parse_row(line))
+        except ValueError as error:
+            stats.reject(line_number, error)
+            continue
+        if len(chunk) >= chunk_size:
+            _import_chunk(channel_id, chunk, senders, parents, stats)
+            chunk = []
+    if chunk:
+        _import_chunk(channel_id, chunk, senders, parents, stats)
+
+    history_cache.invalidate(channel_id)
+    return stats
+
+
+def _import_chunk(channel_id, rows, senders, parents, stats):
+    messages, sources = [], []
+    for row, sender_id in zip(rows, senders.resolve(rows)):
+        parent_id = None
+        if row.get('parent') is not None:
+            parent_id = parents.get(row['parent'])
+            if parent_id is None:
+                sender_id = None
+        if sender_id is None:
+            stats.skipped += 1
+            continue
+        messages.append(Message(
+            channel_id=channel_id,
+            sender_id=sender_id,
+            content=row['content'],
+            timestamp=row['timestamp'],
+            edited=row.get('edited', False),
+            edited_at=row.get('edited_at'),
+            parent_id=parent_id,
+        ))
+        sources.append(row)
+    if not messages:
+        return
+
+    with transaction.atomic():
+        sync.number_messages(messages)
+        messages = Message.objects.bulk_create(messages)
+        threads.record_replies(messages)
+
+    for message, row in zip(messages, sources):
+        # Without a reply_count every top-level message may be a parent
+        if message.parent_id is None and row.get('id') is not None and row.get('reply_count', 1):
+            parents[row['id']] = message.id
+    stats.count += len(messages)
@@ -0,0 +1,98 @@
+"""
+Typing indicators.
+
+``typing`` frames from clients are never stored and skip the message rate
+limiter. Each process broadcasts a user's typing in a channel at most once
+per ``CHAT_TYPING_INTERVAL`` seconds, and collects the typists of a channel
+for ``CHAT_TYPING_BATCH_MS`` into one ``typing`` frame listing all of them,
+so hundreds of people typing cost a few frames per channel per interval.
+Indicators expire on their own: clients drop a user ``expires_in`` seconds
+after the last frame that listed them, or as soon as that user's message
+arrives.
+"""
+import asyncio
+import time
+import weakref
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import groups
+from .encoding import frame_event
+
+TYPING_INTERVAL = getattr(settings, 'CHAT_TYPING_INTERVAL', 3)
+TYPING_BATCH_MS = getattr(settings, 'CHAT_TYPING_BATCH_MS', 250)
+# Long enough to span the gap between two broadcasts of a user still typing
+TYPING_EXPIRES_IN = TYPING_INTERVAL * 2
+
+
+class TypingBroadcaster:
+    """Per-process throttle and batcher for typing indicators"""
+
+    def __init__(self, interval=TYPING_INTERVAL, batch_interval=TYPING_BATCH_MS / 1000):
+        self.interval = interval
+        self.batch_interval = batch_interval
+        # (channel_id, user_id) -> when the user was last broadcast
+        self._last = {}
+        # channel_id -> {user_id: username} waiting for the next batch
+        self._pending = {}
+        self._timers = {}
+        self._tasks = set()
+
+    def typing(self, channel_id, user_id, username):
+        """Note that a user is typing; False if it was throttled"""
+        key = (channel_id, user_id)
+        now = time.monotonic()
+        if now - self._last.get(key, -self.interval) < self.interval:
+            return False
+        self._last[key] = now
+        self._pending.setdefault(channel_id, {})[user_id] = username
+        if channel_id not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[channel_id] = loop.call_later(self.batch_interval, self._flush_later, channel_id)
+        return True
+
+    def message_sent(self, channel_id, user_id):
+        # The message ends the indicator, the next keystroke starts a new one
+        self._last.pop((channel_id, user_id), None)
+        pending = self._pending.get(channel_id)
+        if pending is not None:
+            pending.pop(user_id, None)
+
+    def _flush_later(self, channel_id):
+        del self._timers[channel_id]
+        task = asyncio.ensure_future(self.flush(channel_id))
+        # Keep a reference so the task isn't garbage collected mid-send
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self, channel_id):
+        typists = self._pending.pop(channel_id, None)
+        self._expire()
+        if not typists:
+            return
+        await groups.group_send(get_channel_layer(), channel_id, frame_event('typing_indicator', {
+            'type': 'typing',
+            'channel_id': channel_id,
+            'users': [
+                {'user_id': user_id, 'username': username} for user_id, username in typists.items()
+            ],
+            'expires_in': TYPING_EXPIRES_IN,
+        }))
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.interval
+        for key in [key for key, last in self._last.items() if last < cutoff]:
+            del self._last[key]
+
+
+_broadcasters = weakref.WeakKeyDictionary()
+
+
+def get_typing_broadcaster():
+    """Return the broadcaster for the running event loop"""
+    loop = asyncio.get_running_loop()
+    broadcaster = _broadcasters.get(loop)
+    if broadcaster is None:
+        broadcaster = _broadcasters[loop] = TypingBroadcaster()
+    return broadcaster
@@ -0,0 +1,414 @@
+"""
+Unread counters and read cursors.
+
+Counters live in a store per (user, channel): fan-out increments them for
+every member but the sender and a read receipt sets them to what is left
+after the receipt's message, so the channel list reads all badges for a user
+in one round trip. Receipts at or behind the cursor (late or duplicate ones)
+change nothing. Read cursors (the last
+message a user has read in a channel) are buffered in the store and
+upserted into ``UserChannelLastSeen`` in bulk by ``flush_read_cursors``.
+
+A user's counters are seeded from the database the first time they are
+read, so an empty store (new deployment, flushed Redis) self-heals. Seeding
+starts from the read cursors in the store when there are any, since the
+database copy lags until the next flush, and counts every message of a
+channel the user has no cursor in.
+"""
+import threading
+from functools import reduce
+from operator import or_
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .membership import channel_member_ids
+from .models import Channel, Message, UserChannelLastSeen
+
+
+class UnreadStore:
+    """
+    Base class for unread counter backends.
+
+    Sync methods serve views and tasks, the ``a``-prefixed ones the
+    consumers. ``get_counts`` returns None until ``seed`` was called for
+    the user.
+    """
+
+    def increment(self, channel_id, user_ids):
+        raise NotImplementedError
+
+    async def aincrement(self, channel_id, user_ids):
+        raise NotImplementedError
+
+    def mark_read(self, user_id, channel_id, message_id, unread=0):
+        """
+        Move the read cursor forward to ``message_id`` and set the counter to
+        ``unread``, the messages after it. Does nothing unless ``message_id``
+        is past the cursor.
+        """
+        raise NotImplementedError
+
+    async def amark_read(self, user_id, channel_id, message_id, unread=0):
+        raise NotImplementedError
+
+    def get_counts(self, user_id):
+        raise NotImplementedError
+
+    def seed(self, user_id, counts):
+        raise NotImplementedError
+
+    def get_cursor(self, user_id, channel_id):
+        raise NotImplementedError
+
+    def get_cursors(self, user_id):
+        """Return {channel_id: message_id} of every read cursor of a user in the store"""
+        raise NotImplementedError
+
+    def drain_read_cursors(self):
+        """Return and forget {(user_id, channel_id): message_id} since the last drain"""
+        raise NotImplementedError
+
+
+class MemoryUnreadStore(UnreadStore):
+    """Single-process store for tests and development"""
+
+    def __init__(self, **options):
+        self._counts = {}
+        self._cursors = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+
+    def increment(self, channel_id, user_ids):
+        channel_id = int(channel_id)
+        with self._lock:
+            for user_id in user_ids:
+                counts = self._counts.get(user_id)
+                if counts is not None:
+                    counts[channel_id] = counts.get(channel_id, 0) + 1
+
+    async def aincrement(self, channel_id, user_ids):
+        self.increment(channel_id, user_ids)
+
+    def mark_read(self, user_id, channel_id, message_id, unread=0):
+        key = (int(user_id), int(channel_id))
+        with self._lock:
+            if message_id <= self._cursors.get(key, 0):
+                return
+            self._cursors[key] = message_id
+            self._dirty[key] = message_id
+            counts = self._counts.get(key[0])
+            if counts is not None:
+                counts[key[1]] = unread
+
+    async def amark_read(self, user_id, channel_id, message_id, unread=0):
+        self.mark_read(user_id, channel_id, message_id, unread)
+
+    def get_counts(self, user_id):
+        with self._lock:
+            counts = self._counts.get(int(user_id))
+            return None if counts is None else dict(counts)
+
+    def seed(self, user_id, counts):
+        with self._lock:
+            self._counts[int(user_id)] = dict(counts)
+
+    def get_cursor(self, user_id, channel_id):
+        with self._lock:
+            return self._cursors.get((int(user_id), int(channel_id)))
+
+    def get_cursors(self, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            return {
+                channel_id: message_id
+                for (owner, channel_id), message_id in self._cursors.items()
+                if owner == user_id
+            }
+
+    def drain_read_cursors(self):
+        with self._lock:
+            drained, self._dirty = self._dirty, {}
+            return drained
+
+
+MARK_READ_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+if tonumber(ARGV[2]) <= current then
+    return
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[3], ARGV[2])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[4])
+end
+"""
+
+INCREMENT_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('HINCRBY', key, ARGV[1], 1)
+    end
+end
+"""
+
+
+class RedisUnreadStore(UnreadStore):
+    """
+    Counters shared by every worker.
+
+    Each user has a hash of channel -> unread count and a hash of
+    channel -> last read message id; cursors waiting to be flushed sit in
+    one ``dirty`` hash that the flush task reads and clears in one
+    transaction. Counters are only incremented for seeded users.
+    """
+
+    def __init__(self, url='redis://127.0.0.1:6379/0', prefix='unread'):
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+            self._mark_read_script = self._client.register_script(MARK_READ_SCRIPT)
+            self._increment_script = self._client.register_script(INCREMENT_SCRIPT)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import redis.asyncio
+            self._async_client = redis.asyncio.Redis.from_url(self.url)
+            self._async_mark_read_script = self._async_client.register_script(MARK_READ_SCRIPT)
+            self._async_increment_script = self._async_client.register_script(INCREMENT_SCRIPT)
+        return self._async_client
+
+    def _counts_key(self, user_id):
+        return f'{self.prefix}:counts:{user_id}'
+
+    def _cursors_key(self, user_id):
+        return f'{self.prefix}:cursors:{user_id}'
+
+    @property
+    def _dirty_key(self):
+        return f'{self.prefix}:dirty'
+
+    def _mark_read_call(self, user_id, channel_id, message_id, unread):
+        return {
+            'keys': [self._counts_key(user_id), self._cursors_key(user_id), self._dirty_key],
+            'args': [int(channel_id), int(message_id), f'{user_id}:{channel_id}', int(unread)],
+        }
+
+    def increment(self, channel_id, user_ids):
+        keys = [self._counts_key(user_id) for user_id in user_ids]
+        if keys:
+            client = self.client
+            self._increment_script(keys=keys, args=[int(channel_id)], client=client)
+
+    async def aincrement(self, channel_id, user_ids):
+        keys = [self._counts_key(user_id) for user_id in user_ids]
+        if keys:
+            client = self.async_client
+            await self._async_increment_script(keys=keys, args=[int(channel_id)], client=client)
+
+    def mark_read(self, user_id, channel_id, message_id, unread=0):
+        client = self.client
+        self._mark_read_script(
+            **self._mark_read_call(user_id, channel_id, message_id, unread), client=client
+        )
+
+    async def amark_read(self, user_id, channel_id, message_id, unread=0):
+        client = self.async_client
+        await self._async_mark_read_script(
+            **self._mark_read_call(user_id, channel_id, message_id, unread), client=client
+        )
+
+    def get_counts(self, user_id):
+        counts = self.client.hgetall(self._counts_key(user_id))
+        if not counts:
+            return None
+        # The ``seeded`` field marks users whose counters are complete
+        counts.pop(b'seeded', None)
+        return {int(channel_id): int(count) for channel_id, count in counts.items()}
+
+    def seed(self, user_id, counts):
+        key = self._counts_key(user_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(key, mapping={'seeded': 1, **{str(c): n for c, n in counts.items()}})
+        pipe.execute()
+
+    def get_cursor(self, user_id, channel_id):
+        cursor = self.client.hget(self._cursors_key(user_id), int(channel_id))
+        return None if cursor is None else int(cursor)
+
+    def get_cursors(self, user_id):
+        cursors = self.client.hgetall(self._cursors_key(user_id))
+        return {int(channel_id): int(message_id) for channel_id, message_id in cursors.items()}
+
+    def drain_read_cursors(self):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hgetall(self._dirty_key)
+        pipe.delete(self._dirty_key)
+        dirty, _ = pipe.execute()
+        drained = {}
+        for key, message_id in dirty.items():
+            user_id, channel_id = key.decode().split(':')
+            drained[(int(user_id), int(channel_id))] = int(message_id)
+        return drained
+
+
+_store = None
+
+
+def get_unread_store():
+    """Return the store configured by ``CHAT_UNREAD_STORE``"""
+    global _store
+    if _store is None:
+        config = getattr(settings, 'CHAT_UNREAD_STORE', {})
+        backend = import_string(config.get('BACKEND', 'chat.unread.MemoryUnreadStore'))
+        _store = backend(**config.get('OPTIONS', {}))
+    return _store
+
+
+async def message_posted(channel_id, sender_id, message_id=None):
+    """Count a new message as unread for everyone in the channel but the sender"""
+    members = await channel_member_ids(channel_id)
+    store = get_unread_store()
+    await store.aincrement(channel_id, [user_id for user_id in members if user_id != sender_id])
+    if message_id is not None:
+        # Posting in a channel means the sender has caught up with it
+        await store.amark_read(sender_id, channel_id, message_id)
+
+
+def _unread_after(user_id, channel_id, message_id):
+    """
+    Messages others posted in the channel after ``message_id``, counted the
+    way fan-out counts them, or None if the message is not in the channel.
+    """
+    counts = Message.objects.filter(channel_id=channel_id, id__gte=message_id).aggregate(
+        found=Count('id', filter=Q(id=message_id)),
+        unread=Count('id', filter=Q(id__gt=message_id, parent__isnull=True) & ~Q(sender_id=user_id)),
+    )
+    return counts['unread'] if counts['found'] else None
+
+
+def mark_read(user_id, channel_id, message_id):
+    """
+    Apply a read receipt: move the cursor to ``message_id`` and recount the
+    messages after it. Returns False, changing nothing, if the message is
+    not in the channel.
+    """
+    unread = _unread_after(user_id, channel_id, message_id)
+    if unread is None:
+        return False
+    get_unread_store().mark_read(user_id, channel_id, message_id, unread)
+    return True
+
+
+async def amark_read(user_id, channel_id, message_id):
+    unread = await database_sync_to_async(_unread_after)(user_id, channel_id, message_id)
+    if unread is None:
+        return False
+    await get_unread_store().amark_read(user_id, channel_id, message_id, unread)
+    return True
+
+
+def _count_from_database(user_id, cursors):
+    """
+    Unread counts for all of a user's channels in three queries. ``cursors``
+    are the read cursors in the store, which can be ahead of the database
+    until they are flushed; channels without any cursor count every message.
+    """
+    channel_ids = list(
+        Channel.members.through.objects.filter(user_id=user_id).values_list('channel_id', flat=True)
+    )
+    visits = {
+        channel_id: (last_read_id, last_seen)
+        for channel_id, last_read_id, last_seen in UserChannelLastSeen.objects.filter(
+            user_id=user_id, channel_id__in=channel_ids
+        ).values_list('channel_id', 'last_read_message_id', 'last_seen')
+    }
+    conditions = []
+    unread_from_start = []
+    for channel_id in channel_ids:
+        last_read_id = cursors.get(channel_id)
+        if last_read_id is None and channel_id in visits:
+            last_read_id, last_seen = visits[channel_id]
+            if last_read_id is None:
+                conditions.append(Q(channel_id=channel_id, timestamp__gt=last_seen))
+                continue
+        if last_read_id is None:
+            unread_from_start.append(channel_id)
+        else:
+            conditions.append(Q(channel_id=channel_id, id__gt=last_read_id))
+    if unread_from_start:
+        conditions.append(Q(channel_id__in=unread_from_start))
+
+    counts = dict.fromkeys(channel_ids, 0)
+    if conditions:
+        rows = (
+            Message.objects.filter(reduce(or_, conditions), parent__isnull=True)
+            .exclude(sender_id=user_id)
+            .order_by()
+            .values('channel_id')
+            .annotate(unread=Count('id'))
+        )
+        counts.update({row['channel_id']: row['unread'] for row in rows})
+    return counts
+
+
+def unread_counts(user_id):
+    """Return {channel_id: unread} for a user, seeding the store on a miss"""
+    store = get_unread_store()
+    counts = store.get_counts(user_id)
+    if counts is None:
+        counts = _count_from_database(user_id, store.get_cursors(user_id))
+        store.seed(user_id, counts)
+    return counts
+
+
+def read_cursor(user_id, channel_id):
+    """Last message id the user has read in the channel, or None"""
+    cursor = get_unread_store().get_cursor(user_id, channel_id)
+    if cursor is None:
+        cursor = UserChannelLastSeen.objects.filter(
+            user_id=user_id, channel_id=channel_id
+        ).values_list('last_read_message_id', flat=True).first()
+    return cursor
+
+
+def flush_read_cursors():
+    """Upsert buffered read cursors into ``UserChannelLastSeen``"""
+    cursors = get_unread_store().drain_read_cursors()
+    if not cursors:
+        return 0
+
+    # Drop cursors pointing at messages that were deleted or belong elsewhere
+    valid = set(
+        Message.objects.filter(id__in={message_id for message_id in cursors.values()})
+        .values_list('id', 'channel_id')
+    )
+    now = timezone.now()
+    visits = [
+        UserChannelLastSeen(
+            user_id=user_id, channel_id=channel_id, last_seen=now, last_read_message_id=message_id
+        )
+        for (user_id, channel_id), message_id in cursors.items()
+        if (message_id, channel_id) in valid
+    ]
+    UserChannelLastSeen.objects.bulk_create(
+        visits,
+        update_conflicts=True,
+        unique_fields=['user', 'channel'],
+        update_fields=['last_seen', 'last_read_message'],
+        batch_size=500,
+    )
+    return len(visits)
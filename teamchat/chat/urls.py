@@ -3,8 +3,16 @@ from .views import (
     UserProfileView,
     TeamListView,
     ChannelListView,
+    ChannelMemberListView,
+    TeamMemberListView,
     MessageListView,
     MessageSearchView,
+    ThreadView,
+    ChannelChangesView,
+    ChannelExportView,
+    UnreadCountsView,
+    ReadCursorView,
+    SocketStatsView,
     CustomLoginView,
     CustomSignupView,
 )
@@ -14,9 +22,17 @@ urlpatterns = [
     path('profile/', UserProfileView.as_view(), name='profile'),
     path('login/', CustomLoginView.as_view(), name='custom-login'),
     path('teams/', TeamListView.as_view(), name='team-list'),
+    path('teams/<int:team_id>/members/', TeamMemberListView.as_view(), name='team-members'),
     path('channels/', ChannelListView.as_view(), name='channel-list'),
+    path('channels/<int:channel_id>/members/', ChannelMemberListView.as_view(), name='channel-members'),
+    path('channels/unread/', UnreadCountsView.as_view(), name='channel-unread'),
+    path('channels/<int:channel_id>/read/', ReadCursorView.as_view(), name='channel-read'),
     path('channels/<int:channel_id>/messages/', MessageListView.as_view(), name='message-list'),
+    path('channels/<int:channel_id>/messages/<int:message_id>/thread/', ThreadView.as_view(), name='message-thread'),
+    path('channels/<int:channel_id>/changes/', ChannelChangesView.as_view(), name='channel-changes'),
+    path('channels/<int:channel_id>/export/', ChannelExportView.as_view(), name='channel-export'),
     path('channels/<int:channel_id>/search/', MessageSearchView.as_view(), name='message-search'),
+    path('stats/sockets/', SocketStatsView.as_view(), name='socket-stats'),
 
 ]
 
@@ -2,22 +2,50 @@ from rest_framework import generics, permissions
 from rest_framework.response import Response
 from rest_framework import serializers
 from rest_framework_simplejwt.tokens import RefreshToken
-from django.core.cache import cache
 from .models import User
 from .serializers import UserSerializer
 from .models import Channel, Message, Team
 from .serializers import (
     ChannelSerializer,
+    ChannelSummarySerializer,
+    FastMessageSerializer,
+    MemberSerializer,
     MessageSerializer,
     TeamSerializer,
+    TeamSummarySerializer,
     CustomSignupSerializer,
 )
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import PermissionDenied
 from .serializers import CustomLoginSerializer
-from django.db.models import Q
+from .ratelimit import SearchRateThrottle
+from .pagination import MessageCursorPagination
+from .search import get_search_backend
+from .highlight import Highlighter
+from .membership import (
+    add_channel_members,
+    add_team_members,
+    is_member_sync,
+    remove_channel_members,
+    remove_team_members,
+    sync_channel_members,
+    sync_team_members,
+)
+from .unread import mark_read, read_cursor, unread_counts
+from . import archive, history_cache, outbound
+from .transfer import TransferStats, aexport_chunks, export_chunks
+from .sync import SYNC_PAGE_SIZE, serialize_changes
+from django.db.models import Count, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
 from datetime import datetime
+import logging
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
 class CustomLoginView(APIView):
     def post(self, request):
         serializer = CustomLoginSerializer(data=request.data)
@@ -53,48 +81,385 @@ class UserProfileView(generics.RetrieveAPIView):
     def get_object(self):
         return self.request.user
     
+def wants_summary(request):
+    return request.method == 'GET' and request.query_params.get('view') == 'summary'
+
+
+def related_count(model, field):
+    """Correlated COUNT(*) of ``model`` rows whose ``field`` is the outer pk"""
+    rows = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field)
+    return Coalesce(Subquery(rows.annotate(count=Count('*')).values('count')), 0)
+
+
 class TeamListView(generics.ListCreateAPIView):
-    serializer_class = TeamSerializer
+    """
+    Teams of the current user. ``?view=summary`` drops the member ids in
+    favour of counts; members are listed by TeamMemberListView.
+    """
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_serializer_class(self):
+        return TeamSummarySerializer if wants_summary(self.request) else TeamSerializer
+
     def get_queryset(self):
-        return Team.objects.filter(members=self.request.user)
+        # Counted in subqueries so the list never joins every member row
+        teams = Team.objects.filter(
+            id__in=Team.members.through.objects.filter(user=self.request.user).values('team_id')
+        ).annotate(member_count=related_count(Team.members.through, 'team_id'))
+        if wants_summary(self.request):
+            return teams.annotate(channel_count=related_count(Channel, 'team_id'))
+        return teams.prefetch_related(Prefetch('members', queryset=User.objects.only('id')))
 
     def perform_create(self, serializer):
         # The create() method in serializer will handle this now
         serializer.save()
 
 class ChannelListView(generics.ListCreateAPIView):
-    serializer_class = ChannelSerializer
+    """
+    Channels of the current user. ``?view=summary`` returns member counts,
+    a preview of the last message and unread counts instead of member ids,
+    in the same number of queries for any page size; members are listed by
+    ChannelMemberListView.
+    """
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_serializer_class(self):
+        return ChannelSummarySerializer if wants_summary(self.request) else ChannelSerializer
+
     def get_queryset(self):
-        return Channel.objects.filter(members=self.request.user)
+        channels = Channel.objects.filter(
+            id__in=Channel.members.through.objects.filter(user=self.request.user).values('channel_id')
+        )
+        if wants_summary(self.request):
+            latest = Message.objects.filter(channel=OuterRef('pk')).order_by('-timestamp', '-id')
+            return channels.annotate(
+                member_count=related_count(Channel.members.through, 'channel_id'),
+                last_message_id=Subquery(latest.values('id')[:1]),
+            )
+        return channels.prefetch_related(Prefetch('members', queryset=User.objects.only('id')))
+
+    def list(self, request, *args, **kwargs):
+        if not wants_summary(request):
+            return super().list(request, *args, **kwargs)
+
+        channels = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        # One query for the previews of the whole page
+        last_messages = Message.objects.filter(
+            id__in=[channel.last_message_id for channel in channels if channel.last_message_id]
+        ).select_related('sender').only('id', 'content', 'timestamp', 'sender_id', 'sender__username')
+        context = self.get_serializer_context()
+        context['last_messages'] = {message.id: message for message in last_messages}
+        # Every badge from one read of the counter store
+        context['unread_counts'] = unread_counts(request.user.id)
+        serializer = ChannelSummarySerializer(channels, many=True, context=context)
+        return self.get_paginated_response(serializer.data)
 
     def perform_create(self, serializer):
         serializer.save() 
 
+
+def user_ids_from(request):
+    """The ``user_ids`` list of a bulk membership request, or None if malformed"""
+    user_ids = request.data.get('user_ids')
+    if not isinstance(user_ids, list):
+        return None
+    try:
+        return [int(user_id) for user_id in user_ids]
+    except (TypeError, ValueError):
+        return None
+
+
+class BulkMembershipMixin:
+    """
+    POST adds, DELETE removes and PUT replaces members by id, with a body of
+    ``{"user_ids": [...]}``. Only the creator may change the member list.
+    """
+    add_members = remove_members = sync_members = None
+
+    def get_owner(self):
+        raise NotImplementedError
+
+    def _change(self, request, operation):
+        owner = self.get_owner()
+        if owner.created_by_id != request.user.id:
+            raise PermissionDenied("Only the creator can change members")
+        user_ids = user_ids_from(request)
+        if user_ids is None:
+            return Response(
+                {"error": "user_ids must be a list of user IDs"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if operation == 'sync':
+            added, removed = self.sync_members(owner.id, user_ids)
+        elif operation == 'add':
+            added, removed = self.add_members(owner.id, user_ids), []
+        else:
+            added, removed = [], self.remove_members(owner.id, user_ids)
+        return Response({'added': len(added), 'removed': len(removed)})
+
+    def post(self, request, *args, **kwargs):
+        return self._change(request, 'add')
+
+    def put(self, request, *args, **kwargs):
+        return self._change(request, 'sync')
+
+    def delete(self, request, *args, **kwargs):
+        return self._change(request, 'remove')
+
+
+class ChannelMemberListView(BulkMembershipMixin, generics.ListAPIView):
+    """Paginated members of a channel the current user belongs to"""
+    serializer_class = MemberSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    add_members = staticmethod(add_channel_members)
+    remove_members = staticmethod(remove_channel_members)
+    sync_members = staticmethod(sync_channel_members)
+
+    def get_owner(self):
+        channel_id = self.kwargs['channel_id']
+        if not is_member_sync(channel_id, self.request.user.id):
+            raise PermissionDenied("Channel not found or access denied")
+        return Channel.objects.only('id', 'created_by').get(id=channel_id)
+
+    def get_queryset(self):
+        channel_id = self.kwargs['channel_id']
+        if not is_member_sync(channel_id, self.request.user.id):
+            raise PermissionDenied("Channel not found or access denied")
+        return User.objects.filter(channels__id=channel_id).order_by('username', 'id')
+
+
+class TeamMemberListView(BulkMembershipMixin, generics.ListAPIView):
+    """Paginated members of a team the current user belongs to"""
+    serializer_class = MemberSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    add_members = staticmethod(add_team_members)
+    remove_members = staticmethod(remove_team_members)
+    sync_members = staticmethod(sync_team_members)
+
+    def get_owner(self):
+        team = Team.objects.filter(
+            id=self.kwargs['team_id'], members=self.request.user
+        ).only('id', 'created_by').first()
+        if team is None:
+            raise PermissionDenied("Team not found or access denied")
+        return team
+
+    def get_queryset(self):
+        team_id = self.kwargs['team_id']
+        if not Team.members.through.objects.filter(team_id=team_id, user=self.request.user).exists():
+            raise PermissionDenied("Team not found or access denied")
+        return User.objects.filter(teams__id=team_id).order_by('username', 'id')
+
+
+class UnreadCountsView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        counts = unread_counts(request.user.id)
+        return Response({
+            'channels': {str(channel_id): count for channel_id, count in counts.items()},
+            'total': sum(counts.values())
+        })
+
+
+class SocketStatsView(APIView):
+    """Outbound queue and channel layer counters of the process serving the request"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            'outbound': outbound.stats.as_dict(),
+            'layer_dropped': getattr(get_channel_layer(), 'dropped', None),
+        })
+
+
+class ReadCursorView(APIView):
+    """GET the read cursor of a channel, POST {"message_id": ...} to move it"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, channel_id):
+        if not is_member_sync(channel_id, request.user.id):
+            return Response(
+                {"error": "Channel not found or access denied"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        return Response(self._cursor(request.user.id, channel_id))
+
+    def post(self, request, channel_id):
+        if not is_member_sync(channel_id, request.user.id):
+            return Response(
+                {"error": "Channel not found or access denied"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            message_id = int(request.data.get('message_id'))
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "message_id is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not mark_read(request.user.id, channel_id, message_id):
+            return Response(
+                {"error": "Message not found in this channel"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(self._cursor(request.user.id, channel_id))
+
+    @staticmethod
+    def _cursor(user_id, channel_id):
+        return {
+            'channel_id': channel_id,
+            'last_read_message_id': read_cursor(user_id, channel_id),
+            'unread': unread_counts(user_id).get(channel_id, 0)
+        }
+
 class MessageListView(generics.ListAPIView):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
   
     def get_queryset(self):
+        # Newest 50 by default, ?before=<cursor> walks back through history.
+        # Replies are only listed in their thread. Rows are read with the
+        # sender joined in and serialized by FastMessageSerializer
+        return FastMessageSerializer.values(Message.objects.filter(
+            channel_id=self.kwargs['channel_id'],
+            parent__isnull=True
+        ))
+
+    def list(self, request, *args, **kwargs):
         channel_id = self.kwargs['channel_id']
-        cache_key = f'messages_{channel_id}_{self.request.user.id}'
-        queryset = cache.get(cache_key)
-
-        if not queryset:
-            queryset = Message.objects.filter(
-                channel_id=channel_id,
-                channel__members=self.request.user
-            ).order_by('-timestamp')[:50]  # Limit to 50 most recent messages
-            cache.set(cache_key, queryset, timeout=60*5)  # Cache for 5 minutes
-        
-        return queryset
+        if not is_member_sync(channel_id, request.user.id):
+            return Response(
+                {"error": "Channel not found or access denied"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        # Only the default first page comes from the shared channel cache
+        cacheable = not any(
+            param in request.query_params for param in ('before', 'after', 'count', 'limit')
+        )
+        if not cacheable:
+            page = self.paginate_queryset(self.get_queryset())
+            rows = FastMessageSerializer(page).data
+        else:
+            rows, generation = history_cache.get_recent(channel_id)
+            if rows is None:
+                messages = self.get_queryset().order_by('-timestamp', '-id')[:history_cache.HISTORY_SIZE]
+                rows = FastMessageSerializer(messages).data
+                history_cache.set_recent(channel_id, generation, rows)
+            rows = self.paginator.paginate_serialized(rows, request)
+
+        # Pages reaching past the hot tier continue into archived months
+        rows = archive.stitch_page(self.paginator, rows, channel_id)
+        return self.paginator.get_paginated_response(rows)
+
+
+class ThreadView(generics.ListAPIView):
+    """
+    Replies to one message, newest first with the same cursors as the
+    channel history, plus the parent message. Each page is a range scan on
+    the ``parent, timestamp`` index.
+    """
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
+
+    def get_queryset(self):
+        return FastMessageSerializer.values(Message.objects.filter(
+            channel_id=self.kwargs['channel_id'],
+            parent_id=self.kwargs['message_id']
+        ))
+
+    def list(self, request, *args, **kwargs):
+        channel_id = self.kwargs['channel_id']
+        if not is_member_sync(channel_id, request.user.id):
+            return Response(
+                {"error": "Channel not found or access denied"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        parent = Message.objects.filter(
+            id=self.kwargs['message_id'], channel_id=channel_id, parent__isnull=True
+        ).select_related('sender').first()
+        if parent is None:
+            return Response({"error": "Thread not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        page = self.paginate_queryset(self.get_queryset())
+        response = self.get_paginated_response(FastMessageSerializer(page).data)
+        response.data['parent'] = self.get_serializer(parent).data
+        return response
+
+
+class ChannelChangesView(APIView):
+    """
+    Creates, edits and deletes since ``?since=<seq>``, in seq order.
+
+    Pass the returned ``seq`` as the next ``since`` until ``has_more`` is
+    false. ``reset`` means the client is ahead of the server (e.g. a
+    restored database) and should reload the history instead.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, channel_id):
+        if not is_member_sync(channel_id, request.user.id):
+            return Response(
+                {"error": "Channel not found or access denied"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = min(int(request.query_params.get('limit', SYNC_PAGE_SIZE)), SYNC_PAGE_SIZE)
+        except ValueError:
+            return Response(
+                {"error": "since and limit must be integers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if since < 0 or limit < 1:
+            return Response(
+                {"error": "since must be >= 0 and limit >= 1"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response(serialize_changes(channel_id, since, limit))
+
+
+class ChannelExportView(APIView):
+    """Stream a channel's whole history as NDJSON, see chat.transfer"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, channel_id):
+        if not is_member_sync(channel_id, request.user.id):
+            return Response(
+                {"error": "Channel not found or access denied"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        stats = TransferStats()
+        if isinstance(request._request, ASGIRequest):
+            chunks = self._logged_async(channel_id, stats)
+        else:
+            chunks = self._logged(channel_id, stats)
+        response = StreamingHttpResponse(chunks, content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="channel-{channel_id}.ndjson"'
+        return response
+
+    @staticmethod
+    def _log(channel_id, stats):
+        logger.info('Exported channel %s: %s', channel_id, stats.as_dict())
+
+    def _logged(self, channel_id, stats):
+        yield from export_chunks(channel_id, stats=stats)
+        self._log(channel_id, stats)
+
+    async def _logged_async(self, channel_id, stats):
+        async for chunk in aexport_chunks(channel_id, stats=stats):
+            yield chunk
+        self._log(channel_id, stats)
 
 
 class MessageSearchView(APIView):
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [SearchRateThrottle]
     
     def get(self, request, channel_id):
         # Validate channel access
@@ -111,17 +476,17 @@ class MessageSearchView(APIView):
         date_from = request.GET.get('from')
         date_to = request.GET.get('to')
         user_id = request.GET.get('user')
+        from_date = to_date = None
         
         # Start with base queryset
         queryset = Message.objects.filter(
             channel=channel
-        ).select_related('sender').order_by('-timestamp')
+        ).order_by('-timestamp')
 
-        # Apply text search if provided
+        # Apply full-text search if provided
+        by_relevance = bool(search_term) and request.GET.get('sort') == 'relevance'
         if search_term:
-            queryset = queryset.filter(
-                Q(content__icontains=search_term)
-            )
+            queryset = get_search_backend().search(queryset, search_term, rank=by_relevance)
 
         # Apply date range filter if provided
         if date_from or date_to:
@@ -159,18 +524,30 @@ class MessageSearchView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-        # Pagination
-        page_size = min(int(request.GET.get('limit', '20')), 100)
-        page = int(request.GET.get('page', '1'))
-        total_count = queryset.count()
-        messages = queryset[(page-1)*page_size : page*page_size]
+        # Compiled once and applied to every row of the page
+        highlighter = Highlighter(search_term)
 
-        # Serialize results
-        serializer = MessageSerializer(messages, many=True, context={'request': request})
-        
-        return Response({
-            'results': serializer.data,
-            'total': total_count,
-            'page': page,
-            'page_size': page_size
-        })
\ No newline at end of file
+        # Best matches first, a single page since rank has no stable cursor
+        if by_relevance:
+            limit = MessageCursorPagination().get_page_size(request)
+            messages = FastMessageSerializer.values(queryset.order_by('-search_rank', '-timestamp'))[:limit]
+            return Response({
+                'next': None,
+                'previous': None,
+                'page_size': limit,
+                'results': highlighter.apply(FastMessageSerializer(messages).data)
+            })
+
+        # Keyset pagination, ?before=/?after= cursors and optional ?count=1
+        paginator = MessageCursorPagination()
+        paginator.page_size = 20
+        messages = paginator.paginate_queryset(FastMessageSerializer.values(queryset), request, view=self)
+
+        # Older matches come from archived months once the hot tier runs out
+        rows = archive.stitch_page(
+            paginator,
+            FastMessageSerializer(messages).data,
+            channel.id,
+            archive.search_matcher(search_term, from_date, to_date, user_id or None),
+        )
+        return paginator.get_paginated_response(highlighter.apply(rows))
\ No newline at end of file
@@ -13,17 +13,22 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-from chat.routing import websocket_urlpatterns
+from channels.routing import ChannelNameRouter
+from chat.routing import channel_routes, websocket_urlpatterns
 from chat.middleware import JWTAuthMiddleware
+from chat.outbound import ServerSendMiddleware
 import chat.routing
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": JWTAuthMiddleware(
-        AuthMiddlewareStack(
-            URLRouter(
-                websocket_urlpatterns
+    "websocket": ServerSendMiddleware(
+        JWTAuthMiddleware(
+            AuthMiddlewareStack(
+                URLRouter(
+                    websocket_urlpatterns
+                )
             )
         )
     ),
+    "channel": ChannelNameRouter(channel_routes),
 })
\ No newline at end of file
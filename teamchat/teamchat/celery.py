@@ -15,9 +15,17 @@ app.autodiscover_tasks()
 
 
 app.conf.beat_schedule = {
-    'cleanup-presence': {
-        'task': 'chat.tasks.cleanup_presence',
-        'schedule': crontab(minute='*/5'),  # Every 5 minutes
+    'flush-presence': {
+        'task': 'chat.tasks.flush_presence',
+        'schedule': 30.0,  # Every 30 seconds
+    },
+    'flush-read-cursors': {
+        'task': 'chat.tasks.flush_read_cursors',
+        'schedule': 30.0,
+    },
+    'archive-messages': {
+        'task': 'chat.tasks.archive_messages',
+        'schedule': crontab(hour=3, minute=30),  # Daily, off-peak
     },
 }
 
@@ -147,9 +147,12 @@ SIMPLE_JWT = {
     'BLACKLIST_AFTER_ROTATION': True,
 }
 
+# Sockets of the same process get group messages in memory, other
+# processes through one Redis pub/sub message each (see chat.layers);
+# channels_redis.core.RedisChannelLayer works as well
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.layers.HybridChannelLayer',
         'CONFIG': {
             "hosts": [('127.0.0.1', 6379)],  
         },
@@ -166,4 +169,121 @@ AUTH_USER_MODEL = 'chat.User'
 
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
-]
\ No newline at end of file
+]
+
+# Write-behind message persistence: messages are fanned out with a provisional
+# id and inserted in batches of CHAT_WRITE_BEHIND_BATCH_SIZE or every
+# CHAT_WRITE_BEHIND_FLUSH_MS milliseconds, whichever comes first.
+CHAT_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', 'false').lower() == 'true'
+CHAT_WRITE_BEHIND_BATCH_SIZE = 50
+CHAT_WRITE_BEHIND_FLUSH_MS = 100
+
+# In-process channel membership cache used by the WebSocket consumers
+CHAT_MEMBERSHIP_CACHE_SIZE = 10000
+CHAT_MEMBERSHIP_CACHE_TTL = 300  # seconds
+
+# Rate limiting for the WebSocket and REST paths. MemoryRateLimiter keeps
+# counters per process and is meant for tests and single-process setups.
+CHAT_RATE_LIMITER = {
+    'BACKEND': 'chat.ratelimit.RedisRateLimiter',
+    'OPTIONS': {
+        'url': 'redis://127.0.0.1:6379/1',
+    },
+}
+
+CHAT_RATE_LIMITS = {
+    'message:user': {'algorithm': 'sliding_window', 'limit': 20, 'window': 60},
+    'message:channel': {'algorithm': 'token_bucket', 'limit': 600, 'window': 60},
+    'message:ip': {'algorithm': 'token_bucket', 'limit': 120, 'window': 60},
+    'search:user': {'algorithm': 'sliding_window', 'limit': 30, 'window': 60},
+    'search:ip': {'algorithm': 'token_bucket', 'limit': 60, 'window': 60},
+}
+
+# Shared cache (history pages, generations) for every web and socket worker
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/2',
+    }
+}
+
+CHAT_HISTORY_CACHE_SIZE = 51  # one page plus a row to detect older history
+CHAT_HISTORY_CACHE_TIMEOUT = 60 * 5
+
+# Presence: connections expire CHAT_PRESENCE_TTL seconds after the last
+# heartbeat, offline is announced CHAT_PRESENCE_OFFLINE_GRACE seconds after
+# the last connection closes. last_seen is flushed by chat.tasks.flush_presence.
+CHAT_PRESENCE_STORE = {
+    'BACKEND': 'chat.presence.RedisPresenceStore',
+    'OPTIONS': {
+        'url': 'redis://127.0.0.1:6379/1',
+    },
+}
+CHAT_PRESENCE_TTL = 90
+CHAT_PRESENCE_OFFLINE_GRACE = 10
+
+CHAT_MULTIPLEX_MAX_CHANNELS = 500  # subscriptions per multiplexed socket
+
+# Unread counters per (user, channel); read cursors are flushed to
+# UserChannelLastSeen by chat.tasks.flush_read_cursors.
+CHAT_UNREAD_STORE = {
+    'BACKEND': 'chat.unread.RedisUnreadStore',
+    'OPTIONS': {
+        'url': 'redis://127.0.0.1:6379/1',
+    },
+}
+
+# Users resolved from WebSocket tokens: kept CHAT_AUTH_USER_CACHE_TTL seconds
+# in process and CHAT_AUTH_USER_CACHE_TIMEOUT seconds in the shared cache,
+# dropped from both when the user is saved.
+CHAT_AUTH_USER_CACHE_SIZE = 10000
+CHAT_AUTH_USER_CACHE_TTL = 30
+CHAT_AUTH_USER_CACHE_TIMEOUT = 60 * 5
+
+# Most changes returned by one call to the channel changes endpoint
+CHAT_SYNC_PAGE_SIZE = 500
+
+# The last CHAT_REPLAY_BUFFER size frames of each channel, replayed to
+# sockets that reconnect with ?since=<seq>
+CHAT_REPLAY_BUFFER = {
+    'BACKEND': 'chat.replay.RedisReplayBuffer',
+    'OPTIONS': {
+        'url': 'redis://127.0.0.1:6379/1',
+        'size': 500,
+    },
+}
+
+# Threads that went quiet more than CHAT_ARCHIVE_AFTER_DAYS ago are moved to
+# compressed monthly archives by chat.tasks.archive_messages.
+CHAT_ARCHIVE_AFTER_DAYS = 365
+CHAT_ARCHIVE_BATCH_SIZE = 1000
+
+# Rows per chunk for the NDJSON export stream and import transactions
+CHAT_EXPORT_CHUNK_SIZE = 2000
+CHAT_IMPORT_CHUNK_SIZE = 1000
+
+# Search results carry up to CHAT_HIGHLIGHT_MAX_SNIPPETS snippets with
+# CHAT_HIGHLIGHT_CONTEXT characters around the matches (None: whole message)
+CHAT_HIGHLIGHT_CONTEXT = 60
+CHAT_HIGHLIGHT_MAX_SNIPPETS = 3
+
+# Channels with Channel.group_shards > 1 (see chat.groups and the
+# shard_channel command) fan out per shard group. With CHAT_GROUP_RELAY set
+# to a channel name, e.g. 'chat-group-relay', senders hand sharded sends to
+# `manage.py runworker <name>` instead of doing them inline.
+CHAT_GROUP_RELAY = None
+CHAT_GROUP_SHARDS_CACHE_TTL = 300
+
+# Frames waiting for a slow WebSocket client (under Daphne, once Twisted's
+# 64 KiB transport buffer is full), see chat.outbound. Past either
+# mark presence is coalesced/dropped and CHAT_OUTBOUND_OVERFLOW applies:
+# 'resync' (replace the queue with a resync_required frame) or 'disconnect'.
+CHAT_OUTBOUND_HIGH_WATER = 500
+CHAT_OUTBOUND_HIGH_WATER_BYTES = 1024 * 1024
+CHAT_OUTBOUND_OVERFLOW = 'resync'
+
+# Typing indicators: a user is broadcast at most once per
+# CHAT_TYPING_INTERVAL seconds per channel, typists of a channel are
+# collected for CHAT_TYPING_BATCH_MS into one frame
+CHAT_TYPING_INTERVAL = 3
+CHAT_TYPING_BATCH_MS = 250